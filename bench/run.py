@@ -0,0 +1,165 @@
+#!/usr/bin/env python2
+
+"""
+	Run the RSwail benchmarks and report how long each phase takes.
+
+	Every workload is run with each available build of the interpreter:
+	the interpreted target.py, and the compiled swail-nojit and swail.
+	Builds that haven't been compiled yet are skipped.
+	The interpreter reports the time spent parsing, compiling and executing
+	(see the --timings option of target.py), and we write these as JSON.
+
+	Usage: bench/run.py [--repeat N] [--build NAME]... [--output FILE] [WORKLOAD]...
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+"""The interpreters we can benchmark, with the command to run them."""
+BUILDS = [
+	("interpreted", [sys.executable, os.path.join(ROOT_DIR, "target.py")]),
+	("nojit", [os.path.join(ROOT_DIR, "swail-nojit")]),
+	("jit", [os.path.join(ROOT_DIR, "swail")]),
+]
+
+"""How deep the call chain of deep_calls.swa goes."""
+DEEP_CALL_DEPTH = 200
+"""How many declarations long_file.swa contains."""
+LONG_FILE_DECLARATIONS = 2000
+
+def generate_deep_calls():
+	"""A long chain of functions that each call the previous one."""
+	lines = ["# Call a chain of %d functions." % DEEP_CALL_DEPTH, ""]
+	lines += ["def deep0(x):", "\tx", ""]
+	for depth in range(1, DEEP_CALL_DEPTH + 1):
+		lines += ["def deep%d(x):" % depth, "\tdeep%d(x)" % (depth - 1), ""]
+	lines += ["deep%d(%d)" % (DEEP_CALL_DEPTH, i) for i in range(50)]
+	return "\n".join(lines) + "\n"
+
+def generate_long_file():
+	"""Many short top-level statements, mostly stressing the parser."""
+	lines = ["# %d declarations and calls." % LONG_FILE_DECLARATIONS, ""]
+	for i in range(LONG_FILE_DECLARATIONS):
+		lines += [
+			"def function%d(x, y):" % i,
+			"\tx",
+			"function%d(%d, hello.name)" % (i, i),
+		]
+	return "\n".join(lines) + "\n"
+
+"""Workloads that are too long to keep around as a file."""
+GENERATED_WORKLOADS = [
+	("deep_calls", generate_deep_calls),
+	("long_file", generate_long_file),
+]
+
+def find_workloads(work_dir):
+	"""Collect all workloads, writing the generated ones to work_dir.
+
+	Returns a list of (name, path) pairs.
+	"""
+	workloads = []
+	for filename in sorted(os.listdir(BENCH_DIR)):
+		if filename.endswith(".swa"):
+			workloads.append((filename[:-len(".swa")], os.path.join(BENCH_DIR, filename)))
+	for name, generate in GENERATED_WORKLOADS:
+		path = os.path.join(work_dir, name + ".swa")
+		with open(path, "w") as workload_file:
+			workload_file.write(generate())
+		workloads.append((name, path))
+	return sorted(workloads)
+
+def parse_timings(output):
+	"""Read the "timing <phase> <seconds>" lines the interpreter writes."""
+	timings = {}
+	for line in output.splitlines():
+		words = line.split()
+		if len(words) == 3 and words[0] == "timing":
+			timings[words[1]] = float(words[2])
+	return timings
+
+def run_once(command, path):
+	"""Run the workload once and return the timings of each phase.
+
+	Besides the phases the interpreter reports, "total" is the wall clock time
+	of the whole process, including startup.
+	"""
+	start = time.time()
+	process = subprocess.Popen(command + ["--timings", "--no-cache", path],
+			cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = process.communicate()
+	total = time.time() - start
+	if process.returncode != 0:
+		raise RuntimeError("%s failed on %s:\n%s" % (command[-1], path, err.decode("utf-8", "replace")))
+	timings = parse_timings(err.decode("utf-8", "replace"))
+	timings["total"] = total
+	return timings
+
+def best_timings(runs):
+	"""Take the fastest time of each phase over all runs."""
+	best = {}
+	for run in runs:
+		for phase, seconds in run.items():
+			if phase not in best or seconds < best[phase]:
+				best[phase] = seconds
+	return best
+
+def main(argv):
+	repeat = 3
+	builds = []
+	output = None
+	selected = []
+	args = list(argv[1:])
+	while args:
+		arg = args.pop(0)
+		if arg == "--repeat":
+			repeat = int(args.pop(0))
+		elif arg == "--build":
+			builds.append(args.pop(0))
+		elif arg == "--output":
+			output = args.pop(0)
+		else:
+			selected.append(arg)
+
+	work_dir = tempfile.mkdtemp(prefix="swail-bench-")
+	try:
+		workloads = find_workloads(work_dir)
+		if selected:
+			workloads = [(name, path) for name, path in workloads if name in selected]
+		results = []
+		for build, command in BUILDS:
+			if builds and build not in builds:
+				continue
+			if not os.path.exists(command[-1]):
+				sys.stderr.write("skipping %s: %s doesn't exist\n" % (build, command[-1]))
+				continue
+			for name, path in workloads:
+				sys.stderr.write("running %s with %s\n" % (name, build))
+				runs = [run_once(command, path) for _ in range(repeat)]
+				results.append({
+					"build": build,
+					"workload": name,
+					"runs": runs,
+					"best": best_timings(runs),
+				})
+	finally:
+		shutil.rmtree(work_dir)
+
+	report = json.dumps({"repeat": repeat, "results": results}, indent=1, sort_keys=True)
+	if output is None:
+		sys.stdout.write(report + "\n")
+	else:
+		with open(output, "w") as output_file:
+			output_file.write(report + "\n")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
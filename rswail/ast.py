@@ -1,12 +1,18 @@
-from rswail.bytecode import Instruction
+from rswail.bytecode import Instruction, MatchTable
 from rswail.closure import Closure
-from rswail.cons_list import cons_list, from_list, to_list
+from rswail.cons_list import List, cons_list, from_list, to_list
+from rswail.function import CodeFunction
 from rswail.struct import Struct, StructInstance, construct
 from rswail.value import Integer, String, Value
 
 statement = Struct(u"statement", {
 	u"declaration": [u"header", u"name", u"args", u"body"],
 	u"expression": [u"expr"],
+	u"match": [u"value", u"default", u"cases"],
+})
+
+match_case = Struct(u"match-case", {
+	u"case": [u"member", u"bindings", u"body"],
 })
 
 expression = Struct(u"expression", {
@@ -21,6 +27,7 @@ def expr_base_value(value):
 	assert isinstance(value, Value)
 	return construct(expression, u"base_value", value)
 def expr_apply(function, args):
+	assert isinstance(args, StructInstance)
 	assert args.member.parent is cons_list
 	return construct(expression, u"apply", function, args)
 def expr_from_int(value):
@@ -30,6 +37,10 @@ def stmt_declaration(header, name, args, body):
 	return construct(statement, u"declaration", header, name, args, body)
 def stmt_expression(expr):
 	return construct(statement, u"expression", expr)
+def stmt_match(value, default, cases):
+	return construct(statement, u"match", value, default, cases)
+def make_case(member, bindings, body):
+	return construct(match_case, u"case", member, bindings, body)
 
 def compile_statement(program, block_id, stmt, closure):
 	"""Add code to implement the statement to the given block.
@@ -41,7 +52,19 @@ def compile_statement(program, block_id, stmt, closure):
 	"""
 	assert isinstance(stmt, StructInstance)
 	if stmt.member.name == u"declaration":
-		(header, name, args, body) = stmt.values
+		header = stmt.get_field(0)
+		name = stmt.get_field(1)
+		args = stmt.get_field(2)
+		body = stmt.get_field(3)
+		if is_builtin_def(header, closure):
+			# compile the function directly instead of calling def at runtime
+			closure.make_used(u"def")
+			function, captured = compile_function(program, name, args, body, closure)
+			value_id = program.add_constant(block_id, function)
+			program.add_instruction(block_id, Instruction.PUSH_CONST, value_id)
+			if len(captured) > 0:
+				block_id = compile_make_closure(program, block_id, function, captured, closure)
+			return store_declaration(program, block_id, name, closure)
 		header_expr = expr_name_access(header)
 		# convert all the arguments to base values so we can call with them
 		name_expr = expr_base_value(name)
@@ -50,23 +73,239 @@ def compile_statement(program, block_id, stmt, closure):
 		call_expr = expr_apply(header_expr, from_list([name_expr, args_expr, body_expr]))
 		# run the header against the AST
 		block_id = compile_expression(program, block_id, call_expr, closure)
-		
-		# store it as a name
-		program.add_instruction(block_id, Instruction.DUP, 1)
-		assert isinstance(name, String)
-		name_id = program.add_name(block_id, name.value)
-		program.add_instruction(block_id, Instruction.STORE_LOCAL, name_id)
-		closure.make_bound(name.value)
-		
-		# return value of the statement is whatever we just stored
-		return block_id
+		return store_declaration(program, block_id, name, closure)
 	elif stmt.member.name == u"expression":
-		(expr,) = stmt.values
+		expr = stmt.get_field(0)
 		# return value is the value of the expression
 		return compile_expression(program, block_id, expr, closure)
+	elif stmt.member.name == u"match":
+		return compile_match(program, block_id, stmt, closure)
 	else: # pragma: no cover
 		raise NotImplementedError
 
+def store_declaration(program, block_id, name, closure):
+	"""Add code to store the declared value in TOS as a variable.
+	
+	The value stays on the stack, as the return value of the declaration.
+	
+	Returns the block id that any code after this should append to.
+	"""
+	program.add_instruction(block_id, Instruction.DUP, 1)
+	assert isinstance(name, String)
+	slot = closure.make_bound(name.value)
+	if closure.is_global:
+		name_id = program.add_name(block_id, name.value)
+		program.add_instruction(block_id, Instruction.STORE_GLOBAL, name_id)
+	else:
+		program.add_instruction(block_id, Instruction.STORE_FAST, slot)
+	return block_id
+
+def store_variable(program, block_id, name, closure):
+	"""Add code to pop TOS and store it as a newly bound variable."""
+	assert isinstance(name, unicode)
+	slot = closure.make_bound(name)
+	if closure.is_global:
+		name_id = program.add_name(block_id, name)
+		program.add_instruction(block_id, Instruction.STORE_GLOBAL, name_id)
+	else:
+		program.add_instruction(block_id, Instruction.STORE_FAST, slot)
+
+def compile_match(program, block_id, stmt, closure):
+	"""Add code to run the body of the case matching a value.
+	
+	The cases are chosen by a single JUMP_TABLE instruction.
+	Each case names a struct member, optionally qualified by its struct,
+	and matches the instances of the members with that name and as many
+	fields as the case has variables, see MatchTable. The fields of the
+	instance are bound to the variables of the case, in order.
+	If no case matches, the default body runs, or an error occurs if the
+	match has no default.
+	
+	Returns the block id that any code after this statement should append to.
+	"""
+	value = stmt.get_field(0)
+	default = to_list(stmt.get_field(1))
+	cases = to_list(stmt.get_field(2))
+	block_id = compile_expression(program, block_id, value, closure)
+	
+	struct_names = []
+	member_names = []
+	field_counts = []
+	labels = []
+	case_blocks = []
+	for case in cases:
+		member = case.get_field(0)
+		assert isinstance(member, List)
+		member_name = member.get_item(member.length - 1)
+		assert isinstance(member_name, String)
+		member_names.append(member_name.value)
+		if member.length > 1:
+			struct_name = member.get_item(member.length - 2)
+			assert isinstance(struct_name, String)
+			struct_names.append(struct_name.value)
+		else:
+			struct_names.append(u"")
+		bindings = case.get_field(1)
+		assert isinstance(bindings, List)
+		field_counts.append(bindings.length)
+		case_block = program.new_block()
+		case_blocks.append(case_block)
+		labels.append(program.add_label(block_id, case_block))
+	table = MatchTable(struct_names, member_names, field_counts, labels, len(default) > 0)
+	table_id = program.add_match_table(block_id, table)
+	program.add_instruction(block_id, Instruction.JUMP_TABLE, table_id)
+	
+	end_block = program.new_block()
+	if len(default) > 0:
+		# no case matches, so we don't need the value
+		program.add_instruction(block_id, Instruction.POP, 1)
+		block_id = compile_statements(program, block_id, default, closure)
+		end_label = program.add_label(block_id, end_block)
+		program.add_instruction(block_id, Instruction.JUMP, end_label)
+	
+	for index in range(len(cases)):
+		case = cases[index]
+		block_id = case_blocks[index]
+		# bind the fields, with the last field on top of the stack
+		bindings = to_list(case.get_field(1))
+		program.add_instruction(block_id, Instruction.UNPACK, len(bindings))
+		for neg_index in range(len(bindings)):
+			binding = bindings[len(bindings) - neg_index - 1]
+			assert isinstance(binding, String)
+			store_variable(program, block_id, binding.value, closure)
+		body = to_list(case.get_field(2))
+		if len(body) == 0:
+			program.add_instruction(block_id, Instruction.PUSH_CONST, 0)
+		block_id = compile_statements(program, block_id, body, closure)
+		end_label = program.add_label(block_id, end_block)
+		program.add_instruction(block_id, Instruction.JUMP, end_label)
+	return end_block
+
+def is_builtin_def(header, closure):
+	"""Is the header of a declaration the builtin def?
+	
+	It isn't if def has been redeclared in the closure.
+	"""
+	assert isinstance(header, List)
+	if header.length != 1:
+		return False
+	root = header.head()
+	assert isinstance(root, String)
+	return root.value == u"def" and u"def" not in closure.bound_variables
+
+def compile_function(program, name, args, body, closure):
+	"""Compile a function declaration into new blocks.
+	
+	The arguments are bound to the first slots of the function's closure,
+	and the function returns the value of the last statement of the body.
+	The closure is the one the declaration is in.
+	
+	Returns the CodeFunction that runs the body when called,
+	and the list of names of the free variables it captures from closure.
+	If there are any, the CodeFunction is a template for MAKE_CLOSURE.
+	"""
+	assert isinstance(name, String)
+	function_closure = Closure(parent=closure, function_name=name.value)
+	entry_block = program.new_block()
+	block_id = entry_block
+	
+	# the arguments are on the stack, with the last argument as TOS
+	arg_list = to_list(args)
+	slots = []
+	for arg in arg_list:
+		assert isinstance(arg, StructInstance)
+		assert arg.member is expression.members[u"name_access"]
+		arg_name = arg.get_field(0)
+		assert isinstance(arg_name, List)
+		assert arg_name.length == 1
+		root = arg_name.head()
+		assert isinstance(root, String)
+		slots.append(function_closure.make_bound(root.value))
+	for neg_index in range(0, len(slots)):
+		slot = slots[len(slots) - neg_index - 1]
+		program.add_instruction(block_id, Instruction.STORE_FAST, slot)
+	
+	# run the body, keeping only the value of the last statement
+	statements = to_list(body)
+	if len(statements) == 0:
+		program.add_instruction(block_id, Instruction.PUSH_CONST, 0)
+	block_id = compile_statements(program, block_id, statements, function_closure)
+	
+	program.add_instruction(block_id, Instruction.RETURN)
+	# the caller has put the arguments on the stack
+	stack_depth = program.stack_depth(entry_block, len(slots))
+	function_closure.capture_free_variables()
+	for load_block, index, load_name in function_closure.free_loads:
+		captured_index = function_closure.get_captured_index(load_name)
+		block = program.get_block(load_block)
+		if captured_index >= 0:
+			block.arguments[index] = captured_index
+		else:
+			# the function binds the variable after all, so it isn't free
+			block.opcodes[index] = Instruction.LOAD_FAST
+			block.arguments[index] = function_closure.get_slot(load_name)
+	captured = function_closure.captured
+	self_index = function_closure.captured_indexes.get(name.value, -1)
+	function = CodeFunction(name.value, entry_block, function_closure.slot_count(),
+			stack_depth, self_index=self_index, arg_count=len(slots))
+	return function, captured
+
+def compile_make_closure(program, block_id, function, captured, closure):
+	"""Add code to capture the free variables of the function in TOS.
+	
+	The variables are loaded from the closure in which the function is
+	declared, and MAKE_CLOSURE replaces the template in TOS by a function
+	that stores their values.
+	
+	Returns the block id that any code after this should append to.
+	"""
+	for index in range(len(captured)):
+		if index == function.self_index:
+			# MAKE_CLOSURE puts the new function here, so it can call itself
+			program.add_instruction(block_id, Instruction.PUSH_CONST, 0)
+		else:
+			block_id = compile_load_variable(program, block_id, captured[index], closure)
+	program.add_instruction(block_id, Instruction.MAKE_CLOSURE, len(captured))
+	return block_id
+
+def compile_load_variable(program, block_id, name, closure):
+	"""Add code to push the value of the variable with the given name.
+	
+	The variable comes from a slot if it's bound in this closure,
+	from the captured variables if an enclosing function binds it,
+	and from the globals otherwise.
+	
+	Returns the block id that any code after this should append to.
+	"""
+	assert isinstance(name, unicode)
+	closure.make_used(name)
+	slot = closure.get_slot(name)
+	if slot >= 0:
+		program.add_instruction(block_id, Instruction.LOAD_FAST, slot)
+		return block_id
+	if closure.can_capture(name):
+		# the index is filled in by compile_function
+		closure.add_free_load(block_id, program.get_block(block_id).instruction_count(), name)
+		program.add_instruction(block_id, Instruction.LOAD_FREE, 0)
+		return block_id
+	name_id = program.add_name(block_id, name)
+	program.add_instruction(block_id, Instruction.LOAD_GLOBAL, name_id)
+	return block_id
+
+def compile_statements(program, block_id, statements, closure):
+	"""Add code to run the statements in the list one after the other.
+	
+	The values of all statements are popped, except for the last one,
+	which stays on top of the stack.
+	
+	Returns the block id that any code after these statements should append to.
+	"""
+	for index in range(0, len(statements)):
+		if index > 0:
+			program.add_instruction(block_id, Instruction.POP, 1)
+		block_id = compile_statement(program, block_id, statements[index], closure)
+	return block_id
+
 def compile_expression(program, block_id, expr, closure):
 	"""Add code to implement the expression to the given block.
 	
@@ -75,31 +314,29 @@ def compile_expression(program, block_id, expr, closure):
 	
 	Returns the block id that any code after this expression should append to.
 	"""
+	assert isinstance(expr, StructInstance)
 	if expr.member.name == u"name_access":
 		# get the root and all its attributes
-		(name,) = expr.values
-		assert name.member is cons_list.members[u"cons"]
-		root, tail = name.values
+		name = expr.get_field(0)
+		assert isinstance(name, List)
+		assert not name.is_empty()
+		root = name.head()
 		assert isinstance(root, String)
 		root_name = root.value
 		assert isinstance(root_name, unicode)
 		
-		# load the root
-		closure.make_used(root_name)
-		root_id = program.add_name(block_id, root_name)
-		assert isinstance(root_id, int)
-		program.add_instruction(block_id, Instruction.LOAD_LOCAL, root_id)
+		block_id = compile_load_variable(program, block_id, root_name, closure)
 		
 		# load its attributes
-		while tail.member is cons_list.members[u"cons"]:
-			attr, tail = tail.values
+		for index in range(1, name.length):
+			attr = name.get_item(index)
 			assert isinstance(attr, String)
 			attr_id = program.add_name(block_id, attr.value)
 			program.add_instruction(block_id, Instruction.LOAD_ATTR, attr_id)
-		assert tail.member is cons_list.members[u"empty"]
 		return block_id
 	elif expr.member.name == u"apply":
-		(function_expr, arg_exprs) = expr.values
+		function_expr = expr.get_field(0)
+		arg_exprs = expr.get_field(1)
 		block_id = compile_expression(program, block_id, function_expr, closure)
 		arg_expr_list = to_list(arg_exprs)
 		for arg_expr in arg_expr_list:
@@ -110,7 +347,7 @@ def compile_expression(program, block_id, expr, closure):
 		next_block = program.make_next_block(block_id)
 		return next_block
 	elif expr.member.name == u"base_value":
-		(value,) = expr.values
+		value = expr.get_field(0)
 		value_id = program.add_constant(block_id, value)
 		program.add_instruction(block_id, Instruction.PUSH_CONST, value_id)
 		return block_id
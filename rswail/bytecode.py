@@ -1,7 +1,11 @@
-from rpython.rtyper.lltypesystem.lltype import Array, Unsigned
+import sys
+
+from rpython.rlib.jit import elidable
 
 from rswail.closure import Closure
-from rswail.value import Unit, Value
+from rswail.globals import make_globals
+from rswail.map import AttributeCache
+from rswail.value import Unit, Value, make_value_dict
 
 class Instruction:
 	"""Contains constants for each opcode in the language.
@@ -11,7 +15,8 @@ class Instruction:
 	For example, PUSH_INT takes an int as argument and places it on the stack.
 	If the description doesn't mention its meaning, the argument is any valid value.
 	
-	TODO: decide how many bits we want to use for opcodes / arguments.
+	Once a block is finalized, each instruction is packed into a single word,
+	with the opcode in the lowest OPCODE_BITS bits and the argument above.
 	"""
 	NOP = 0 # Do nothing
 	HELLO = 1 # Print "Hello, World!"
@@ -24,13 +29,100 @@ class Instruction:
 	STORE_LOCAL = 8 # Pop and write to locals[names[<arg>]]
 	POP = 9 # Pop <arg> values from the stack (0 < arg)
 	DUP = 10 # Duplicate the <arg>th value on the stack (0 < arg <= len(stack))
-	CALL = 11 # Pop <arg> arguments, pop function, call function with arguments
+	CALL = 11 # Pop <arg> arguments, pop function, call function with arguments,
+		# then continue after the call, or at next_block_id if it is the last instruction
 	LOAD_ATTR = 12 # Pop value and push value[names[<arg>]]
 	JUMP_LABEL = 13 # Pop <arg>th value on the stack and jump to the labeled block
 	SWAP = 14 # Move the <arg>th value on the stack to TOS (0 < arg <= len(stack))
+	LOAD_FAST = 15 # Push slots[<arg>]
+	STORE_FAST = 16 # Pop and write to slots[<arg>]
+	LOAD_GLOBAL = 17 # Push globals[names[<arg>]]
+	STORE_GLOBAL = 18 # Pop and write to globals[names[<arg>]]
+	STORE_FAST_KEEP = 19 # Write TOS to slots[<arg>] without popping
+	STORE_GLOBAL_KEEP = 20 # Write TOS to globals[names[<arg>]] without popping
+	# the following take a combined argument, see pack_load_attr
+	LOAD_FAST_ATTR = 21 # Push slots[<load>][names[<attr>]]
+	LOAD_GLOBAL_ATTR = 22 # Push globals[names[<load>]][names[<attr>]]
+	JUMP_TABLE = 23 # Jump to the case of match_tables[<arg>] matching TOS, without popping,
+		# or continue if no case matches and the match has a default
+	UNPACK = 24 # Pop struct instance with <arg> fields and push the fields, the last as TOS
+	LOAD_FREE = 25 # Push captured[<arg>] of the running function
+	MAKE_CLOSURE = 26 # Pop <arg> values, pop function and push the function capturing the values
+	TAIL_CALL = 27 # CALL followed by RETURN, reusing the frame for the call if possible
+	RETURN = 28 # Return TOS from the running function to the caller
+	# the following are made by the interpreter, see Block.quicken
+	CALL_NATIVE = 29 # CALL for a NativeFunction
+	CALL_CODE = 30 # CALL for a CodeFunction
+	JUMP_IF_BOOL = 31 # JUMP_IF for a Boolean
+	LOAD_ATTR_STRUCT_MEMBER = 32 # LOAD_ATTR for a Struct with the map seen before
 	
 	HCF = 255 # Halt and Catch Fire: should never be implemented
 
+"""The number of bits of a packed instruction used for the opcode."""
+OPCODE_BITS = 8
+OPCODE_MASK = (1 << OPCODE_BITS) - 1
+"""The range of arguments that fit in a packed instruction."""
+MAX_ARGUMENT = sys.maxint >> OPCODE_BITS
+MIN_ARGUMENT = -MAX_ARGUMENT - 1
+
+def pack_instruction(opcode, argument):
+	"""Combine an opcode and its argument into a single word."""
+	assert 0 <= opcode <= OPCODE_MASK
+	assert MIN_ARGUMENT <= argument <= MAX_ARGUMENT
+	return (argument << OPCODE_BITS) | opcode
+def unpack_opcode(instruction):
+	"""Get the opcode of a packed instruction."""
+	return instruction & OPCODE_MASK
+def unpack_argument(instruction):
+	"""Get the argument of a packed instruction."""
+	return instruction >> OPCODE_BITS
+
+"""The number of bits of a combined argument used for the load argument."""
+LOAD_ARGUMENT_BITS = 24
+LOAD_ARGUMENT_MASK = (1 << LOAD_ARGUMENT_BITS) - 1
+"""The range of each half of a combined argument."""
+MAX_LOAD_ARGUMENT = LOAD_ARGUMENT_MASK
+MAX_ATTR_ARGUMENT = MAX_ARGUMENT >> LOAD_ARGUMENT_BITS
+
+def pack_load_attr(load_argument, attr_argument):
+	"""Combine the arguments of a load and a LOAD_ATTR into one argument.
+	
+	Used by superinstructions such as LOAD_FAST_ATTR.
+	"""
+	assert 0 <= load_argument <= MAX_LOAD_ARGUMENT
+	assert 0 <= attr_argument <= MAX_ATTR_ARGUMENT
+	return (attr_argument << LOAD_ARGUMENT_BITS) | load_argument
+def unpack_load(argument):
+	"""Get the load argument from a combined argument."""
+	return argument & LOAD_ARGUMENT_MASK
+def unpack_attr(argument):
+	"""Get the LOAD_ATTR argument from a combined argument."""
+	return argument >> LOAD_ARGUMENT_BITS
+
+def stack_effect(opcode, argument):
+	"""How much the instruction changes the height of the stack.
+	
+	No instruction has more values on the stack halfway through
+	than before or after it, so this also gives the most values it needs.
+	"""
+	if opcode in [Instruction.PUSH_INT, Instruction.PUSH_CONST,
+			Instruction.LOAD_LOCAL, Instruction.LOAD_FAST,
+			Instruction.LOAD_GLOBAL, Instruction.DUP,
+			Instruction.LOAD_FAST_ATTR, Instruction.LOAD_GLOBAL_ATTR,
+			Instruction.LOAD_FREE]:
+		return 1
+	elif opcode in [Instruction.WRITE, Instruction.JUMP_IF,
+			Instruction.STORE_LOCAL, Instruction.STORE_FAST,
+			Instruction.STORE_GLOBAL, Instruction.JUMP_LABEL,
+			Instruction.JUMP_IF_BOOL]:
+		return -1
+	elif opcode in [Instruction.POP, Instruction.CALL, Instruction.MAKE_CLOSURE,
+			Instruction.TAIL_CALL, Instruction.CALL_NATIVE, Instruction.CALL_CODE]:
+		return -argument
+	elif opcode == Instruction.UNPACK:
+		return argument - 1
+	return 0
+
 """Maps human-readable instruction names to instruction ids."""
 instruction_names = {
 		"nop": Instruction.NOP,
@@ -48,6 +140,20 @@ instruction_names = {
 		"load_attr": Instruction.LOAD_ATTR,
 		"jump_label": Instruction.JUMP_LABEL,
 		"swap": Instruction.SWAP,
+		"load_fast": Instruction.LOAD_FAST,
+		"store_fast": Instruction.STORE_FAST,
+		"load_global": Instruction.LOAD_GLOBAL,
+		"store_global": Instruction.STORE_GLOBAL,
+		"store_fast_keep": Instruction.STORE_FAST_KEEP,
+		"store_global_keep": Instruction.STORE_GLOBAL_KEEP,
+		"load_fast_attr": Instruction.LOAD_FAST_ATTR,
+		"load_global_attr": Instruction.LOAD_GLOBAL_ATTR,
+		"jump_table": Instruction.JUMP_TABLE,
+		"unpack": Instruction.UNPACK,
+		"load_free": Instruction.LOAD_FREE,
+		"make_closure": Instruction.MAKE_CLOSURE,
+		"tail_call": Instruction.TAIL_CALL,
+		"return": Instruction.RETURN,
 		
 		"hcf": Instruction.HCF,
 }
@@ -63,58 +169,238 @@ Flags cases like returning in a block that doesn't expect return values.
 """
 INVALID_BLOCK = -1
 
-class Block:
-	"""The smallest grouping of code, with labels and constants."""
+class ConstantPool:
+	"""The constants and names used by the code of a program.
+	
+	All blocks of a program share one pool, and instructions refer to its items
+	by their index. Equivalent constants and equal names are stored only once.
+	
+	While compiling, items are added to constants and names.
+	Finalizing copies them to constant_table and name_table,
+	which the JIT treats as constant until the pool is finalized again.
+	"""
+	_immutable_fields_ = ['constant_table?[*]', 'name_table?[*]']
+
 	def __init__(self):
-		"""Make a new empty block."""
+		"""Make a new pool containing only the unit value and the empty name."""
+		self.constants = []
+		"""The id of each constant, keyed by the (equivalent) value."""
+		self.constant_ids = make_value_dict()
+		self.names = []
+		"""The id of each name, keyed by the name."""
+		self.name_ids = {}
+		self.constant_table = []
+		self.name_table = []
+		self.add_constant(Unit())
+		self.add_name(u'')
+
+	def add_constant(self, value):
+		"""Add a constant, or find an equivalent one already in the pool.
+		
+		Returns the id of the constant.
+		"""
+		assert isinstance(value, Value)
+		constant_id = self.constant_ids.get(value, -1)
+		if constant_id < 0:
+			constant_id = len(self.constants)
+			self.constants.append(value)
+			self.constant_ids[value] = constant_id
+		return constant_id
+
+	def replace_constant(self, constant_id, value):
+		"""Put another value in place of the constant with the given id."""
+		assert isinstance(value, Value)
+		old_value = self.constants[constant_id]
+		if self.constant_ids.get(old_value, -1) == constant_id:
+			del self.constant_ids[old_value]
+		self.constants[constant_id] = value
+		if value not in self.constant_ids:
+			self.constant_ids[value] = constant_id
+
+	def add_name(self, name):
+		"""Add a name, or find it if it is already in the pool.
+		
+		Returns the id of the name.
+		"""
+		assert isinstance(name, unicode)
+		name_id = self.name_ids.get(name, -1)
+		if name_id < 0:
+			name_id = len(self.names)
+			self.names.append(name)
+			self.name_ids[name] = name_id
+		return name_id
+
+	def is_finalized(self):
+		"""Have all items been copied to the tables?"""
+		return (len(self.constant_table) == len(self.constants)
+				and len(self.name_table) == len(self.names))
+
+	def finalize(self):
+		"""Copy the items to the tables used for execution.
+		
+		Does nothing if no items were added since the last time.
+		"""
+		if self.is_finalized():
+			return
+		# the tables never change size, so they must be fresh lists
+		constant_table = [None] * len(self.constants)
+		for index in range(len(self.constants)):
+			constant_table[index] = self.constants[index]
+		name_table = [u""] * len(self.names)
+		for index in range(len(self.names)):
+			name_table[index] = self.names[index]
+		self.constant_table = constant_table
+		self.name_table = name_table
+
+class MatchTable:
+	"""The cases of a match statement, which JUMP_TABLE chooses from.
+	
+	Each case matches the instances of the struct members with a given name
+	and number of fields, and goes to the block of one of the labels.
+	A case can also name the struct, e.g. cons_list.cons, and then only matches
+	members of a struct with that name. Since names in the source can't
+	contain dashes, these stand for the dashes in the name of the struct.
+	The first time we match an instance of a struct, we look up the case of
+	each of its members, so after that we find the case by the member's tag.
+	"""
+	def __init__(self, struct_names, member_names, field_counts, labels, has_default):
+		"""Make a table matching members named member_names[i] to labels[i].
+		
+		The member must be of a struct named struct_names[i],
+		or any struct if that is empty, and have field_counts[i] fields.
+		If has_default is set, values matching no case continue
+		after the JUMP_TABLE instruction.
+		"""
+		assert len(struct_names) == len(labels)
+		assert len(member_names) == len(labels)
+		assert len(field_counts) == len(labels)
+		self.struct_names = struct_names
+		self.member_names = member_names
+		self.field_counts = field_counts
+		"""The label id (in the block) of each case."""
+		self.labels = labels
+		self.has_default = has_default
+		"""The struct we looked up the cases of most recently."""
+		self.struct = None
+		"""The case of each member of self.struct by tag, or -1 for none."""
+		self.cases = None
+
+	@elidable
+	def find_case(self, member):
+		"""Get the index of the case matching the member, or -1 if there is none."""
+		struct_name = member.parent.get_name().replace(u"-", u"_")
+		for index in range(len(self.member_names)):
+			if self.member_names[index] != member.get_name():
+				continue
+			if self.struct_names[index] and self.struct_names[index] != struct_name:
+				continue
+			if self.field_counts[index] == len(member.fields):
+				return index
+		return -1
+
+	def lookup(self, member):
+		"""Get the index of the case matching the member, or -1 if there is none."""
+		struct = member.parent
+		if struct is not self.struct:
+			self.cases = [self.find_case(struct_member)
+					for struct_member in struct.member_list]
+			self.struct = struct
+		return self.cases[member.tag]
+
+def copy_code(code):
+	"""Copy the packed instructions into a new list that never changes size."""
+	copy = [0] * len(code)
+	for index in range(len(code)):
+		copy[index] = code[index]
+	return copy
+
+class Block:
+	"""The smallest grouping of code, with labels.
+	
+	The constants and names the code uses are in the pool, shared by all
+	blocks of the program.
+	
+	A block is built up one instruction at a time, and finalized once it is
+	complete. After that, its code is a fixed list of packed instructions.
+	
+	The interpreter runs a copy of the code, in which it replaces instructions
+	by variants specialized on the values they saw, see quicken.
+	The JIT runs the code itself, which never changes,
+	and specializes on the values in its own way.
+	"""
+	_immutable_fields_ = ['code[*]', 'pool']
+
+	def __init__(self, pool=None):
+		"""Make a new empty block.
+		
+		The block adds its constants and names to the pool,
+		or to a new pool of its own if there is none.
+		"""
 		
 		"""The opcodes of the instructions in the program.
 		
-		Should contain exactly as many items as self.arguments
+		Should contain exactly as many items as self.arguments.
+		Becomes None when the block is finalized.
 		"""
 		self.opcodes = []
 		
 		"""The arguments of the instructions in the program.
 		
-		Should contain exactly as many items as self.opcodes
+		Should contain exactly as many items as self.opcodes.
+		Becomes None when the block is finalized.
 		"""
 		self.arguments = []
 		
-		"""The jump labels (i.e. block ids) used in this block.
+		"""The packed instructions, see pack_instruction.
 		
-		Every label should be used for an instruction.
+		Is None until the block is finalized.
 		"""
-		self.labels = [0] # TODO: better type hinting
+		self.code = None
 		
-		"""The constants (i.e. values that don't reference other values) used
-		in this block.
+		"""The packed instructions the interpreter runs, see quicken.
 		
-		Every constant should be used for an instruction.
+		Is None until the block is finalized.
 		"""
-		self.constants = [Unit()] # TODO: better type hinting
+		self.quickened = None
+		
+		"""The jump labels (i.e. block ids) used in this block.
 		
-		"""The names (i.e. unicode strings) used in this block.
+		Every label should be used for an instruction.
+		"""
+		self.labels = [0] # TODO: better type hinting
 		
-		Each name should be used for an instruction.
+		"""The constants (i.e. values that don't reference other values)
+		and names (i.e. unicode strings) used in this block.
 		"""
-		self.names = [u''] # TODO: better type hinting
+		if pool is None:
+			pool = ConstantPool()
+		self.pool = pool
+		
+		"""The tables of the JUMP_TABLE instructions in this block."""
+		self.match_tables = []
 		
 		"""The block id to jump to after this block finishes execution."""
 		self.next_block_id = INVALID_BLOCK # TODO: better type hinting
+		
+		"""The inline cache of each instruction loading an attribute.
+		
+		Indexed by the position of the instruction, and allocated on demand.
+		"""
+		self.attribute_caches = None
 	
 	def add_constant(self, value):
 		"""Add a constant to this block.
 		
 		Returns the id of the constant.
 		"""
-		assert isinstance(value, Value)
-		self.constants.append(value)
-		return len(self.constants) - 1
+		return self.pool.add_constant(value)
 	
 	def add_instruction(self, opcode, argument):
 		"""Add an instruction to the end of this block."""
 		assert isinstance(opcode, int)
 		assert isinstance(argument, int)
+		assert not self.is_finalized()
+		assert MIN_ARGUMENT <= argument <= MAX_ARGUMENT
 		self.opcodes.append(opcode)
 		self.arguments.append(argument)
 	
@@ -127,21 +413,115 @@ class Block:
 		self.labels.append(label)
 		return len(self.labels) - 1
 	
+	def add_match_table(self, table):
+		"""Add a jump table to this block.
+		
+		Returns the id of the table.
+		"""
+		assert isinstance(table, MatchTable)
+		self.match_tables.append(table)
+		return len(self.match_tables) - 1
+
 	def add_name(self, name):
 		"""Add a name to this block.
 		
 		Returns the id of the name.
 		"""
-		assert isinstance(name, unicode)
-		# don't waste too much space on non-unique names
-		if name in self.names:
-			return self.names.index(name)
-		self.names.append(name)
-		return len(self.names) - 1
+		return self.pool.add_name(name)
+
+	def is_finalized(self):
+		"""Has the code of this block been packed?"""
+		return self.code is not None
+
+	def finalize(self):
+		"""Pack the instructions, after which no more can be added.
+		
+		Does nothing if the block was already finalized.
+		"""
+		self.pool.finalize()
+		if self.is_finalized():
+			return
+		opcodes = self.opcodes
+		arguments = self.arguments
+		code = [0] * len(opcodes)
+		for index in range(len(opcodes)):
+			code[index] = pack_instruction(opcodes[index], arguments[index])
+		self.set_code(code)
+
+	def set_code(self, code):
+		"""Finalize the block with the given packed instructions.
+		
+		The block keeps its own fixed-size copies of the list code.
+		"""
+		self.code = copy_code(code)
+		self.quickened = copy_code(code)
+		self.opcodes = None
+		self.arguments = None
+
+	def quicken(self, index, opcode):
+		"""Replace the opcode of the instruction the interpreter runs.
+		
+		The new opcode is a variant of the original instruction with the same
+		argument, that only works for some values and falls back otherwise.
+		"""
+		assert self.is_finalized()
+		argument = unpack_argument(self.code[index])
+		self.quickened[index] = pack_instruction(opcode, argument)
+
+	def get_instruction(self, index):
+		"""Get the opcode and argument of the instruction at the given index."""
+		if self.is_finalized():
+			instruction = self.code[index]
+			return unpack_opcode(instruction), unpack_argument(instruction)
+		return self.opcodes[index], self.arguments[index]
+
+	def ends_with_call(self):
+		"""Does execution continue in the next block after this one?"""
+		count = self.instruction_count()
+		if count == 0:
+			return False
+		opcode, argument = self.get_instruction(count - 1)
+		return opcode == Instruction.CALL
+
+	def stack_usage(self):
+		"""Find how the block uses the stack, relative to its height at the start.
+		
+		Returns the most values the block adds to the stack at any time,
+		and how many values it adds in total (both can be negative).
+		"""
+		depth = 0
+		max_depth = 0
+		for index in range(self.instruction_count()):
+			opcode, argument = self.get_instruction(index)
+			depth += stack_effect(opcode, argument)
+			max_depth = max(max_depth, depth)
+		return max_depth, depth
+
+	def get_attribute_cache(self, pc):
+		"""Get the inline cache for the attribute loaded at the given position."""
+		assert self.is_finalized()
+		if self.attribute_caches is None:
+			self.attribute_caches = [None] * len(self.code)
+		cache = self.attribute_caches[pc]
+		if cache is None:
+			cache = AttributeCache()
+			self.attribute_caches[pc] = cache
+		return cache
+
+	def instruction_count(self):
+		"""The number of instructions in this block."""
+		if self.is_finalized():
+			return len(self.code)
+		return len(self.opcodes)
 
 	def pretty_print(self): # pragma: no cover
 		"""Format this object into a human-readable (python) string."""
-		return u"block {}".format(list(zip(self.opcodes, self.arguments)))
+		if self.is_finalized():
+			instructions = [(unpack_opcode(instruction), unpack_argument(instruction))
+					for instruction in self.code]
+		else:
+			instructions = list(zip(self.opcodes, self.arguments))
+		return u"block {}".format(instructions)
 
 class Program:
 	"""Defines the full program, with blocks and initialization."""
@@ -153,16 +533,20 @@ class Program:
 		Jump instructions always go to the start of a block.
 		"""
 		self.blocks = []
+		"""The constants and names used by all blocks."""
+		self.pool = ConstantPool()
 		"""By default, a single block numbered start_block has been initialized.
 		
 		This block is the one the main loop starts off executing, so it's useful
 		for writing program initialization code and other static stuff.
 		"""
 		self.start_block = self.new_block()
+		"""The global variables, shared by all code in the program."""
+		self.globals = make_globals()
 
 	def new_block(self):
 		"""Make a new block and give its id."""
-		self.blocks.append(Block())
+		self.blocks.append(Block(self.pool))
 		return len(self.blocks) - 1
 
 	def add_constant(self, block_id, value):
@@ -186,10 +570,56 @@ class Program:
 		"""Add a name to the given block."""
 		return self.blocks[block_id].add_name(name)
 
+	def add_match_table(self, block_id, table):
+		"""Add a jump table to the given block."""
+		return self.blocks[block_id].add_match_table(table)
+
+	def finalize(self):
+		"""Pack the code of all blocks so the program can be executed.
+		
+		Blocks that were finalized before are left alone,
+		so it's fine to add new blocks and finalize again.
+		"""
+		for block in self.blocks:
+			block.finalize()
+
 	def get_block(self, block_id):
 		"""Get the block object from its id."""
 		return self.blocks[block_id]
 
+	def stack_depth(self, block_id, entry_depth=0):
+		"""Find the most values on the stack when running from this block.
+		
+		Follows the blocks execution continues at after a call,
+		and the blocks that jump instructions go to.
+		The stack starts off with entry_depth values.
+		"""
+		# the height of the stack at the start of each block we reach
+		entry_depths = {block_id: entry_depth}
+		todo = [block_id]
+		max_depth = entry_depth
+		while len(todo) > 0:
+			current_id = todo.pop()
+			block = self.blocks[current_id]
+			depth = entry_depths[current_id]
+			successors = []
+			for index in range(block.instruction_count()):
+				opcode, argument = block.get_instruction(index)
+				depth += stack_effect(opcode, argument)
+				max_depth = max(max_depth, depth)
+				if opcode in [Instruction.JUMP, Instruction.JUMP_IF]:
+					successors.append((block.labels[argument], depth))
+				elif opcode == Instruction.JUMP_TABLE:
+					for label in block.match_tables[argument].labels:
+						successors.append((block.labels[label], depth))
+			if block.ends_with_call():
+				successors.append((block.next_block_id, depth))
+			for successor, successor_depth in successors:
+				if 0 <= successor < len(self.blocks) and successor not in entry_depths:
+					entry_depths[successor] = successor_depth
+					todo.append(successor)
+		return max_depth
+
 	def set_next_block_id(self, block_id, next_block_id):
 		"""Set the block id to jump to after this block finishes execution."""
 		self.blocks[block_id].next_block_id = next_block_id
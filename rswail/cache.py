@@ -0,0 +1,359 @@
+import os
+
+from rpython.rlib import rmmap
+from rpython.rlib.rarithmetic import LONG_BIT, intmask, r_uint
+from rpython.rlib.rmd5 import RMD5
+
+from rswail.ast import expression, match_case, statement
+from rswail.bytecode import INVALID_BLOCK, Block, MatchTable, Program
+from rswail.cons_list import List, cons_list, from_list
+from rswail.function import CodeFunction
+from rswail.struct import StructInstance, make_instance
+from rswail.value import Boolean, Integer, Label, String, Unit
+
+"""Store compiled programs on disk, so we don't have to parse them again.
+
+A cache file starts with MAGIC, followed by the MD5 digest of the source
+code it was compiled from. If the source has a different digest, the cache
+is stale and we ignore it. After that comes the program itself: the
+names and constants of its pool, the start block, then each block's
+next block id, code, labels and match tables.
+
+Integers are encoded as variable-length zigzag integers (7 bits per byte,
+lowest bits first) and strings are prefixed by their length in bytes.
+"""
+
+"""Identifies cache files and the version of their format.
+
+Change the last byte whenever the format or the meaning of the bytecode
+changes, so old cache files are ignored instead of misinterpreted.
+"""
+MAGIC = "SWC\x0c"
+
+"""The structs which can be stored in a cache file, by name.
+
+Instances of other structs can't be cached since we can't find their
+members again when loading.
+"""
+cacheable_structs = {}
+for struct in [cons_list, expression, match_case, statement]:
+	cacheable_structs[struct.name] = struct
+
+class CacheError(Exception):
+	"""Raised when a program can't be stored or loaded from a cache file."""
+	pass
+
+def source_digest(source):
+	"""Calculate the digest that identifies the source of a cache file."""
+	return RMD5(source).digest()
+
+def cache_path(source_path):
+	"""Determine where to cache the compiled version of a source file."""
+	if source_path.endswith(".swa"):
+		end = len(source_path) - len(".swa")
+		assert end >= 0
+		return source_path[:end] + ".swc"
+	return source_path + ".swc"
+
+class CacheWriter:
+	"""Encodes values to the format of a cache file."""
+	def __init__(self):
+		self.parts = []
+
+	def write_byte(self, byte):
+		assert 0 <= byte < 256
+		self.parts.append(chr(byte))
+
+	def write_int(self, value):
+		# zigzag encoding makes small negative numbers small as well
+		unsigned = (r_uint(value) << 1) ^ r_uint(value >> (LONG_BIT - 1))
+		while unsigned >= 0x80:
+			self.write_byte(intmask(unsigned & 0x7f) | 0x80)
+			unsigned = unsigned >> 7
+		self.write_byte(intmask(unsigned))
+
+	def write_bytes(self, bytes):
+		self.write_int(len(bytes))
+		self.parts.append(bytes)
+
+	def write_unicode(self, string):
+		assert isinstance(string, unicode)
+		self.write_bytes(string.encode("utf-8"))
+
+	def write_value(self, value):
+		"""Write a constant, prefixed by a byte indicating its type."""
+		if isinstance(value, Unit):
+			self.write_byte(ord("u"))
+		elif isinstance(value, Boolean):
+			self.write_byte(ord("b"))
+			self.write_byte(1 if value.value else 0)
+		elif isinstance(value, Integer):
+			if value.is_small():
+				self.write_byte(ord("i"))
+				self.write_int(value.intval)
+			else:
+				self.write_byte(ord("I"))
+				self.write_bytes(value.str())
+		elif isinstance(value, String):
+			self.write_byte(ord("s"))
+			self.write_unicode(value.value)
+		elif isinstance(value, Label):
+			self.write_byte(ord("l"))
+			self.write_int(value.get_value())
+		elif isinstance(value, CodeFunction):
+			if len(value.captured) > 0:
+				raise CacheError("can't cache functions with captured values")
+			self.write_byte(ord("f"))
+			self.write_unicode(value.get_name())
+			self.write_int(value.block_id)
+			self.write_int(value.slot_count)
+			self.write_int(value.stack_depth)
+			self.write_int(value.self_index)
+			self.write_int(value.arg_count)
+		elif isinstance(value, StructInstance):
+			struct = value.member.parent
+			if struct.name not in cacheable_structs:
+				raise CacheError("can't cache instances of this struct")
+			self.write_byte(ord("S"))
+			self.write_unicode(struct.name)
+			self.write_unicode(value.member.name)
+			if isinstance(value, List):
+				# store the elements instead of nesting the tails
+				self.write_int(-1 - value.length)
+				for index in range(value.length):
+					self.write_value(value.get_item(index))
+			else:
+				self.write_int(value.field_count())
+				for index in range(value.field_count()):
+					self.write_value(value.get_field(index))
+		else:
+			raise CacheError("can't cache this kind of value")
+
+	def write_program(self, program):
+		assert isinstance(program, Program)
+		self.write_int(len(program.pool.names))
+		for name in program.pool.names:
+			self.write_unicode(name)
+		self.write_int(len(program.pool.constants))
+		for constant in program.pool.constants:
+			self.write_value(constant)
+		self.write_int(program.start_block)
+		self.write_int(len(program.blocks))
+		for block in program.blocks:
+			assert block.is_finalized()
+			self.write_int(block.next_block_id)
+			self.write_int(len(block.code))
+			for instruction in block.code:
+				self.write_int(instruction)
+			self.write_int(len(block.labels))
+			for label in block.labels:
+				self.write_int(label)
+			self.write_int(len(block.match_tables))
+			for table in block.match_tables:
+				self.write_byte(1 if table.has_default else 0)
+				self.write_int(len(table.labels))
+				for index in range(len(table.labels)):
+					self.write_unicode(table.struct_names[index])
+					self.write_unicode(table.member_names[index])
+					self.write_int(table.field_counts[index])
+					self.write_int(table.labels[index])
+
+	def getvalue(self):
+		return "".join(self.parts)
+
+class CacheReader:
+	"""Decodes values from a memory-mapped cache file."""
+	def __init__(self, data):
+		self.data = data
+		self.size = data.file_size()
+		self.position = 0
+
+	def read_byte(self):
+		if self.position >= self.size:
+			raise CacheError("unexpected end of cache file")
+		byte = ord(self.data.getitem(self.position))
+		self.position += 1
+		return byte
+
+	def read_int(self):
+		unsigned = r_uint(0)
+		shift = 0
+		while True:
+			if shift >= LONG_BIT:
+				raise CacheError("integer too large in cache file")
+			byte = self.read_byte()
+			unsigned |= r_uint(byte & 0x7f) << shift
+			shift += 7
+			if byte < 0x80:
+				break
+		return intmask(unsigned >> 1) ^ -intmask(unsigned & 1)
+
+	def read_raw(self, length):
+		if length < 0 or self.position + length > self.size:
+			raise CacheError("unexpected end of cache file")
+		bytes = self.data.getslice(self.position, length)
+		self.position += length
+		return bytes
+
+	def read_bytes(self):
+		return self.read_raw(self.read_int())
+
+	def read_unicode(self):
+		return self.read_bytes().decode("utf-8")
+
+	def read_value(self):
+		tag = chr(self.read_byte())
+		if tag == "u":
+			return Unit()
+		elif tag == "b":
+			return Boolean(self.read_byte() != 0)
+		elif tag == "i":
+			return Integer.from_int(self.read_int())
+		elif tag == "I":
+			return Integer.from_decimal(self.read_bytes())
+		elif tag == "s":
+			return String(self.read_unicode())
+		elif tag == "l":
+			return Label(self.read_int())
+		elif tag == "f":
+			name = self.read_unicode()
+			block_id = self.read_int()
+			slot_count = self.read_int()
+			stack_depth = self.read_int()
+			self_index = self.read_int()
+			arg_count = self.read_int()
+			return CodeFunction(name, block_id, slot_count, stack_depth,
+					self_index=self_index, arg_count=arg_count)
+		elif tag == "S":
+			struct_name = self.read_unicode()
+			member_name = self.read_unicode()
+			if struct_name not in cacheable_structs:
+				raise CacheError("unknown struct in cache file")
+			struct = cacheable_structs[struct_name]
+			if member_name not in struct.members:
+				raise CacheError("unknown struct member in cache file")
+			field_count = self.read_int()
+			if field_count < 0:
+				# a List, with its elements instead of fields
+				return from_list([self.read_value() for i in range(-1 - field_count)])
+			values = [self.read_value() for i in range(field_count)]
+			return make_instance(struct.members[member_name], values)
+		else:
+			raise CacheError("unknown value type in cache file")
+
+	def read_match_table(self):
+		has_default = self.read_byte() != 0
+		struct_names = []
+		member_names = []
+		field_counts = []
+		labels = []
+		for i in range(self.read_int()):
+			struct_names.append(self.read_unicode())
+			member_names.append(self.read_unicode())
+			field_counts.append(self.read_int())
+			labels.append(self.read_int())
+		return MatchTable(struct_names, member_names, field_counts, labels, has_default)
+
+	def read_program(self):
+		program = Program()
+		pool = program.pool
+		for i in range(self.read_int()):
+			if pool.add_name(self.read_unicode()) != i:
+				raise CacheError("duplicate name in cache file")
+		for i in range(self.read_int()):
+			if pool.add_constant(self.read_value()) != i:
+				raise CacheError("duplicate constant in cache file")
+		program.start_block = self.read_int()
+		block_count = self.read_int()
+		program.blocks = [Block(pool) for i in range(block_count)]
+		for block in program.blocks:
+			block.next_block_id = self.read_int()
+			block.set_code([self.read_int() for i in range(self.read_int())])
+			block.labels = [self.read_int() for i in range(self.read_int())]
+			block.match_tables = [self.read_match_table() for i in range(self.read_int())]
+		if not 0 <= program.start_block < block_count:
+			raise CacheError("invalid start block in cache file")
+		# a corrupted file shouldn't make us jump to blocks that don't exist
+		for block in program.blocks:
+			if block.next_block_id != INVALID_BLOCK and not 0 <= block.next_block_id < block_count:
+				raise CacheError("invalid next block in cache file")
+			for label in block.labels:
+				if not 0 <= label < block_count:
+					raise CacheError("invalid label in cache file")
+			for table in block.match_tables:
+				for label in table.labels:
+					if not 0 <= label < len(block.labels):
+						raise CacheError("invalid match label in cache file")
+		for constant in pool.constants:
+			if isinstance(constant, Label):
+				if not 0 <= constant.value < block_count:
+					raise CacheError("invalid label constant in cache file")
+			elif isinstance(constant, CodeFunction):
+				if not 0 <= constant.block_id < block_count:
+					raise CacheError("invalid function block in cache file")
+		return program
+
+def dump_program(program, source):
+	"""Encode the program, compiled from the given source, as a cache file."""
+	writer = CacheWriter()
+	writer.parts.append(MAGIC)
+	writer.parts.append(source_digest(source))
+	writer.write_program(program)
+	return writer.getvalue()
+
+def write_cache(path, program, source):
+	"""Store the program in a cache file.
+	
+	Returns whether writing succeeded, e.g. it fails in a read-only directory
+	or when the program contains values that can't be cached.
+	"""
+	try:
+		contents = dump_program(program, source)
+	except CacheError:
+		return False
+	# write to a temporary file first, so we never leave half a cache file
+	temp_path = path + ".tmp"
+	try:
+		fp = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+		try:
+			written = 0
+			while written < len(contents):
+				written += os.write(fp, contents[written:])
+		finally:
+			os.close(fp)
+		os.rename(temp_path, path)
+	except OSError:
+		return False
+	return True
+
+def read_cache(path, source):
+	"""Load the program from a cache file if it's fresh.
+	
+	Returns None if there is no cache file, or it is stale or invalid.
+	"""
+	try:
+		fp = os.open(path, os.O_RDONLY, 0777)
+	except OSError:
+		return None
+	try:
+		# empty files can't be mapped, and can't be valid cache files anyway
+		if os.fstat(fp).st_size == 0:
+			os.close(fp)
+			return None
+		data = rmmap.mmap(fp, 0, access=rmmap.ACCESS_READ)
+	except (OSError, rmmap.RMMapError):
+		os.close(fp)
+		return None
+	try:
+		reader = CacheReader(data)
+		if reader.read_raw(len(MAGIC)) != MAGIC:
+			return None
+		digest = source_digest(source)
+		if reader.read_raw(len(digest)) != digest:
+			return None
+		return reader.read_program()
+	except CacheError:
+		return None
+	finally:
+		data.close()
+		os.close(fp)
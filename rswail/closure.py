@@ -6,9 +6,22 @@ class Closure:
 	A closure can cause many stack frames,
 	e.g. when a function is called many times.
 	"""
-	def __init__(self):
-		"""Make a new closure."""
+	def __init__(self, is_global=False, parent=None, function_name=None):
+		"""Make a new closure.
 		
+		If is_global is set, this is the outermost closure of a program,
+		and the variables bound in it become global variables.
+		The parent is the closure the code of this closure is nested in,
+		and function_name is the name of the function we're compiling,
+		if any.
+		"""
+		
+		"""Whether the variables bound in this closure are global variables."""
+		self.is_global = is_global
+		"""The closure this one is nested in, or None."""
+		self.parent = parent
+		"""The name of the function this closure belongs to, or None."""
+		self.function_name = function_name
 		"""The variables bound in this closure.
 		
 		We need to track these variables so we can load them from the
@@ -25,15 +38,89 @@ class Closure:
 		Note that bound_variables and used_variables can have any kind of overlap.
 		"""
 		self.used_variables = {}
+		"""The slot index in the stack frame of each bound variable.
+		
+		Each bound variable gets its own slot, numbered from 0 in the order
+		they are bound, so the frame can store them in a fixed-size array.
+		"""
+		self.slots = {}
+		"""The free variables captured from the enclosing closures.
+		
+		A function stores their values in a fixed-size array when it is made,
+		in this order, so its code can load them by index.
+		Filled in by capture_free_variables.
+		"""
+		self.captured = []
+		"""The index in self.captured of each captured variable."""
+		self.captured_indexes = {}
+		"""Each LOAD_FREE instruction, as (block id, index in the block, name).
+		
+		We only know the index of a captured variable once the whole function
+		is compiled, after which these instructions get it as argument.
+		"""
+		self.free_loads = []
 	def make_bound(self, name):
-		"""Remember that a declaration introduces a new name."""
+		"""Remember that a declaration introduces a new name.
+		
+		Returns the slot index of the variable in the stack frame,
+		or -1 if it's a global variable.
+		"""
 		assert isinstance(name, unicode)
 		self.bound_variables[name] = None
+		if self.is_global:
+			return -1
+		if name not in self.slots:
+			self.slots[name] = len(self.slots)
+		return self.slots[name]
 	def make_used(self, name):
 		"""Remember that an expression wants to load a variable.
 		"""
 		assert isinstance(name, unicode)
 		self.used_variables[name] = None
+	def get_slot(self, name):
+		"""Get the slot index of a bound variable.
+		
+		Returns -1 if the variable isn't bound in this closure,
+		or if it's a global variable.
+		"""
+		assert isinstance(name, unicode)
+		return self.slots.get(name, -1)
+	def can_capture(self, name):
+		"""Can the variable be captured from the enclosing closures?
+		
+		That is the case if an enclosing closure (that isn't global) binds it.
+		A function can also capture itself, to call itself recursively.
+		"""
+		assert isinstance(name, unicode)
+		if self.parent is None or self.parent.is_global:
+			return False
+		if name == self.function_name or self.parent.get_slot(name) >= 0:
+			return True
+		return self.parent.can_capture(name)
+	def add_free_load(self, block_id, index, name):
+		"""Remember that the instruction loads a captured variable."""
+		self.free_loads.append((block_id, index, name))
+	def capture_free_variables(self):
+		"""Fill in captured once all code of the closure is compiled.
+		
+		These are the free variables (see get_free_variables) that can be
+		captured, in the order the code first loads them.
+		"""
+		free_variables = self.get_free_variables()
+		for block_id, index, name in self.free_loads:
+			if name in free_variables and name not in self.captured_indexes:
+				self.captured_indexes[name] = len(self.captured)
+				self.captured.append(name)
+	def get_captured_index(self, name):
+		"""Get the index of a captured variable, or -1 if it isn't captured.
+		
+		Only valid after capture_free_variables.
+		"""
+		assert isinstance(name, unicode)
+		return self.captured_indexes.get(name, -1)
+	def slot_count(self):
+		"""The number of slots a stack frame for this closure needs."""
+		return len(self.slots)
 	def get_free_variables(self):
 		"""Calculate which variables need to be closed over in the outer frame.
 		
@@ -44,4 +131,3 @@ class Closure:
 			if key not in self.bound_variables:
 				result[key] = None
 		return result
-
@@ -1,79 +1,187 @@
-from rswail.struct import Struct, construct
+from rpython.rlib.objectmodel import compute_identity_hash
 
-"""Implement a list of elements as an algebraic data structure.
+from rswail.struct import Struct, StructInstance, StructMember, combine_hashes
 
-This has a lot worse performance than array lists so we probably want to make
-some form of optimization that allows us to use any kind of list.
+"""Implement a list of elements as an algebraic data structure.
 
-Currently, we use cons-lists during parsing since it's easier to program.
+For Swail code, a list is an instance of the cons-list struct: it is either
+empty, or a cons of a head element and a tail list.
+Natively, we store the elements in an array, see the List class.
 """
-cons_list = Struct(u"cons-list", {
+class ConsListMember(StructMember):
+	"""A member of cons_list, which makes its instances as List."""
+	def make_instance(self, values):
+		if len(values) == 2 and isinstance(values[1], List):
+			return cons(values[0], values[1])
+		return StructMember.make_instance(self, values)
+
+class ConsListStruct(Struct):
+	"""The cons-list struct, whose members are ConsListMembers."""
+	def make_member(self, name, fields, tag):
+		return ConsListMember(self, name, fields, tag)
+
+cons_list = ConsListStruct(u"cons-list", {
 	u"empty": [],
 	u"cons": [u"head", u"tail"],
 })
 
+"""The members of cons_list, so we don't have to look them up each time."""
+empty_member = cons_list.members[u"empty"]
+cons_member = cons_list.members[u"cons"]
+
+class List(StructInstance):
+	"""A cons-list which stores its elements in an array.
+	
+	The elements are stored in reverse order, so the head is the last
+	element of the array. That way, the tail of a list is the same array
+	with a shorter length, and cons can usually add the new head in place.
+	
+	Multiple lists share the array, so it must only grow:
+	a list owns the array when its length is the length of the array.
+	"""
+	def __init__(self, items, length):
+		"""Make a list of the first length items, stored in reverse order."""
+		assert 0 <= length <= len(items)
+		if length == 0:
+			member = empty_member
+		else:
+			member = cons_member
+		StructInstance.__init__(self, member)
+		self.items = items
+		self.length = length
+
+	def is_empty(self):
+		return self.length == 0
+
+	def head(self):
+		"""Get the first element of a nonempty list."""
+		assert self.length > 0
+		return self.items[self.length - 1]
+
+	def tail(self):
+		"""Get the list of elements after the first, of a nonempty list."""
+		assert self.length > 0
+		if self.length == 1:
+			return _empty
+		return List(self.items, self.length - 1)
+
+	def get_item(self, i):
+		"""Get the element at an index, where 0 <= i < self.length."""
+		assert 0 <= i < self.length
+		return self.items[self.length - i - 1]
+
+	def to_list(self):
+		"""Copy the elements into a new Python list, from head to end."""
+		return [self.get_item(i) for i in range(self.length)]
+
+	def field_count(self):
+		if self.length == 0:
+			return 0
+		return 2
+
+	def get_field(self, index):
+		if index == 0:
+			return self.head()
+		assert index == 1
+		return self.tail()
+
+	def eq(self, other):
+		"""Is this list equivalent to another?
+		
+		Equivalent lists have the same length and equivalent elements.
+		"""
+		if self is other:
+			return True
+		if not isinstance(other, List):
+			return StructInstance.eq(self, other)
+		if self.length != other.length:
+			return False
+		if self.hash_value != 0 and other.hash_value != 0 and self.hash_value != other.hash_value:
+			return False
+		for i in range(self.length):
+			if not self.get_item(i).eq(other.get_item(i)):
+				return False
+		return True
+
+	def compute_hash(self):
+		"""Hash the list like the nested cons instances it represents.
+		
+		Goes through the elements in a loop instead of recursing into the tail.
+		"""
+		hash = compute_identity_hash(empty_member)
+		for i in range(self.length):
+			# go through the elements from the last one
+			head_hash = combine_hashes(compute_identity_hash(cons_member), self.items[i].hash())
+			hash = combine_hashes(head_hash, hash)
+		return hash
+
+	def __repr__(self):
+		return "List(%r)" % (self.to_list(),)
+
+"""The empty list, shared since all empty lists are the same."""
+_empty = List([], 0)
+empty_member.instance = _empty
+
 def empty():
-	"""Make a new empty list."""
-	return construct(cons_list, u"empty")
+	"""Get the empty list."""
+	return _empty
 
 def cons(head, tail):
 	"""Add an element to the beginning of the list.
 	
 	To add an element to the end, use append.
 	"""
-	assert tail.member.parent is cons_list
-	return construct(cons_list, u"cons", head, tail)
+	assert isinstance(tail, List)
+	if tail.length == 0:
+		# don't add to the array of the shared empty list
+		return List([head], 1)
+	items = tail.items
+	if tail.length != len(items):
+		# someone else has already added to the array, so copy our part
+		items = items[:tail.length]
+	items.append(head)
+	return List(items, tail.length + 1)
 
 def singleton(element):
 	"""Make a list with one element."""
-	return cons(element, empty())
+	return List([element], 1)
 
 def append(list, element):
 	"""Add an element to the end of the list.
 	
 	To add an element to the beginning, use cons.
 	"""
-	if list.member is cons_list.members[u"empty"]:
-		return cons(element, empty())
-	else:
-		assert list.member is cons_list.members[u"cons"]
-		head, tail = list.values
-		return cons(head, append(tail, element))
+	assert isinstance(list, List)
+	items = [element]
+	items.extend(list.items[:list.length])
+	return List(items, len(items))
 
 def extend(list1, list2):
 	"""Make a list from the elements of list1 succeeded by the elements of list2."""
-	if list1.member is cons_list.members[u"empty"]:
+	assert isinstance(list1, List)
+	assert isinstance(list2, List)
+	if list1.is_empty():
 		return list2
-	else:
-		assert list1.member is cons_list.members[u"cons"]
-		head, tail = list1.values
-		return cons(head, extend(tail, list2))
+	items = list2.items[:list2.length]
+	items.extend(list1.items[:list1.length])
+	return List(items, len(items))
 
 def from_list(list):
 	"""Convert a Python list to a cons-list."""
-	result = empty()
-	for neg_index in range(0, len(list)):
-		index = len(list) - neg_index - 1
-		result = cons(list[index], result)
-	return result
+	if len(list) == 0:
+		return _empty
+	items = [list[len(list) - i - 1] for i in range(len(list))]
+	return List(items, len(items))
 
 def to_list(list):
 	"""Convert a cons-list to a Python list."""
-	result = []
-	while list.member is not cons_list.members[u"empty"]:
-		assert list.member is cons_list.members[u"cons"]
-		head, list = list.values
-		result.append(head)
-	return result
+	assert isinstance(list, List)
+	return list.to_list()
 
 def length(list):
 	"""Count the number of elements in the list."""
-	if list.member is cons_list.members[u"empty"]:
-		return 0
-	else:
-		assert list.member is cons_list.members[u"cons"]
-		head, tail = list.values
-		return 1 + length(tail)
+	assert isinstance(list, List)
+	return list.length
 
 def index(list, i):
 	"""Get the element at a specified index.
@@ -85,14 +193,9 @@ def index(list, i):
 	list must be a cons-list instance,
 	i must be an int.
 	"""
+	assert isinstance(list, List)
 	if i < 0:
 		raise IndexError("negative index in cons-list")
-	if list.member is cons_list.members[u"empty"]:
+	if i >= list.length:
 		raise IndexError("too large index in cons-list")
-	assert list.member is cons_list.members[u"cons"]
-	head, tail = list.values
-	if i == 0:
-		return head
-	else:
-		return index(tail, i - 1)
-
+	return list.get_item(i)
@@ -1,18 +1,32 @@
-from rpython.rlib.jit import JitDriver, hint
-from rpython.rlib.rbigint import rbigint
+from rpython.rlib.jit import JitDriver, hint, promote, we_are_jitted
 
-from rswail.bytecode import Instruction
-from rswail.function import Function
-from rswail.globals import make_globals
-from rswail.value import Integer, Label
+from rswail.bytecode import INVALID_BLOCK, Instruction, unpack_argument, unpack_attr, unpack_load, unpack_opcode
+from rswail.function import ArgumentCountError, CodeFunction, Function, NativeFunction
+from rswail.struct import Struct, StructInstance, StructMember
+from rswail.value import Boolean, Integer, Label
 
+def get_location(pc, block_id, scope): # pragma: no cover
+	"""Describe the position in the code for the JIT's debug output."""
+	return "block %d, pc %d" % (block_id, pc)
+
+"""Drives the JIT compilation of the main loop.
+
+Each function call runs in its own invocation of execute_frame,
+so every function gets its own portal and the JIT can inline a call
+or call the machine code compiled for the function directly.
+"""
 jitdriver = JitDriver(greens=['pc', 'block_id', 'scope'],
-		reds=['stack', 'frame', 'local_vars', 'program'],
+		reds=['frame'],
 		virtualizables=['frame'],
+		get_printable_location=get_location,
 		is_recursive=True,
 		)
 
 
+class MatchError(Exception):
+	"""Raised when no case of a match statement matches the value."""
+	pass
+
 def jitpolicy(driver): # pragma: no cover
 	from rpython.jit.codewriter.policy import JitPolicy
 	return JitPolicy()
@@ -24,55 +38,89 @@ class Frame:
 	which represents a set of variables during compilation.
 	A closure can cause many stack frames,
 	e.g. when a function is called many times.
+	
+	Each frame executes in its own call to execute_frame,
+	and no other frame holds a reference to it,
+	so the JIT can allocate it as a virtual.
+	
+	Each frame has its own value stack: a list of fixed size, as computed by
+	Program.stack_depth, and the stack pointer sp, the number of values on it.
 	"""
 
 	_virtualizable_ = [
 			'program',
 			'block_id',
-			'local_vars',
+			'slots[*]',
+			'stack[*]',
+			'sp',
+			'captured',
 			'scope',
 			'pc',
 			'ended',
-			'previous_frame',
 	]
 
 	_immutable_fields_ = [
 			'program',
+			'slots',
+			'stack',
+			'return_block',
 	]
 
-	def __init__(self, program, block_id, previous_frame=None):
+	def __init__(self, program, block_id, slot_count=0, return_block=INVALID_BLOCK, stack_depth=0, captured=None):
 		"""Create a new stack frame.
 		
 		program is the program we're executing,
 		block_id is the block that execution starts at,
-		previous_frame is a reference to the frame to return to (if not None).
+		slot_count is the number of local variable slots the code uses,
+		return_block is the block the caller continues at after we return,
+		stack_depth is the most values the code has on the stack at once,
+		captured is the list of values captured by the running function.
 		"""
 		self = hint(self, access_directly=True, fresh_virtualizable=True)
 		self.program = program
 		self.block_id = block_id
-		self.local_vars = make_globals() # TODO: untangle locals and globals
+		self.local_vars = None
+		self.slots = [None] * slot_count
+		self.stack = [None] * stack_depth
+		self.sp = 0
+		self.return_block = return_block
+		if captured is None:
+			captured = []
+		self.captured = captured
 
 		self.switch_scope()
-		self.previous_frame = previous_frame
 
 	def switch_scope(self):
 		"""Initialize the scope we just switched to."""
 		self.scope = self.program.get_block(self.block_id)
 		self.pc = 0
-		self.ended = len(self.scope.opcodes) <= self.pc
+		self.ended = len(self.scope.code) <= self.pc
 
 	def get_opcode(self):
-		"""Get the opcode of the instruction that will be executed."""
-		return self.scope.opcodes[self.pc]
+		"""Get the opcode of the instruction that will be executed.
+		
+		The interpreter runs the quickened code, the JIT the original code.
+		"""
+		if we_are_jitted():
+			return unpack_opcode(self.scope.code[self.pc])
+		return unpack_opcode(self.scope.quickened[self.pc])
+	def quicken(self, opcode):
+		"""Replace the current instruction by a variant, see Block.quicken."""
+		if not we_are_jitted():
+			self.scope.quicken(self.pc, opcode)
 	def get_argument(self):
 		"""Get the argument to the instruction that will be executed."""
-		return self.scope.arguments[self.pc]
+		return unpack_argument(self.scope.code[self.pc])
 	def next_instruction(self):
 		"""Mark the instruction as executed and fetch the next one."""
 		self.pc += 1
-		if len(self.scope.opcodes) <= self.pc:
+		if len(self.scope.code) <= self.pc:
 			self.ended = True
 
+	def is_last_instruction(self):
+		"""Is the current instruction the last one of the block?"""
+		return self.pc + 1 >= len(self.scope.code)
+
 	def jump_label(self, argument):
 		"""Go to the block after looking up its label."""
 		assert argument >= 0
@@ -85,12 +133,169 @@ class Frame:
 		self.block_id = block_id
 		self.switch_scope()
 
+	def push(self, value):
+		"""Put the value on top of the stack."""
+		sp = self.sp
+		assert 0 <= sp < len(self.stack)
+		self.stack[sp] = value
+		self.sp = sp + 1
+	def pop(self):
+		"""Take the value on top of the stack off."""
+		sp = self.sp - 1
+		assert 0 <= sp < len(self.stack)
+		value = self.stack[sp]
+		self.stack[sp] = None
+		self.sp = sp
+		return value
+	def peek(self, depth):
+		"""Get the value at the given depth, where TOS has depth 1."""
+		index = self.sp - depth
+		assert 0 <= index < self.sp
+		return self.stack[index]
+	def pop_many(self, count):
+		"""Take count values off the stack, or all of them if there are fewer."""
+		new_sp = self.sp - count
+		if new_sp < 0:
+			new_sp = 0
+		while self.sp > new_sp:
+			self.pop()
+	def remove(self, depth):
+		"""Take the value at the given depth out of the stack.
+		
+		The values above it move down one place.
+		"""
+		index = self.sp - depth
+		assert 0 <= index < self.sp
+		value = self.stack[index]
+		while index < self.sp - 1:
+			self.stack[index] = self.stack[index + 1]
+			index += 1
+		self.pop()
+		return value
+	def stack_values(self):
+		"""Copy the values on the stack into a new list, from bottom to top."""
+		return [self.stack[index] for index in range(self.sp)]
+
+	def reuse_for_tail_call(self, argument):
+		"""Run the function called with argument count arguments in this frame.
+		
+		The function and its arguments are on top of the stack.
+		This only works if the function is a CodeFunction that fits in the
+		slots and stack of this frame.
+		
+		Returns whether the frame has been reused.
+		"""
+		function_pos = self.sp - argument - 1
+		assert 0 <= function_pos < self.sp
+		function = self.stack[function_pos]
+		if not isinstance(function, CodeFunction):
+			return False
+		if not function.accepts(argument):
+			return False
+		if function.slot_count > len(self.slots):
+			return False
+		if function.stack_depth == 0 or function.stack_depth > len(self.stack):
+			return False
+		# the arguments go to the bottom of the stack
+		for index in range(argument):
+			self.stack[index] = self.stack[function_pos + 1 + index]
+		self.pop_many(self.sp - argument)
+		for slot in range(len(self.slots)):
+			self.slots[slot] = None
+		self.local_vars = None
+		self.captured = function.captured
+		self.jump_id(function.block_id)
+		return True
+
 	def get_constant(self, constant_id):
 		"""Get the constant with given id from the scope."""
-		return self.scope.constants[constant_id]
+		return self.scope.pool.constant_table[constant_id]
 	def get_name(self, name_id):
 		"""Get the name with given id from the scope."""
-		return self.scope.names[name_id]
+		return self.scope.pool.name_table[name_id]
+	def load_local(self, name):
+		"""Get the value of a variable by name.
+		
+		Falls back to the global variables if it isn't a local.
+		"""
+		if self.local_vars is not None and name in self.local_vars:
+			return self.local_vars[name]
+		return self.program.globals.lookup(name)
+	def store_local(self, name, value):
+		"""Set the value of a local variable by name."""
+		if self.local_vars is None:
+			self.local_vars = {}
+		self.local_vars[name] = value
+	def load_attribute(self, value, name):
+		"""Get the attribute of the value loaded by the current instruction.
+		
+		The interpreter remembers where the attribute was found last time,
+		the JIT specializes on the value's map instead.
+		"""
+		if we_are_jitted():
+			return value.get(name)
+		cache = self.scope.get_attribute_cache(self.pc)
+		return value.get_at(name, cache.lookup(value.map, name))
+	def quicken_load_attribute(self, value, attribute):
+		"""Specialize LOAD_ATTR if it loaded a member of a struct.
+		
+		The attribute cache now holds the struct's map,
+		so LOAD_ATTR_STRUCT_MEMBER can load from its storage directly.
+		"""
+		if (not we_are_jitted() and isinstance(value, Struct)
+				and isinstance(attribute, StructMember)):
+			self.quicken(Instruction.LOAD_ATTR_STRUCT_MEMBER)
+	def load_struct_member(self, value):
+		"""Get the attribute of the struct loaded by the current instruction.
+		
+		Returns None if the value isn't a struct with the map
+		the attribute was found in last time.
+		"""
+		cache = self.scope.get_attribute_cache(self.pc)
+		if not isinstance(value, Struct) or value.map is not cache.map or cache.index < 0:
+			return None
+		return value.storage[cache.index]
+	def pop_condition(self, opcode):
+		"""Take the value on top of the stack off and get whether it is truthy.
+		
+		JUMP_IF specializes to JUMP_IF_BOOL if the value is a Boolean,
+		which reads the value directly instead of calling bool.
+		"""
+		tos = self.pop()
+		if we_are_jitted():
+			return tos.bool()
+		if isinstance(tos, Boolean):
+			if opcode != Instruction.JUMP_IF_BOOL:
+				self.quicken(Instruction.JUMP_IF_BOOL)
+			return tos.value
+		if opcode != Instruction.JUMP_IF:
+			self.quicken(Instruction.JUMP_IF)
+		return tos.bool()
+	def find_case(self, table_id, value):
+		"""Get the index of the case of the match table that matches the value.
+		
+		Returns -1 if no case matches.
+		The interpreter remembers the cases of the last struct it matched,
+		the JIT specializes on the value's member instead.
+		"""
+		if not isinstance(value, StructInstance):
+			return -1
+		table = self.scope.match_tables[table_id]
+		if we_are_jitted():
+			return promote(table).find_case(promote(value.member))
+		return table.lookup(value.member)
+	def load_captured(self, index):
+		"""Get the value of the captured variable with the given index."""
+		assert 0 <= index < len(self.captured)
+		return self.captured[index]
+	def load_slot(self, slot):
+		"""Get the value of the local variable in the given slot."""
+		assert 0 <= slot < len(self.slots)
+		return self.slots[slot]
+	def store_slot(self, slot, value):
+		"""Set the value of the local variable in the given slot."""
+		assert 0 <= slot < len(self.slots)
+		self.slots[slot] = value
 	def next_block_id(self):
 		"""Get the block id to jump to from the scope.
 		
@@ -98,15 +303,113 @@ class Frame:
 		"""
 		return self.scope.next_block_id
 
-def main_loop(program, block_id, stack):
-	frame = Frame(program, block_id)
-	del program
-	del block_id
+def main_loop(program, block_id, stack, slot_count=0):
+	"""Execute the program starting at the given block.
+	
+	The values in the list stack are put on the stack before execution starts.
+	
+	Returns the list of values on the stack after execution.
+	"""
+	program.finalize()
+	stack_depth = program.stack_depth(block_id, len(stack))
+	frame = Frame(program, block_id, slot_count=slot_count, stack_depth=stack_depth)
+	for value in stack:
+		frame.push(value)
+	execute_frame(frame)
+	return frame.stack_values()
+
+def call_function(frame, argument):
+	"""Call the function below the argument count arguments on the stack.
+	
+	The function and arguments are replaced by the return value.
+	
+	Returns the block id the caller continues at if the call is the
+	last instruction in the block.
+	"""
+	function = frame.peek(argument + 1)
+	assert isinstance(function, Function)
+	if isinstance(function, NativeFunction):
+		return call_native(frame, function, argument)
+	assert isinstance(function, CodeFunction)
+	return call_code(frame, function, argument)
+
+def call_native(frame, function, argument):
+	"""Call the native function below the arguments, like call_function.
+	
+	The arguments are read off the stack here: the JIT doesn't allow
+	the stack of the frame to be passed to other functions.
+	"""
+	if argument == 0:
+		result = function.call0()
+	elif argument == 1:
+		result = function.call1(frame.peek(1))
+	elif argument == 2:
+		result = function.call2(frame.peek(2), frame.peek(1))
+	else:
+		args = [None] * argument
+		for index in range(argument):
+			args[index] = frame.peek(argument - index)
+		result = function.call_args(args)
+	frame.pop_many(argument + 1)
+	frame.push(result)
+	return frame.next_block_id()
+
+def call_code(frame, function, argument):
+	"""Call the code function below the arguments, like call_function.
+	
+	The function runs in its own frame, through the portal.
+	"""
+	if not function.accepts(argument):
+		raise ArgumentCountError
+	function_pos = frame.sp - argument - 1
+	assert 0 <= function_pos < frame.sp
+	return_id = frame.next_block_id()
+	stack_depth = function.stack_depth
+	if stack_depth == 0:
+		# the function was made without computing this, e.g. in a test
+		stack_depth = frame.program.stack_depth(function.block_id, argument)
+	callee = Frame(frame.program, function.block_id, function.slot_count, return_id,
+			stack_depth, function.captured)
+	# pass the arguments
+	for index in range(function_pos + 1, frame.sp):
+		callee.push(frame.stack[index])
+	frame.pop_many(argument + 1)
+	execute_frame(callee)
+	frame.push(callee.pop())
+	return return_id
+
+def call_quickened(frame, opcode, argument):
+	"""Call the function below the arguments, like call_function.
+	
+	CALL specializes to CALL_NATIVE or CALL_CODE for the kind of function it
+	called, which skip asking the function how to call it.
+	If they get another kind of function, they fall back to CALL.
+	"""
+	if we_are_jitted():
+		return call_function(frame, argument)
+	function = frame.peek(argument + 1)
+	if isinstance(function, NativeFunction):
+		if opcode != Instruction.CALL_NATIVE:
+			frame.quicken(Instruction.CALL_NATIVE)
+		return call_native(frame, function, argument)
+	if isinstance(function, CodeFunction):
+		if opcode != Instruction.CALL_CODE:
+			frame.quicken(Instruction.CALL_CODE)
+		return call_code(frame, function, argument)
+	if opcode != Instruction.CALL:
+		frame.quicken(Instruction.CALL)
+	return call_function(frame, argument)
+
+def execute_frame(frame):
+	"""Execute code in the frame until it returns or runs out of code.
+	
+	This is the JIT's portal, which is entered again for each function call.
+	"""
 	while True:
 		# tell JIT that we've merged multiple execution flows
-		jitdriver.jit_merge_point(program=frame.program, scope=frame.scope,
-				local_vars=frame.local_vars, pc=frame.pc, block_id=frame.block_id,
-				stack=stack, frame=frame)
+		jitdriver.jit_merge_point(scope=frame.scope,
+				pc=frame.pc, block_id=frame.block_id,
+				frame=frame)
 
 		if frame.ended:
 			break
@@ -117,76 +420,146 @@ def main_loop(program, block_id, stack):
 		elif opcode == Instruction.HELLO:
 			print("Hello, World!")
 		elif opcode == Instruction.PUSH_INT:
-			stack.append(Integer(rbigint.fromint(argument)))
+			frame.push(Integer.from_int(argument))
 		elif opcode == Instruction.WRITE:
-			print(stack.pop())
+			print(frame.pop())
 		elif opcode == Instruction.JUMP:
 			frame.jump_label(argument)
-			jitdriver.can_enter_jit(program=frame.program, scope=frame.scope,
-				local_vars=frame.local_vars, pc=frame.pc, block_id=frame.block_id,
-				stack=stack, frame=frame)
+			jitdriver.can_enter_jit(scope=frame.scope,
+				pc=frame.pc, block_id=frame.block_id,
+				frame=frame)
 			# don't increment the program counter!
 			continue
-		elif opcode == Instruction.JUMP_IF:
-			tos = stack.pop()
-			if tos.bool():
+		elif opcode == Instruction.JUMP_IF or opcode == Instruction.JUMP_IF_BOOL:
+			if frame.pop_condition(opcode):
 				frame.jump_label(argument)
-				jitdriver.can_enter_jit(program=frame.program, scope=frame.scope,
-					local_vars=frame.local_vars, pc=frame.pc, block_id=frame.block_id,
-					stack=stack, frame=frame)
+				jitdriver.can_enter_jit(scope=frame.scope,
+					pc=frame.pc, block_id=frame.block_id,
+					frame=frame)
 				# don't increment the program counter!
 				continue
 		elif opcode == Instruction.JUMP_LABEL:
-			assert 0 < argument <= len(stack)
-			block_label = stack.pop(-argument)
+			block_label = frame.remove(argument)
 			assert isinstance(block_label, Label)
 			frame.jump_id(block_label.get_value())
-			jitdriver.can_enter_jit(program=frame.program, scope=frame.scope,
-				local_vars=frame.local_vars, pc=frame.pc, block_id=frame.block_id,
-				stack=stack, frame=frame)
+			jitdriver.can_enter_jit(scope=frame.scope,
+				pc=frame.pc, block_id=frame.block_id,
+				frame=frame)
 			# don't increment the program counter!
 			continue
 		elif opcode == Instruction.PUSH_CONST:
-			stack.append(frame.get_constant(argument))
+			frame.push(frame.get_constant(argument))
 		elif opcode == Instruction.LOAD_LOCAL:
 			name = frame.get_name(argument)
 			assert isinstance(name, unicode)
-			stack.append(frame.local_vars[name])
+			frame.push(frame.load_local(name))
 		elif opcode == Instruction.STORE_LOCAL:
 			name = frame.get_name(argument)
 			assert isinstance(name, unicode)
-			frame.local_vars[name] = stack.pop()
+			frame.store_local(name, frame.pop())
+		elif opcode == Instruction.LOAD_GLOBAL:
+			name = frame.get_name(argument)
+			assert isinstance(name, unicode)
+			frame.push(frame.program.globals.lookup(name))
+		elif opcode == Instruction.STORE_GLOBAL:
+			name = frame.get_name(argument)
+			assert isinstance(name, unicode)
+			frame.program.globals.define(name, frame.pop())
+		elif opcode == Instruction.LOAD_ATTR:
+			name = frame.get_name(argument)
+			assert isinstance(name, unicode)
+			value = frame.pop()
+			attribute = frame.load_attribute(value, name)
+			frame.quicken_load_attribute(value, attribute)
+			frame.push(attribute)
+		elif opcode == Instruction.LOAD_ATTR_STRUCT_MEMBER:
+			value = frame.pop()
+			attribute = frame.load_struct_member(value)
+			if attribute is None:
+				# not the struct we saw before: load as usual and specialize again
+				frame.quicken(Instruction.LOAD_ATTR)
+				name = frame.get_name(argument)
+				assert isinstance(name, unicode)
+				attribute = frame.load_attribute(value, name)
+				frame.quicken_load_attribute(value, attribute)
+			frame.push(attribute)
+		elif opcode == Instruction.LOAD_FAST:
+			frame.push(frame.load_slot(argument))
+		elif opcode == Instruction.STORE_FAST:
+			frame.store_slot(argument, frame.pop())
+		elif opcode == Instruction.STORE_FAST_KEEP:
+			frame.store_slot(argument, frame.peek(1))
+		elif opcode == Instruction.STORE_GLOBAL_KEEP:
+			name = frame.get_name(argument)
+			assert isinstance(name, unicode)
+			frame.program.globals.define(name, frame.peek(1))
+		elif opcode == Instruction.LOAD_FAST_ATTR:
+			name = frame.get_name(unpack_attr(argument))
+			assert isinstance(name, unicode)
+			value = frame.load_slot(unpack_load(argument))
+			frame.push(frame.load_attribute(value, name))
+		elif opcode == Instruction.LOAD_GLOBAL_ATTR:
+			global_name = frame.get_name(unpack_load(argument))
+			assert isinstance(global_name, unicode)
+			name = frame.get_name(unpack_attr(argument))
+			assert isinstance(name, unicode)
+			value = frame.program.globals.lookup(global_name)
+			frame.push(frame.load_attribute(value, name))
 		elif opcode == Instruction.POP:
-			if argument >= len(stack):
-				stack = []
-			else:
-				new_length = len(stack) - argument
-				# help rpython out with basic arithmetic
-				# so it knows the stack is nonempty
-				assert new_length > 0
-				stack = stack[:new_length]
+			frame.pop_many(argument)
 		elif opcode == Instruction.DUP:
-			assert 0 < argument <= len(stack)
-			stack.append(stack[-argument])
+			frame.push(frame.peek(argument))
 		elif opcode == Instruction.SWAP:
-			assert 0 < argument <= len(stack)
-			stack.append(stack.pop(-argument))
-		elif opcode == Instruction.CALL:
-			function_pos = len(stack) - argument - 1
-			assert 0 <= function_pos < len(stack)
-			function = stack[function_pos]
-			assert isinstance(function, Function)
-			return_id = frame.next_block_id()
-			new_frame, next_block = function.call(return_id, stack, function_pos)
-			if new_frame:
-				# TODO: the JIT doesn't like the frame being replaced
-				# so figure out some way to not replace it?
-				# TODO: this is a hacky way to get globals into scope
-				frame = Frame(frame.program, next_block, frame)
-			else:
-				frame.jump_id(next_block)
-			continue
+			frame.push(frame.remove(argument))
+		elif opcode == Instruction.JUMP_TABLE:
+			case = frame.find_case(argument, frame.peek(1))
+			if case >= 0:
+				frame.jump_label(frame.scope.match_tables[argument].labels[case])
+				jitdriver.can_enter_jit(scope=frame.scope,
+					pc=frame.pc, block_id=frame.block_id,
+					frame=frame)
+				# don't increment the program counter!
+				continue
+			if not frame.scope.match_tables[argument].has_default:
+				raise MatchError
+		elif opcode == Instruction.UNPACK:
+			instance = frame.pop()
+			assert isinstance(instance, StructInstance)
+			if instance.field_count() != argument:
+				# the stack only has room for the fields of the case
+				raise MatchError
+			for index in range(argument):
+				frame.push(instance.get_field(index))
+		elif opcode == Instruction.LOAD_FREE:
+			frame.push(frame.load_captured(argument))
+		elif opcode == Instruction.MAKE_CLOSURE:
+			captured = [None] * argument
+			for index in range(argument - 1, -1, -1):
+				captured[index] = frame.pop()
+			template = frame.pop()
+			assert isinstance(template, CodeFunction)
+			frame.push(template.make_closure(captured))
+		elif opcode == Instruction.TAIL_CALL:
+			if frame.reuse_for_tail_call(argument):
+				jitdriver.can_enter_jit(scope=frame.scope,
+					pc=frame.pc, block_id=frame.block_id,
+					frame=frame)
+				continue
+			# call in a new frame and return what it returns
+			call_function(frame, argument)
+			break
+		elif opcode == Instruction.RETURN:
+			# the caller takes the return value from the top of our stack
+			break
+		elif (opcode == Instruction.CALL or opcode == Instruction.CALL_NATIVE
+				or opcode == Instruction.CALL_CODE):
+			return_id = call_quickened(frame, opcode, argument)
+			if frame.is_last_instruction():
+				# the code after the call is in the next block
+				if return_id == INVALID_BLOCK:
+					break
+				frame.jump_id(return_id)
+				continue
 		else:
 			raise NotImplementedError
 		frame.next_instruction()
-	return stack
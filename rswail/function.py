@@ -1,56 +1,141 @@
-from rswail.value import Label, Value
+from rswail.value import Value
+
+class ArgumentCountError(Exception):
+	"""Raised when a function is called with the wrong number of arguments."""
+	pass
 
 class Function(Value):
-	"""Base class for functions."""
+	"""Base class for functions.
+	
+	The interpreter calls each kind of function in its own way,
+	see call_function in rswail.execute.
+	"""
 	def __init__(self, name):
 		Value.__init__(self, name)
+
+class NativeFunction(Function):
+	"""Built-in function written in native code.
 	
-	def call(self, return_id, stack, arg_start): # pragma: no cover
-		"""Call the function with some arguments.
-		
-		return_id is the id of the block that will handle the return value.
-		stack is the value stack at the time of calling,
-		stack[arg_start+1:] is the list of arguments to the function.
+	func gets the list of arguments and returns the return value.
+	"""
+	def __init__(self, name, func):
+		Function.__init__(self, name)
+		self.func = func
+	
+	def call_args(self, args):
+		"""Call the function on the list of arguments.
 		
-		You may write to stack[arg_start:] e.g. for return values.
-		After jumping to return_id, TOS must be stack[arg_start],
-		which is considered the return value of the function.
+		Returns the return value.
+		"""
+		return self.func(args)
+
+	def call0(self):
+		"""Call the function without arguments.
 		
-		Returns whether we need a new stack frame,
-		and the block that execution will go to.
-		This block should eventually jump to block return_id.
+		Like call1 and call2, this lets the subclasses with a fixed number of
+		arguments get them directly, without allocating a list.
+		They raise ArgumentCountError when called with any other number.
 		"""
-		raise Exception("call to abstract method Function.call")
+		return self.call_args([])
+	def call1(self, arg0):
+		"""Call the function with one argument."""
+		return self.call_args([arg0])
+	def call2(self, arg0, arg1):
+		"""Call the function with two arguments."""
+		return self.call_args([arg0, arg1])
 
-class NativeFunction(Function):
-	"""Built-in function written in native code."""
+class NativeFunction0(NativeFunction):
+	"""Built-in function without arguments.
+	
+	func gets called without arguments, so we don't need to allocate a list.
+	"""
 	def __init__(self, name, func):
 		Function.__init__(self, name)
-		self.func = func
-	
-	def call(self, return_id, stack, arg_start):
-		arguments = stack[arg_start+1:]
-		stack[arg_start] = self.func(arguments)
-		# TODO: this should be nicer!
-		for i in range(arg_start+1, len(stack)):
-			stack.pop()
-		return False, return_id
+		self.func0 = func
+
+	def call_args(self, args):
+		# any other number of arguments than we take
+		raise ArgumentCountError
+
+	def call0(self):
+		return self.func0()
+
+class NativeFunction1(NativeFunction):
+	"""Built-in function with one argument, which func gets directly."""
+	def __init__(self, name, func):
+		Function.__init__(self, name)
+		self.func1 = func
+
+	def call_args(self, args):
+		# any other number of arguments than we take
+		raise ArgumentCountError
+
+	def call1(self, arg0):
+		return self.func1(arg0)
+
+class NativeFunction2(NativeFunction):
+	"""Built-in function with two arguments, which func gets directly."""
+	def __init__(self, name, func):
+		Function.__init__(self, name)
+		self.func2 = func
+
+	def call_args(self, args):
+		# any other number of arguments than we take
+		raise ArgumentCountError
+
+	def call2(self, arg0, arg1):
+		return self.func2(arg0, arg1)
 
 class CodeFunction(Function):
 	"""A function written in bytecode.
 	
-	When the function is called, all the arguments are on the stack,
-	with the last argument as TOS.
-	Below the arguments is the label to jump to.
+	When the function is called, all the arguments are on the stack of a new
+	frame, with the last argument as TOS. The code ends with RETURN,
+	and the frame remembers the block the caller continues at.
+	
+	slot_count is the number of local variable slots the function body uses,
+	stack_depth is the most values the call has on the stack at any time,
+	including the arguments.
+	
+	captured contains the values of the free variables the function uses,
+	see make_closure. If the function captures itself, so it can call itself,
+	self_index is the index of the function in captured, otherwise -1.
+	
+	arg_count is the number of arguments the function takes,
+	or -1 if it wasn't given, e.g. in a test; then any number is accepted.
 	"""
-	def __init__(self, name, block_id):
+	# the items of captured aren't immutable: make_closure stores the function
+	# itself in the list after making it
+	_immutable_fields_ = ['block_id', 'slot_count', 'stack_depth', 'captured', 'self_index', 'arg_count']
+
+	def __init__(self, name, block_id, slot_count=0, stack_depth=0, captured=None, self_index=-1, arg_count=-1):
 		Function.__init__(self, name)
 		self.block_id = block_id
+		self.slot_count = slot_count
+		self.stack_depth = stack_depth
+		if captured is None:
+			captured = []
+		self.captured = captured
+		self.self_index = self_index
+		self.arg_count = arg_count
+
+	def accepts(self, arg_count):
+		"""Can the function be called with the given number of arguments?"""
+		return self.arg_count < 0 or self.arg_count == arg_count
+
+	def make_closure(self, captured):
+		"""Make a function running the same code with the captured values.
+		
+		The list captured must not change after this,
+		except that we fill in the function itself at self_index.
+		"""
+		function = CodeFunction(self.get_name(), self.block_id, self.slot_count,
+				self.stack_depth, captured, self.self_index, self.arg_count)
+		if self.self_index >= 0:
+			captured[self.self_index] = function
+		return function
 
-	def call(self, return_id, stack, arg_start):
-		assert isinstance(return_id, int)
-		assert isinstance(stack, list)
-		assert isinstance(arg_start, int)
-		assert 0 <= arg_start < len(stack)
-		stack[arg_start] = Label(return_id)
-		return True, self.block_id
+	def with_block_id(self, block_id):
+		"""Make a copy of this function that starts at another block."""
+		return CodeFunction(self.get_name(), block_id, self.slot_count,
+				self.stack_depth, self.captured, self.self_index, self.arg_count)
@@ -1,18 +1,113 @@
-from rswail.function import CodeFunction, NativeFunction
+from rpython.rlib.jit import elidable, promote
 
-def hello(args):
-	assert len(args) == 0
+from rswail.function import CodeFunction, NativeFunction, NativeFunction0, NativeFunction2
+from rswail.value import Integer
+
+def hello():
 	print(u"Hello, World!")
 
+def add(left, right):
+	"""Add two integers."""
+	assert isinstance(left, Integer)
+	assert isinstance(right, Integer)
+	return left.add(right)
+
+def sub(left, right):
+	"""Subtract the second integer from the first."""
+	assert isinstance(left, Integer)
+	assert isinstance(right, Integer)
+	return left.sub(right)
+
+def mul(left, right):
+	"""Multiply two integers."""
+	assert isinstance(left, Integer)
+	assert isinstance(right, Integer)
+	return left.mul(right)
+
 def def_(args):
 	"""Create a new function."""
 	# FIXME!
 
+class VersionTag:
+	"""Marks a version of the set of global names.
+	
+	Whenever a global name is added, the Globals get a fresh tag,
+	so the JIT knows the results of earlier lookups have become invalid.
+	"""
+	pass
+
+class GlobalCell:
+	"""Stores the value of a single global variable.
+	
+	Globals should be assigned much less often than they are read,
+	so we make the value quasi-immutable: the JIT can treat it as a constant
+	and invalidates the generated code if it does get assigned.
+	"""
+	_immutable_fields_ = ['value?']
+
+	def __init__(self, value):
+		self.value = value
+
+class Globals:
+	"""The global variables of a program.
+	
+	There is one of these for each Program, shared between all stack frames.
+	"""
+	_immutable_fields_ = ['version?']
+
+	def __init__(self):
+		"""Make a new, empty set of global variables."""
+		
+		"""The cell storing each global's value, keyed by its name."""
+		self.cells = {}
+		"""The current version of self.cells."""
+		self.version = VersionTag()
+
+	def get_cell(self, name):
+		"""Get the cell storing the global with the given name.
+		
+		Returns None if there is no such global.
+		"""
+		assert isinstance(name, unicode)
+		self = promote(self)
+		version = promote(self.version)
+		return self._lookup_cell(name, version)
+
+	@elidable
+	def _lookup_cell(self, name, version):
+		"""Look up the cell, which gives the same result for the same version."""
+		return self.cells.get(name, None)
+
+	def contains(self, name):
+		"""Is there a global with the given name?"""
+		return self.get_cell(name) is not None
+
+	def lookup(self, name):
+		"""Get the value of the global with the given name.
+		
+		Raises a KeyError if there is no such global.
+		"""
+		cell = self.get_cell(name)
+		if cell is None:
+			raise KeyError(name)
+		return cell.value
+
+	def define(self, name, value):
+		"""Set the value of the global with the given name."""
+		cell = self.get_cell(name)
+		if cell is None:
+			self.cells[name] = GlobalCell(value)
+			self.version = VersionTag()
+		else:
+			cell.value = value
+
 def make_globals():
-	"""Make a list of global variables used in a block."""
-	global_map = {
-			u"hello": NativeFunction(u"hello", hello),
-			u"def": NativeFunction(u"def", def_),
-			u"rpython_is_weird": CodeFunction(u"rpython_is_weird", -1),
-	}
+	"""Make the global variables for a new program."""
+	global_map = Globals()
+	global_map.define(u"hello", NativeFunction0(u"hello", hello))
+	global_map.define(u"def", NativeFunction(u"def", def_))
+	global_map.define(u"add", NativeFunction2(u"add", add))
+	global_map.define(u"sub", NativeFunction2(u"sub", sub))
+	global_map.define(u"mul", NativeFunction2(u"mul", mul))
+	global_map.define(u"rpython_is_weird", CodeFunction(u"rpython_is_weird", -1))
 	return global_map
@@ -0,0 +1,66 @@
+from rpython.rlib.jit import elidable
+
+class Map:
+	"""The layout of the attributes of a value.
+
+	A map knows the index in the value's storage of each attribute.
+	Values that got the same attributes in the same order share a map,
+	so checking a value's map is enough to know where an attribute lives.
+	Maps never change after they're made: adding an attribute to a value
+	moves it to another map.
+	"""
+	def __init__(self):
+		"""Make a new map without any attributes."""
+
+		"""The index of each attribute, keyed by its name."""
+		self.indexes = {}
+		"""The maps we get by adding an attribute to this one, by name."""
+		self.transitions = {}
+
+	def attribute_count(self):
+		"""The number of attributes stored by values with this map."""
+		return len(self.indexes)
+
+	@elidable
+	def find_index(self, name):
+		"""Get the index of the attribute with the given name.
+
+		Returns -1 if values with this map don't have the attribute.
+		"""
+		return self.indexes.get(name, -1)
+
+	@elidable
+	def with_attribute(self, name):
+		"""Get the map we get by adding an attribute to this one."""
+		if name not in self.transitions:
+			new_map = Map()
+			new_map.indexes.update(self.indexes)
+			new_map.indexes[name] = len(self.indexes)
+			self.transitions[name] = new_map
+		return self.transitions[name]
+
+"""The map of all values without any attributes."""
+EMPTY_MAP = Map()
+
+class AttributeCache:
+	"""Remembers where a LOAD_ATTR instruction found its attribute last time.
+
+	Most attribute loads see values with the same map each time,
+	so we can skip looking up the name in the map.
+	The JIT doesn't need this, since it specializes the code on the map.
+	"""
+	def __init__(self):
+		self.map = None
+		self.index = -1
+
+	def lookup(self, map, name):
+		"""Get the index of the attribute in values with the given map.
+
+		Returns -1 if values with this map don't have the attribute.
+		"""
+		if map is self.map:
+			return self.index
+		index = map.find_index(name)
+		self.map = map
+		self.index = index
+		return index
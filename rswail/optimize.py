@@ -0,0 +1,338 @@
+from rswail.bytecode import INVALID_BLOCK, Instruction, MAX_ATTR_ARGUMENT, MAX_LOAD_ARGUMENT, pack_load_attr, unpack_attr, unpack_load
+from rswail.function import CodeFunction
+
+"""Optimizations on the bytecode of a program, before it is finalized.
+
+The compiler emits simple code for each statement and expression,
+which leaves some instructions that do nothing useful when put together.
+The optimizer removes them and combines common sequences into a single
+instruction, so the interpreter needs fewer dispatches.
+"""
+
+"""Instructions that only push a value, without any other effect.
+
+If that value is popped right away, we can leave out both.
+"""
+pure_pushes = [
+		Instruction.PUSH_INT,
+		Instruction.PUSH_CONST,
+		Instruction.LOAD_FAST,
+		Instruction.LOAD_FREE,
+		Instruction.DUP,
+]
+
+"""The instruction that stores without popping, for each storing instruction."""
+keeping_stores = {
+		Instruction.STORE_FAST: Instruction.STORE_FAST_KEEP,
+		Instruction.STORE_GLOBAL: Instruction.STORE_GLOBAL_KEEP,
+}
+"""The instruction that stores and pops, for each keeping instruction."""
+popping_stores = {
+		Instruction.STORE_FAST_KEEP: Instruction.STORE_FAST,
+		Instruction.STORE_GLOBAL_KEEP: Instruction.STORE_GLOBAL,
+}
+
+"""The superinstruction that also loads an attribute, for each load."""
+attribute_loads = {
+		Instruction.LOAD_FAST: Instruction.LOAD_FAST_ATTR,
+		Instruction.LOAD_GLOBAL: Instruction.LOAD_GLOBAL_ATTR,
+}
+
+"""Instructions whose argument is the id of a name."""
+name_instructions = [
+		Instruction.LOAD_LOCAL,
+		Instruction.STORE_LOCAL,
+		Instruction.LOAD_ATTR,
+		Instruction.LOAD_GLOBAL,
+		Instruction.STORE_GLOBAL,
+		Instruction.STORE_GLOBAL_KEEP,
+]
+"""Instructions whose argument is the id of a label."""
+label_instructions = [
+		Instruction.JUMP,
+		Instruction.JUMP_IF,
+]
+
+class PeepholeOptimizer:
+	"""Rewrites the code of a block one instruction at a time.
+
+	Each instruction is appended to the optimized code,
+	after which we look for patterns at the end of the code to simplify.
+	"""
+	def __init__(self):
+		self.opcodes = []
+		self.arguments = []
+
+	def emit(self, opcode, argument):
+		"""Append the instruction and simplify the code before it."""
+		self.opcodes.append(opcode)
+		self.arguments.append(argument)
+		while self.simplify():
+			pass
+
+	def drop_last(self):
+		"""Remove the last instruction."""
+		self.opcodes.pop()
+		self.arguments.pop()
+
+	def simplify(self):
+		"""Apply a single simplification to the end of the code.
+
+		Returns whether anything was simplified.
+		"""
+		if len(self.opcodes) < 2:
+			return False
+		last = self.opcodes[-1]
+		last_arg = self.arguments[-1]
+		previous = self.opcodes[-2]
+		previous_arg = self.arguments[-2]
+		if last == Instruction.POP:
+			if previous == Instruction.POP:
+				# combine two pops
+				self.drop_last()
+				self.arguments[-1] = previous_arg + last_arg
+				return True
+			if previous in pure_pushes or previous in popping_stores:
+				if previous in pure_pushes:
+					# don't push a value we immediately pop
+					self.drop_last()
+					self.drop_last()
+				else:
+					# store and pop instead of keeping the value
+					self.drop_last()
+					self.opcodes[-1] = popping_stores[previous]
+				if last_arg > 1:
+					self.opcodes.append(Instruction.POP)
+					self.arguments.append(last_arg - 1)
+				return True
+		elif last in keeping_stores:
+			if previous == Instruction.DUP and previous_arg == 1:
+				# store without popping instead of duplicating
+				self.drop_last()
+				self.opcodes[-1] = keeping_stores[last]
+				self.arguments[-1] = last_arg
+				return True
+		elif last == Instruction.RETURN:
+			if previous == Instruction.CALL:
+				# return the value of the call by calling in our place
+				self.drop_last()
+				self.opcodes[-1] = Instruction.TAIL_CALL
+				return True
+		elif last == Instruction.LOAD_ATTR:
+			if (previous in attribute_loads
+					and 0 <= previous_arg <= MAX_LOAD_ARGUMENT
+					and 0 <= last_arg <= MAX_ATTR_ARGUMENT):
+				# load the value and its attribute in one go
+				self.drop_last()
+				self.opcodes[-1] = attribute_loads[previous]
+				self.arguments[-1] = pack_load_attr(previous_arg, last_arg)
+				return True
+		return False
+
+class Renumbering:
+	"""Gives new ids to the items (constants, names or labels) of a block."""
+	def use(self, old_id): # pragma: no cover
+		"""Get the new id of the item with the old id."""
+		raise NotImplementedError
+
+class IdMap(Renumbering):
+	"""Renumbers the items of a block, keeping only the ones in use.
+	
+	Only the ids are renumbered, so the same class works for any kind of item:
+	the caller picks the items to keep using old_ids.
+	"""
+	def __init__(self, count):
+		"""The old id of each new id, in order of first use."""
+		self.old_ids = []
+		"""The new id of each old id, or -1 if it isn't used (yet)."""
+		self.new_ids = [-1] * count
+
+	def use(self, old_id):
+		"""Mark the item as used and give its new id."""
+		if self.new_ids[old_id] < 0:
+			self.new_ids[old_id] = len(self.old_ids)
+			self.old_ids.append(old_id)
+		return self.new_ids[old_id]
+
+class SameIds(Renumbering):
+	"""Keeps the ids of items shared by all blocks, i.e. constants and names."""
+	def use(self, old_id):
+		return old_id
+
+class Offset(Renumbering):
+	"""Renumbers the items of a block when appending them to another block."""
+	def __init__(self, offset):
+		self.offset = offset
+
+	def use(self, old_id):
+		return old_id + self.offset
+
+def renumber_argument(opcode, argument, constants, names, labels):
+	"""Give the argument of the instruction after renumbering the items."""
+	if opcode == Instruction.PUSH_CONST:
+		return constants.use(argument)
+	elif opcode in name_instructions:
+		return names.use(argument)
+	elif opcode in label_instructions:
+		return labels.use(argument)
+	elif opcode == Instruction.LOAD_FAST_ATTR:
+		return pack_load_attr(unpack_load(argument), names.use(unpack_attr(argument)))
+	elif opcode == Instruction.LOAD_GLOBAL_ATTR:
+		return pack_load_attr(names.use(unpack_load(argument)), names.use(unpack_attr(argument)))
+	return argument
+
+def compact_block(block):
+	"""Drop the labels no instruction refers to.
+	
+	The constants and names are in the pool of the program,
+	which other blocks may still refer to.
+	"""
+	labels = IdMap(len(block.labels))
+	for index in range(len(block.opcodes)):
+		block.arguments[index] = renumber_argument(block.opcodes[index],
+				block.arguments[index], SameIds(), SameIds(), labels)
+	for table in block.match_tables:
+		table.labels = [labels.use(label) for label in table.labels]
+	block.labels = [block.labels[old_id] for old_id in labels.old_ids]
+
+def append_block(block, other):
+	"""Add the code of the other block to the end of the block.
+	
+	Both blocks must share their pool.
+	"""
+	assert block.pool is other.pool
+	labels = Offset(len(block.labels))
+	tables = Offset(len(block.match_tables))
+	for index in range(len(other.opcodes)):
+		opcode = other.opcodes[index]
+		argument = other.arguments[index]
+		if opcode == Instruction.JUMP_TABLE:
+			argument = tables.use(argument)
+		else:
+			argument = renumber_argument(opcode, argument, SameIds(), SameIds(), labels)
+		block.opcodes.append(opcode)
+		block.arguments.append(argument)
+	for table in other.match_tables:
+		table.labels = [labels.use(label) for label in table.labels]
+		block.match_tables.append(table)
+	block.labels.extend(other.labels)
+	block.next_block_id = other.next_block_id
+
+def find_jump_targets(program):
+	"""Which blocks can be entered other than by returning from a call?
+
+	These are the start block, the blocks that labels refer to,
+	and the entry blocks of functions.
+	"""
+	targets = [False] * len(program.blocks)
+	targets[program.start_block] = True
+	for block in program.blocks:
+		for label in block.labels:
+			if 0 <= label < len(targets):
+				targets[label] = True
+	for constant in program.pool.constants:
+		if isinstance(constant, CodeFunction) and 0 <= constant.block_id < len(targets):
+			targets[constant.block_id] = True
+	return targets
+
+def can_merge(program, block_id, targets, predecessors):
+	"""Can the next block of this one be appended to its code?
+
+	That is the case if the block ends with a call, which is the only way to
+	enter the next block: execution just continues after the call.
+	"""
+	block = program.blocks[block_id]
+	next_id = block.next_block_id
+	if next_id < 0 or next_id == block_id or targets[next_id]:
+		return False
+	if predecessors[next_id] != 1 or program.blocks[next_id].is_finalized():
+		return False
+	return (not block.is_finalized() and len(block.opcodes) > 0
+			and block.opcodes[-1] == Instruction.CALL)
+
+def merge_blocks(program):
+	"""Append each block that is only entered after a call to its caller.
+
+	Returns a list with True for each block id that has been merged away.
+	"""
+	targets = find_jump_targets(program)
+	predecessors = [0] * len(program.blocks)
+	for block in program.blocks:
+		if 0 <= block.next_block_id < len(predecessors):
+			predecessors[block.next_block_id] += 1
+	merged = [False] * len(program.blocks)
+	for block_id in range(len(program.blocks)):
+		if merged[block_id]:
+			continue
+		while can_merge(program, block_id, targets, predecessors):
+			block = program.blocks[block_id]
+			next_id = block.next_block_id
+			append_block(block, program.blocks[next_id])
+			merged[next_id] = True
+	return merged
+
+def renumber_blocks(program, removed):
+	"""Drop the removed blocks and number the others consecutively."""
+	new_ids = [INVALID_BLOCK] * len(program.blocks)
+	blocks = []
+	for block_id in range(len(program.blocks)):
+		if not removed[block_id]:
+			new_ids[block_id] = len(blocks)
+			blocks.append(program.blocks[block_id])
+	for block in blocks:
+		block.labels = [new_ids[label] if 0 <= label < len(new_ids) else label
+				for label in block.labels]
+		if 0 <= block.next_block_id < len(new_ids):
+			block.next_block_id = new_ids[block.next_block_id]
+	pool = program.pool
+	for index in range(len(pool.constants)):
+		constant = pool.constants[index]
+		if isinstance(constant, CodeFunction) and 0 <= constant.block_id < len(new_ids):
+			pool.replace_constant(index, constant.with_block_id(new_ids[constant.block_id]))
+	program.blocks = blocks
+	program.start_block = new_ids[program.start_block]
+
+def is_return_block(block):
+	"""Does the block consist of returning the value of a function call?"""
+	return (not block.is_finalized() and len(block.opcodes) == 1
+			and block.opcodes[0] == Instruction.RETURN)
+
+def thread_returns(program):
+	"""Return directly instead of jumping to a block that only returns.
+	
+	This puts the returns of e.g. the cases of a match at the end of a function
+	right after the code of the case, where a call can become a tail call.
+	"""
+	for block in program.blocks:
+		if block.is_finalized():
+			continue
+		for index in range(len(block.opcodes)):
+			if block.opcodes[index] != Instruction.JUMP:
+				continue
+			target = block.labels[block.arguments[index]]
+			if 0 <= target < len(program.blocks) and is_return_block(program.blocks[target]):
+				block.opcodes[index] = Instruction.RETURN
+				block.arguments[index] = 0
+
+def optimize_block(block):
+	"""Simplify the code of a block that hasn't been finalized."""
+	if block.is_finalized():
+		return
+	optimizer = PeepholeOptimizer()
+	for index in range(len(block.opcodes)):
+		optimizer.emit(block.opcodes[index], block.arguments[index])
+	block.opcodes = optimizer.opcodes
+	block.arguments = optimizer.arguments
+	compact_block(block)
+
+def optimize_program(program):
+	"""Simplify the code of all blocks that haven't been finalized.
+
+	Blocks that only continue after a call are merged into their caller first,
+	and jumps to a return become the return itself,
+	so the peephole optimizer sees longer stretches of code.
+	"""
+	renumber_blocks(program, merge_blocks(program))
+	thread_returns(program)
+	for block in program.blocks:
+		optimize_block(block)
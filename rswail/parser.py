@@ -1,9 +1,12 @@
+from rpython.rlib.parsing.deterministic import LexerError
 from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
-from rpython.rlib.parsing.parsing import ParseError
+from rpython.rlib.parsing.lexer import SourcePos, Token
+from rpython.rlib.parsing.parsing import PackratParser, ParseError
+from rpython.rlib.parsing.regex import StringExpression
 from rpython.rlib.parsing.tree import RPythonVisitor, Symbol
 
-from rswail.ast import statement, expression, expr_name_access, expr_base_value, expr_apply, stmt_declaration, stmt_expression
-from rswail.cons_list import append, cons, empty, extend, singleton
+from rswail.ast import statement, expression, expr_name_access, expr_base_value, expr_apply, make_case, stmt_declaration, stmt_expression, stmt_match
+from rswail.cons_list import empty, from_list, singleton, to_list
 from rswail.value import Integer, String
 
 """Define Swail's grammar.
@@ -24,7 +27,7 @@ NAME: "[A-Za-z_][A-Za-z0-9_]*";
 
 file: [NEWLINE]* (statement [NEWLINE]+)* [EOF];
 block: INDENT (statement [NEWLINE]+)+ DEDENT;
-statement: <declaration> | <expression_stmt>;
+statement: <declaration> | <match> | <expression_stmt>;
 declaration: general_name NAME arg_list (":" NEWLINE block)?;
 expression_stmt: expression;
 
@@ -36,6 +39,13 @@ base_value: LITERAL_INT;
 
 arg_list: "(" (expression [","])* expression? ")";
 general_name: (NAME ["."])* NAME;
+
+match: ["match"] expression ([":"] [NEWLINE] block)? case+;
+case: [NEWLINE] ["case"] general_name pattern [":"] [NEWLINE] block;
+pattern: "(" (binding [","])* binding? ")";
+binding: ["`"] NAME;
+
+single_statement: statement [EOF];
 """)
 
 """Convert a lexed bytestring into parser nodes.
@@ -45,48 +55,132 @@ all the boring details.
 """
 lexed_to_nodes = make_parse_function(regexes, rules, eof=True)
 
-def swail_lexer(program_code):
-	"""To make parsing a bit easier, we first convert indentation to explicit tokens."""
-	indent_level = 0
-	char = '\n'
-	source = iter(program_code)
-	eof = False
-	result = []
-	# we break from the loop when there are no more characters in the file
-	while not eof:
-		if char == '\n':
-			line_indent = 0
-			# count the indentation on this line
-			while True:
-				try:
-					char = next(source)
-				except StopIteration:
-					eof = True
-					break
-				if char != '\t':
-					break
-				line_indent += 1
-			# and print that amount of indent/dedent tokens
-			for i in range(indent_level, line_indent):
-				result.append("<indent>\t")
-			for i in range(line_indent, indent_level):
-				# TODO: remove the \n at the end
-				# workaround for ending each statement with newlines
-				result.append("<dedent>\t\n")
-			indent_level = line_indent
+"""Parses the tokens of a single top-level statement into parser nodes.
+
+The tokens are produced by swail_tokenizer, which takes care of indentation.
+We parse each statement separately, since the parser needs to recurse once
+for each statement in a repetition.
+"""
+statement_parser = PackratParser(rules, "single_statement")
+
+"""Maps each punctuation character in the grammar to the name of its token.
+
+The parser generator chooses these names, so we look them up instead of
+hardcoding them.
+"""
+punctuation_tokens = {}
+"""Maps each keyword in the grammar to the name of its token.
+
+Keywords look like names, so they can't be used as a name.
+"""
+keyword_tokens = {}
+for token_name, token_regex in regexes:
+	if token_name.startswith("__") and isinstance(token_regex, StringExpression):
+		if len(token_regex.string) == 1:
+			punctuation_tokens[token_regex.string] = token_name
 		else:
-			try:
-				char = next(source)
-			except StopIteration:
-				break
-		result.append(char)
+			keyword_tokens[token_regex.string] = token_name
+
+def is_digit(char):
+	return "0" <= char <= "9"
+def is_name_start(char):
+	return "A" <= char <= "Z" or "a" <= char <= "z" or char == "_"
+def is_name_char(char):
+	return is_name_start(char) or is_digit(char)
+
+class SwailTokenizer:
+	"""Converts source code into tokens for the parser in a single pass.
 	
-	# clean up remaining indentation
-	result.append("\n")
-	for i in range(0, indent_level):
-		result.append("<dedent>\t\n")
+	Indentation at the start of a line is converted to explicit INDENT and
+	DEDENT tokens, so the grammar can stay context-free.
+	Each DEDENT is followed by a NEWLINE, which ends the statement
+	containing the block.
 	
-	return result
+	Use the swail_tokenizer function to run it.
+	"""
+	def __init__(self, program_code):
+		self.code = program_code
+		self.position = 0
+		self.line = 0
+		self.line_start = 0
+		self.indent_level = 0
+		self.tokens = []
+
+	def add_token(self, name, start, end):
+		"""Add a token for the source code in code[start:end]."""
+		assert 0 <= start <= end
+		source_pos = SourcePos(start, self.line, start - self.line_start)
+		self.tokens.append(Token(name, self.code[start:end], source_pos))
+
+	def add_indentation(self, line_indent):
+		"""Add the tokens to go from the current indentation to line_indent."""
+		for i in range(self.indent_level, line_indent):
+			self.add_token("INDENT", self.position, self.position)
+		for i in range(line_indent, self.indent_level):
+			self.add_token("DEDENT", self.position, self.position)
+			self.add_token("NEWLINE", self.position, self.position)
+		self.indent_level = line_indent
+
+	def start_line(self):
+		"""Process the indentation at the start of a line.
+		
+		Lines without any statement don't change the indentation.
+		"""
+		code = self.code
+		line_indent = 0
+		while self.position < len(code) and code[self.position] == "\t":
+			self.position += 1
+			line_indent += 1
+		end = self.position
+		while end < len(code) and code[end] == " ":
+			end += 1
+		if end < len(code) and code[end] != "\n" and code[end] != "#":
+			self.add_indentation(line_indent)
+
+	def tokenize(self):
+		"""Produce the list of tokens, ending with an EOF token."""
+		code = self.code
+		self.start_line()
+		while self.position < len(code):
+			start = self.position
+			char = code[start]
+			if char == " ":
+				self.position += 1
+			elif char == "#":
+				# comments last until the end of the line
+				while self.position < len(code) and code[self.position] != "\n":
+					self.position += 1
+			elif char == "\n":
+				self.position += 1
+				self.add_token("NEWLINE", start, self.position)
+				self.line += 1
+				self.line_start = self.position
+				self.start_line()
+			elif is_digit(char):
+				while self.position < len(code) and is_digit(code[self.position]):
+					self.position += 1
+				self.add_token("LITERAL_INT", start, self.position)
+			elif is_name_start(char):
+				while self.position < len(code) and is_name_char(code[self.position]):
+					self.position += 1
+				name = keyword_tokens.get(code[start:self.position], "NAME")
+				self.add_token(name, start, self.position)
+			elif char in punctuation_tokens:
+				self.position += 1
+				self.add_token(punctuation_tokens[char], start, self.position)
+			else:
+				source_pos = SourcePos(start, self.line, start - self.line_start)
+				raise LexerError(code, 0, source_pos)
+		
+		# finish the last statement and clean up remaining indentation
+		self.add_token("NEWLINE", self.position, self.position)
+		self.add_indentation(0)
+		self.add_token("EOF", self.position, self.position)
+		return self.tokens
+
+def swail_tokenizer(program_code):
+	"""Convert source code into a list of tokens for the parser."""
+	return SwailTokenizer(program_code).tokenize()
 
 class NodesToASTVisitor(RPythonVisitor):
 	"""Converts the nodes from the parser generator into a Swail AST.
@@ -98,7 +192,7 @@ class NodesToASTVisitor(RPythonVisitor):
 		pass
 
 	def general_symbol_visit(self, node):
-		return String.from_bytes(node.token.source)
+		return String.interned_utf8(node.token.source)
 
 	def general_nonterminal_visit(self, node):
 		children = [self.dispatch(child) for child in node.children]
@@ -126,37 +220,35 @@ class NodesToASTVisitor(RPythonVisitor):
 	def visit__maybe_symbol4(self, node):
 		assert len(node.children) == 1
 		return singleton(self.dispatch(node.children[0]))
+	def collect_repetition(self, node, items):
+		"""Append the elements of a repeated symbol to the Python list items.
+		
+		The parser represents a repetition as a node with the first element,
+		the separator and optionally a node of the same kind with the
+		remaining elements.
+		We go through these in a loop so long repetitions don't overflow the
+		stack, and convert to a cons-list only once.
+		"""
+		symbol = node.symbol
+		while True:
+			assert len(node.children) in [2, 3]
+			items.append(self.dispatch(node.children[0]))
+			if len(node.children) == 2:
+				return items
+			node = node.children[2]
+			assert node.symbol == symbol
 	def visit__plus_symbol2(self, node):
-		assert len(node.children) in [2, 3]
-		result = singleton(self.dispatch(node.children[0]))
-		if len(node.children) == 3:
-			assert node.children[2].symbol == "_plus_symbol2"
-			result = extend(result, self.dispatch(node.children[2]))
-		return result
+		return from_list(self.collect_repetition(node, []))
 	def visit__star_symbol1(self, node):
-		assert len(node.children) in [2, 3]
-		result = singleton(self.dispatch(node.children[0]))
-		if len(node.children) == 3:
-			assert node.children[2].symbol == "_star_symbol1"
-			result = extend(result, self.dispatch(node.children[2]))
-		return result
+		return from_list(self.collect_repetition(node, []))
 	def visit__star_symbol3(self, node):
-		assert len(node.children) in [2, 3]
-		result = singleton(self.dispatch(node.children[0]))
-		if len(node.children) == 3:
-			assert node.children[2].symbol == "_star_symbol3"
-			result = extend(result, self.dispatch(node.children[2]))
-		return result
+		return from_list(self.collect_repetition(node, []))
 	def visit__star_symbol5(self, node):
-		assert len(node.children) in [2, 3]
 		# TODO: support other encodings?
-		root_name = self.dispatch(node.children[0])
-		assert isinstance(root_name, String)
-		result = singleton(root_name)
-		if len(node.children) == 3:
-			assert node.children[2].symbol == "_star_symbol5"
-			result = extend(result, self.dispatch(node.children[2]))
-		return result
+		names = self.collect_repetition(node, [])
+		for name in names:
+			assert isinstance(name, String)
+		return from_list(names)
 
 	def visit_file(self, node):
 		assert len(node.children) in [1, 2]
@@ -199,8 +291,7 @@ class NodesToASTVisitor(RPythonVisitor):
 		assert len(node.children) == 1
 		value_symbol = node.children[0]
 		if value_symbol.symbol == "LITERAL_INT":
-			decimal = String.from_bytes(value_symbol.token.source)
-			return expr_base_value(Integer.from_string(decimal))
+			return expr_base_value(Integer.from_decimal(value_symbol.token.source))
 		else: # pragma: no cover
 			raise NotImplementedError
 
@@ -212,19 +303,66 @@ class NodesToASTVisitor(RPythonVisitor):
 			return self.dispatch(node.children[1])
 		else:
 			# at least 2 elements in the list
-			result = self.dispatch(node.children[1])
-			result = extend(result, self.dispatch(node.children[2]))
-			return result
+			assert node.children[1].symbol == "_star_symbol3"
+			args = self.collect_repetition(node.children[1], [])
+			args.extend(to_list(self.dispatch(node.children[2])))
+			return from_list(args)
 	def visit_general_name(self, node):
 		assert len(node.children) in [1, 2]
+		names = []
 		if len(node.children) == 2:
-			result = self.dispatch(node.children[0])
-		else:
-			result = empty()
+			assert node.children[0].symbol == "_star_symbol5"
+			self.collect_repetition(node.children[0], names)
 		assert node.children[-1].symbol == "NAME"
 		# TODO: support other encodings?
-		result = append(result, String.from_bytes(node.children[-1].token.source))
-		return result
+		names.append(String.interned_utf8(node.children[-1].token.source))
+		return from_list(names)
+	def visit_match(self, node):
+		assert len(node.children) in [3, 4]
+		value = self.dispatch(node.children[1])
+		if len(node.children) == 3:
+			default = empty()
+		else:
+			default = self.dispatch(node.children[2])
+		# the cases are a repetition without separators
+		cases = []
+		cases_node = node.children[-1]
+		while True:
+			assert cases_node.symbol == "_plus_symbol3"
+			assert len(cases_node.children) in [1, 2]
+			cases.append(self.dispatch(cases_node.children[0]))
+			if len(cases_node.children) == 1:
+				break
+			cases_node = cases_node.children[1]
+		return stmt_match(value, default, from_list(cases))
+	def visit__maybe_symbol6(self, node):
+		assert len(node.children) == 3
+		return self.dispatch(node.children[2])
+	def visit_case(self, node):
+		assert len(node.children) == 7
+		member = self.dispatch(node.children[2])
+		bindings = self.dispatch(node.children[3])
+		body = self.dispatch(node.children[6])
+		return make_case(member, bindings, body)
+	def visit_pattern(self, node):
+		assert len(node.children) in [2, 3]
+		bindings = []
+		if len(node.children) == 3:
+			# at least 2 bindings
+			assert node.children[1].symbol == "_star_symbol7"
+			self.collect_repetition(node.children[1], bindings)
+		rest = node.children[-1]
+		assert rest.symbol == "__pattern_rest_0_0"
+		if len(rest.children) == 2:
+			bindings.append(self.dispatch(rest.children[0]))
+		return from_list(bindings)
+	def visit_binding(self, node):
+		assert len(node.children) == 2
+		return String.interned_utf8(node.children[1].token.source)
+	def visit_single_statement(self, node):
+		assert len(node.children) == 2
+		assert node.children[1].symbol == "EOF"
+		return self.dispatch(node.children[0])
 
 def nodes_to_ast(program_nodes):
 	"""Convert the nodes we received from the generated parser into Swail AST.
@@ -237,12 +375,47 @@ def nodes_to_ast(program_nodes):
 	visitor = NodesToASTVisitor()
 	return visitor.dispatch(program_nodes)
 
+"""The tokens which continue a statement on the next line."""
+continuation_tokens = ["INDENT", keyword_tokens["case"]]
+
+def split_statements(tokens):
+	"""Split the tokens of a file into the tokens of each top-level statement.
+	
+	A top-level statement ends at a newline outside of any block,
+	unless the newline starts a block or a case of a match.
+	Each list of tokens ends with an EOF token instead of that newline,
+	and empty statements are skipped.
+	"""
+	assert tokens[-1].name == "EOF"
+	eof = tokens[-1]
+	result = []
+	indent_level = 0
+	start = 0
+	for index in range(len(tokens)):
+		token = tokens[index]
+		if token.name == "INDENT":
+			indent_level += 1
+		elif token.name == "DEDENT":
+			indent_level -= 1
+		elif indent_level == 0 and token.name in ["NEWLINE", "EOF"]:
+			if index + 1 < len(tokens) and tokens[index + 1].name in continuation_tokens:
+				# the newline before a block or a case doesn't end the statement
+				continue
+			if start < index:
+				statement_tokens = tokens[start:index]
+				statement_tokens.append(eof)
+				result.append(statement_tokens)
+			start = index + 1
+	return result
+
 def swail_parser(program_code):
 	"""Parse a string representing a single Swail file into an AST.
 	
 	This is probably the function you want to use during execution.
 	"""
-	# TODO directly produce rlib.parsing tokens
-	lexed = "".join(swail_lexer(program_code))
-	nodes = lexed_to_nodes(lexed)
-	return nodes_to_ast(nodes)
+	tokens = swail_tokenizer(program_code)
+	statements = []
+	for statement_tokens in split_statements(tokens):
+		nodes = statement_parser.parse(statement_tokens)
+		statements.append(nodes_to_ast(nodes))
+	return from_list(statements)
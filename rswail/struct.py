@@ -1,39 +1,112 @@
+from rpython.rlib.objectmodel import compute_identity_hash
+from rpython.rlib.rarithmetic import intmask
+
 from rswail.value import Value
 
+def combine_hashes(hash, field_hash):
+	"""Mix the hash of a field into the hash of the fields before it."""
+	return intmask((hash * 1000003) ^ field_hash)
+
 class Struct(Value):
 	def __init__(self, name, member_dict):
 		# initialize members first so we can't overwrite it
 		self.members = {}
+		"""The members, indexed by their tag."""
+		self.member_list = []
 		Value.__init__(self, name)
 		for key, value in member_dict.items():
-			member = StructMember(self, key, value)
+			member = self.make_member(key, value, len(self.member_list))
 			self.members[key] = member
-	def get(self, key):
-		assert isinstance(key, unicode)
-		if key in self.members:
-			return self.members[key]
-		return Value.get(self, key)
+			self.member_list.append(member)
+			# also store them as attributes, so loading them is fast
+			Value.set(self, key, member)
 	def set(self, key, value):
 		assert isinstance(key, unicode)
 		if key in self.members:
 			assert isinstance(value, StructMember)
 			self.members[key] = value
-		else:
-			Value.set(self, key, value)
+		Value.set(self, key, value)
+	def make_member(self, name, fields, tag):
+		"""Make the member with the given name, fields and tag.
+		
+		Override this to use a subclass of StructMember.
+		"""
+		return StructMember(self, name, fields, tag)
 
 class StructMember(Value):
-	def __init__(self, parent, name, fields):
+	"""A way to construct instances of a struct, with a fixed list of fields.
+	
+	The members of a struct are numbered by their tag,
+	so code can tell members apart by indexing instead of comparing.
+	"""
+	_immutable_fields_ = ['parent', 'tag', 'fields[*]', 'field_indexes']
+
+	def __init__(self, parent, name, fields, tag):
 		Value.__init__(self, name)
 		self.parent = parent
+		self.tag = tag
 		self.fields = fields
+		"""The index of each field in the instances, keyed by its name."""
+		self.field_indexes = {}
+		for index in range(len(fields)):
+			self.field_indexes[fields[index]] = index
+		"""The one instance of this member, if it has no fields."""
+		self.instance = None
+	def field_index(self, name):
+		"""Get the index of the field with the given name, or -1 if none."""
+		return self.field_indexes.get(name, -1)
+	def nullary_instance(self):
+		"""Get the shared instance of this member without any fields.
+		
+		Instances are immutable, so all instances without fields are the same.
+		"""
+		if self.instance is None:
+			self.instance = StructInstance0(self)
+		return self.instance
+	def make_instance(self, values):
+		"""Make an instance of this member with the fields in the list values."""
+		if len(values) == 0:
+			return self.nullary_instance()
+		elif len(values) == 1:
+			return StructInstance1(self, values[0])
+		elif len(values) == 2:
+			return StructInstance2(self, values[0], values[1])
+		elif len(values) == 3:
+			return StructInstance3(self, values[0], values[1], values[2])
+		elif len(values) == 4:
+			return StructInstance4(self, values[0], values[1], values[2], values[3])
+		return StructInstanceN(self, values)
 
 class StructInstance(Value):
-	def __init__(self, name, member, values):
+	"""An instance of a struct member, with a value for each field.
+	
+	This is an abstract class: the subclasses store a fixed number of fields
+	and override field_count and get_field. The fields never change after
+	construction, so the JIT can read them as constants on known instances.
+	Its name is the name of the member.
+	"""
+	_immutable_fields_ = ['member']
+
+	def __init__(self, member):
 		assert isinstance(member, StructMember)
-		assert isinstance(values, list)
-		Value.__init__(self, name)
+		Value.__init__(self, None)
 		self.member = member
-		self.values = values
+		"""The hash of the instance, or 0 if it hasn't been computed yet."""
+		self.hash_value = 0
+	def get_name(self):
+		return self.member.get_name()
+	def field_count(self): # pragma: no cover
+		"""The number of fields this instance has values for."""
+		raise NotImplementedError
+	def get_field(self, index): # pragma: no cover
+		"""Get the value of the field with the given index."""
+		raise NotImplementedError
+	def get_named_field(self, name):
+		"""Get the value of the field with the given name."""
+		index = self.member.field_index(name)
+		if index < 0:
+			raise KeyError(name)
+		return self.get_field(index)
 	def eq(self, other):
 		"""Is this instance equivalent to another?
 		
@@ -45,16 +118,142 @@ class StructInstance(Value):
 			return False
 		if self.member is not other.member:
 			return False
-		if len(self.values) != len(other.values):
+		if self.field_count() != other.field_count():
+			return False
+		if self.hash_value != 0 and other.hash_value != 0 and self.hash_value != other.hash_value:
+			# we already know the fields differ somewhere
 			return False
-		for self_val, other_val in zip(self.values, other.values):
+		for index in range(self.field_count()):
+			self_val = self.get_field(index)
+			other_val = other.get_field(index)
 			assert isinstance(self_val, Value)
 			assert isinstance(other_val, Value)
 			if not self_val.eq(other_val):
 				return False
 		return True
+	def hash(self):
+		"""Hash the member and the fields.
+		
+		Instances are immutable, so we only compute the hash once.
+		"""
+		if self.hash_value == 0:
+			self.hash_value = self.compute_hash()
+			if self.hash_value == 0:
+				self.hash_value = 1
+		return self.hash_value
+	def compute_hash(self):
+		"""Hash the member and the fields without using the cached hash."""
+		hash = compute_identity_hash(self.member)
+		for index in range(self.field_count()):
+			hash = combine_hashes(hash, self.get_field(index).hash())
+		return hash
 	def __repr__(self):
-		return repr(self.member) + repr(self.values)
+		fields = [self.get_field(index) for index in range(self.field_count())]
+		return repr(self.member) + repr(fields)
+
+class StructInstance0(StructInstance):
+	"""An instance without fields."""
+	def field_count(self):
+		return 0
+	def get_field(self, index):
+		raise IndexError(index)
+
+class StructInstance1(StructInstance):
+	"""An instance with one field."""
+	_immutable_fields_ = ['field0']
+
+	def __init__(self, member, field0):
+		StructInstance.__init__(self, member)
+		self.field0 = field0
+	def field_count(self):
+		return 1
+	def get_field(self, index):
+		if index == 0:
+			return self.field0
+		raise IndexError(index)
+
+class StructInstance2(StructInstance):
+	"""An instance with two fields."""
+	_immutable_fields_ = ['field0', 'field1']
+
+	def __init__(self, member, field0, field1):
+		StructInstance.__init__(self, member)
+		self.field0 = field0
+		self.field1 = field1
+	def field_count(self):
+		return 2
+	def get_field(self, index):
+		if index == 0:
+			return self.field0
+		elif index == 1:
+			return self.field1
+		raise IndexError(index)
+
+class StructInstance3(StructInstance):
+	"""An instance with three fields."""
+	_immutable_fields_ = ['field0', 'field1', 'field2']
+
+	def __init__(self, member, field0, field1, field2):
+		StructInstance.__init__(self, member)
+		self.field0 = field0
+		self.field1 = field1
+		self.field2 = field2
+	def field_count(self):
+		return 3
+	def get_field(self, index):
+		if index == 0:
+			return self.field0
+		elif index == 1:
+			return self.field1
+		elif index == 2:
+			return self.field2
+		raise IndexError(index)
+
+class StructInstance4(StructInstance):
+	"""An instance with four fields."""
+	_immutable_fields_ = ['field0', 'field1', 'field2', 'field3']
+
+	def __init__(self, member, field0, field1, field2, field3):
+		StructInstance.__init__(self, member)
+		self.field0 = field0
+		self.field1 = field1
+		self.field2 = field2
+		self.field3 = field3
+	def field_count(self):
+		return 4
+	def get_field(self, index):
+		if index == 0:
+			return self.field0
+		elif index == 1:
+			return self.field1
+		elif index == 2:
+			return self.field2
+		elif index == 3:
+			return self.field3
+		raise IndexError(index)
+
+class StructInstanceN(StructInstance):
+	"""An instance with any number of fields, stored in a fixed-size list."""
+	_immutable_fields_ = ['values[*]']
+
+	def __init__(self, member, values):
+		assert isinstance(values, list)
+		StructInstance.__init__(self, member)
+		# copy the values, so the caller may keep using its list
+		self.values = [None] * len(values)
+		for index in range(len(values)):
+			self.values[index] = values[index]
+	def field_count(self):
+		return len(self.values)
+	def get_field(self, index):
+		return self.values[index]
+
+def make_instance(member, values):
+	"""Make an instance of the member with the fields in the list values."""
+	assert isinstance(member, StructMember)
+	for value in values:
+		assert isinstance(value, Value)
+	return member.make_instance(values)
 
 def construct(struct, member_name, *args):
 	"""Make a new StructInstance.
@@ -64,7 +263,5 @@ def construct(struct, member_name, *args):
 	"""
 	assert isinstance(struct, Struct)
 	assert isinstance(member_name, unicode)
-	arg_list = list(args)
-	for value in arg_list:
-		assert isinstance(value, Value)
-	return StructInstance(member_name, struct.members[member_name], arg_list)
+	member = struct.members[member_name]
+	return member.make_instance(list(args))
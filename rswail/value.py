@@ -1,6 +1,10 @@
-from rpython.rlib.objectmodel import not_rpython
+from rpython.rlib.jit import promote
+from rpython.rlib.objectmodel import compute_hash, compute_identity_hash, not_rpython, r_dict
+from rpython.rlib.rarithmetic import ovfcheck
 from rpython.rlib.rbigint import rbigint
 
+from rswail.map import EMPTY_MAP
+
 """When set to True, built-in Python operators on Values will raise.
 
 We enable this during pytest runs to make sure operators don't accidentally
@@ -8,27 +12,59 @@ get overloaded in Python and fail in RPython.
 """
 _strict_operators = False
 
+"""The attribute storage of values that have never been assigned any.
+
+Shared between all those values, so we only allocate a list on the first set.
+Never modify it directly!
+"""
+_no_attributes = []
+
 class Value:
 	"""Swail's base type.
 	
-	Since Swail is kind of object-oriented, we have a dict with the object's
-	attributes.
+	Since Swail is kind of object-oriented, values have attributes.
+	Their values are stored in a list, and the value's map says which
+	attribute is at which index (see rswail.map).
 	Since Swail is kind of declarative, we also remember the object's name as
 	given in the declaration.
+	Subclasses can leave the name None if they compute it in get_name,
+	so the name is only built when somebody asks for it.
 	"""
 	def __init__(self, name):
-		assert isinstance(name, unicode)
-		self.dict = {}
+		assert name is None or isinstance(name, unicode)
+		self.map = EMPTY_MAP
+		self.storage = _no_attributes
 		self.name = name
+	def get_name(self):
+		"""Get the name of the value, as given in the declaration."""
+		assert self.name is not None
+		return self.name
 	def get(self, key):
 		assert isinstance(key, unicode)
-		if key == u"name" and key not in self.dict:
-			return String(self.name)
-		return self.dict[key]
+		map = promote(self.map)
+		return self.get_at(key, map.find_index(key))
+	def get_at(self, key, index):
+		"""Get the attribute key, which the map says is at the given index.
+		
+		The index is -1 if the attribute isn't in the map.
+		"""
+		if index >= 0:
+			return self.storage[index]
+		if key == u"name":
+			return String(self.get_name())
+		raise KeyError(key)
 	def set(self, key, value):
 		assert isinstance(key, unicode)
 		assert isinstance(value, Value)
-		self.dict[key] = value
+		index = self.map.find_index(key)
+		if index >= 0:
+			self.storage[index] = value
+		elif self.storage is _no_attributes:
+			self.map = self.map.with_attribute(key)
+			self.storage = [value]
+		else:
+			self.map = self.map.with_attribute(key)
+			self.storage.append(value)
 	def bool(self):
 		"""bool operator.
 		
@@ -46,6 +82,15 @@ class Value:
 		As with all operators, returns a native value.
 		"""
 		return self is other
+	def hash(self):
+		"""Hash the value, consistently with eq.
+		
+		Values that are equivalent to each other have the same hash.
+		By default, hashes the reference, like eq compares references.
+		
+		As with all operators, returns a native value.
+		"""
+		return compute_identity_hash(self)
 
 	@not_rpython
 	def __eq__(self, other):
@@ -73,7 +118,10 @@ class Value:
 class Unit(Value):
 	"""The unit value, of which there is exactly one."""
 	def __init__(self):
-		Value.__init__(self, u'()')
+		Value.__init__(self, None)
+
+	def get_name(self):
+		return u'()'
 
 	def bool(self):
 		return False
@@ -81,14 +129,22 @@ class Unit(Value):
 	def eq(self, other):
 		return isinstance(other, Unit)
 
+	def hash(self):
+		return 0x2a
+
 class Boolean(Value):
 	"""A boolean value, either True or False."""
 	def __init__(self, value):
 		assert isinstance(value, bool)
 
-		Value.__init__(self, unicode(str(value)))
+		Value.__init__(self, None)
 		self.value = value
 
+	def get_name(self):
+		if self.value:
+			return u"True"
+		return u"False"
+
 	def bool(self):
 		return self.value
 	
@@ -105,33 +161,78 @@ class Boolean(Value):
 		else:
 			return False
 
+	def hash(self):
+		if self.value:
+			return 1
+		return 0
+
 class Integer(Value):
-	"""A (long) integer."""
-	def __init__(self, value):
-		"""Create a new integer from a bigint value."""
-		assert isinstance(value, rbigint)
+	"""A (long) integer.
+	
+	Integers that fit in a machine word are stored as an int in intval,
+	and bigval is None. Only larger integers are stored as an rbigint,
+	so arithmetic on small integers doesn't need to allocate bigints.
+	The name is only converted to a decimal string when it's asked for.
+	"""
+	_immutable_fields_ = ['intval', 'bigval']
 
-		Value.__init__(self, unicode(value.str()))
-		self.value = value
+	def __init__(self, value, intval=0):
+		"""Create a new integer from a bigint value.
+		
+		If value is None, the integer is the machine int intval instead.
+		"""
+		Value.__init__(self, None)
+		if value is not None:
+			assert isinstance(value, rbigint)
+			try:
+				intval = value.toint()
+				value = None
+			except OverflowError:
+				pass
+		self.intval = intval
+		self.bigval = value
 
 	@staticmethod
 	def from_int(value):
-		return Integer(rbigint.fromint(value))
+		return Integer(None, value)
 
 	@staticmethod
 	def from_decimal(value):
+		"""Parse the decimal digits in the byte string value."""
+		assert isinstance(value, str)
 		return Integer(rbigint.fromdecimalstr(value))
 	@staticmethod
 	def from_string(value):
 		assert isinstance(value, String)
-		return Integer(rbigint.fromdecimalstr(value.value))
+		return Integer.from_decimal(value.value.encode("utf-8"))
+
+	def is_small(self):
+		"""Does the integer fit in a machine word?"""
+		return self.bigval is None
+
+	def to_bigint(self):
+		"""Get the value as an rbigint, allocating one if needed."""
+		if self.bigval is None:
+			return rbigint.fromint(self.intval)
+		return self.bigval
+
+	def str(self):
+		"""Get the decimal representation of the integer."""
+		if self.bigval is None:
+			return str(self.intval)
+		return self.bigval.str()
+
+	def get_name(self):
+		return unicode(self.str())
 
 	def bool(self):
 		"""Convert integer to boolean.
 		
 		Nonzero values are True, zero values are False.
 		"""
-		return not self.value.int_eq(0)
+		if self.bigval is None:
+			return self.intval != 0
+		return not self.bigval.int_eq(0)
 
 	def eq(self, other):
 		"""Is this integer equivalent to another?
@@ -139,28 +240,86 @@ class Integer(Value):
 		As a convenience, also supports equivalence to int and bigint.
 		"""
 		if isinstance(other, Integer):
-			return self.value.eq(other.value)
+			if self.bigval is None and other.bigval is None:
+				return self.intval == other.intval
+			return self.to_bigint().eq(other.to_bigint())
 		elif isinstance(other, int):
-			return self.value.int_eq(other)
+			if self.bigval is None:
+				return self.intval == other
+			return self.bigval.int_eq(other)
 		elif isinstance(other, rbigint):
-			return self.value.eq(other)
+			return self.to_bigint().eq(other)
 		else:
 			return False
 
+	def hash(self):
+		# equal integers are both small or both big, since we normalize them
+		if self.bigval is None:
+			return self.intval
+		return self.bigval.hash()
+
+	def add(self, other):
+		"""+ operator, staying in machine ints unless the result overflows."""
+		assert isinstance(other, Integer)
+		if self.bigval is None and other.bigval is None:
+			try:
+				result = ovfcheck(self.intval + other.intval)
+			except OverflowError:
+				pass
+			else:
+				return Integer.from_int(result)
+		return Integer(self.to_bigint().add(other.to_bigint()))
+
+	def sub(self, other):
+		"""- operator, staying in machine ints unless the result overflows."""
+		assert isinstance(other, Integer)
+		if self.bigval is None and other.bigval is None:
+			try:
+				result = ovfcheck(self.intval - other.intval)
+			except OverflowError:
+				pass
+			else:
+				return Integer.from_int(result)
+		return Integer(self.to_bigint().sub(other.to_bigint()))
+
+	def mul(self, other):
+		"""* operator, staying in machine ints unless the result overflows."""
+		assert isinstance(other, Integer)
+		if self.bigval is None and other.bigval is None:
+			try:
+				result = ovfcheck(self.intval * other.intval)
+			except OverflowError:
+				pass
+			else:
+				return Integer.from_int(result)
+		return Integer(self.to_bigint().mul(other.to_bigint()))
+
 	def __unicode__(self): # pragma: no cover
-		return u"<Integer({}) at {}>".format(self.value, id(self))
+		return u"<Integer({}) at {}>".format(self.str(), id(self))
+
+"""The interned Strings, keyed by their value."""
+_interned_strings = {}
+"""The interned Strings, keyed by their value encoded as UTF-8."""
+_interned_utf8 = {}
 
 class String(Value):
 	"""A sequence of Unicode codepoints.
 	
 	Not to be confused with Python 2's sequence of bytes!
+	
+	Strings that occur often, like identifiers in the source code, can be
+	interned so they're only allocated once and compare by identity.
+	Nothing should set attributes on interned Strings, since they're shared.
 	"""
 	def __init__(self, value):
 		"""Initialize from a Unicode string."""
 		assert isinstance(value, unicode)
 		
-		Value.__init__(self, u'"' + value + u'"')
+		Value.__init__(self, None)
 		self.value = value
+
+	def get_name(self):
+		return u'"' + self.value + u'"'
 	
 	@staticmethod
 	def from_bytes(bytes, encoding="utf-8"):
@@ -170,6 +329,28 @@ class String(Value):
 		"""
 		return String(bytes.decode(encoding))
 	
+	@staticmethod
+	def interned(value):
+		"""Get the one String with the given unicode value."""
+		assert isinstance(value, unicode)
+		string = _interned_strings.get(value, None)
+		if string is None:
+			string = String(value)
+			_interned_strings[value] = string
+		return string
+	
+	@staticmethod
+	def interned_utf8(bytes):
+		"""Get the one String with the given value, encoded as UTF-8.
+		
+		Doesn't decode the bytes again if the String was already interned.
+		"""
+		string = _interned_utf8.get(bytes, None)
+		if string is None:
+			string = String.interned(bytes.decode("utf-8"))
+			_interned_utf8[bytes] = string
+		return string
+	
 	def bool(self):
 		return self.value != u''
 	
@@ -178,6 +359,8 @@ class String(Value):
 		
 		As a convenience, also supports equivalence to unicode.
 		"""
+		if self is other:
+			return True
 		if isinstance(other, String):
 			return self.value == other.value
 		elif isinstance(other, unicode):
@@ -185,6 +368,9 @@ class String(Value):
 		else:
 			return False
 	
+	def hash(self):
+		return compute_hash(self.value)
+	
 	def __unicode__(self): # pragma: no cover
 		return self.value
 
@@ -195,9 +381,12 @@ class Label(Value):
 	"""
 	def __init__(self, value):
 		assert isinstance(value, int)
-		Value.__init__(self, u":" + unicode(str(value)))
+		Value.__init__(self, None)
 		self.value = value
 
+	def get_name(self):
+		return u":" + unicode(str(self.value))
+
 	def get_value(self):
 		"""Get the id stored in the label.
 		
@@ -206,3 +395,21 @@ class Label(Value):
 		but it can detect this method exists.)
 		"""
 		return self.value
+
+	def eq(self, other):
+		return isinstance(other, Label) and self.value == other.value
+
+	def hash(self):
+		return self.value
+
+def values_equal(value1, value2):
+	"""Are the values equivalent? Used as the key comparison of value dicts."""
+	return value1.eq(value2)
+
+def value_hash(value):
+	"""Hash the value. Used as the key hash of value dicts."""
+	return value.hash()
+
+def make_value_dict():
+	"""Make a dict that uses equivalence of Values to compare its keys."""
+	return r_dict(values_equal, value_hash)
@@ -19,28 +19,40 @@
 
 import os
 import sys
+import time
 
 # TODO: we should be able to do this better
 # e.g. without manipulating the python path
 sys.path.append("pypy")
 
-from rswail.ast import Closure, compile_statement
+from rpython.rlib import rstackovf
+
+from rswail.ast import Closure, compile_statements
 from rswail.bytecode import Program
+from rswail.cache import cache_path, read_cache, write_cache
 from rswail.cons_list import to_list
 from rswail.execute import main_loop
 from rswail.globals import make_globals
+from rswail.optimize import optimize_program
 from rswail.parser import swail_parser
 
 def parse(program_contents):
 	# parse the program
 	parsed = swail_parser(program_contents)
+	return compile_program(parsed)
 
-	# compile the program
+def compile_program(parsed):
+	"""Compile the list of statements the parser returned.
+	
+	Returns the program and the closure of its global variables.
+	"""
 	program = Program()
 	block_id = program.start_block
-	globals = Closure()
-	for statement in to_list(parsed):
-		block_id = compile_statement(program, block_id, statement, globals)
+	globals = Closure(is_global=True)
+	# only the value of the last statement remains on the stack
+	block_id = compile_statements(program, block_id, to_list(parsed), globals)
+	optimize_program(program)
+	program.finalize()
 	return program, globals
 
 def start_execution(program, stack=None, global_closure=None):
@@ -56,10 +68,21 @@ def start_execution(program, stack=None, global_closure=None):
 	"""
 	if stack is None:
 		stack = []
+	slot_count = 0
+	if global_closure is not None:
+		slot_count = global_closure.slot_count()
 	# TODO: distinguish between these things
-	return main_loop(program, program.start_block, stack)
+	return main_loop(program, program.start_block, stack, slot_count)
 
-def run(fp):
+def run(fp, cache_path=None, timings=False):
+	"""Run the program in the file opened as fp.
+	
+	If cache_path isn't None, we try to load the compiled program from there,
+	and store it there after compiling.
+	
+	If timings is True, the time spent in each phase is written to stderr,
+	one line per phase of the form "timing <phase> <seconds>".
+	"""
 	program_contents = ""
 	while True:
 		read = os.read(fp, 4096)
@@ -67,17 +90,58 @@ def run(fp):
 			break
 		program_contents += read
 	os.close(fp)
-	program, globals = parse(program_contents)
-	start_execution(program, stack=None, global_closure=globals)
+	program = None
+	if cache_path is not None:
+		start = time.time()
+		program = read_cache(cache_path, program_contents)
+		if timings and program is not None:
+			write_timing("load", time.time() - start)
+	if program is None:
+		start = time.time()
+		parsed = swail_parser(program_contents)
+		if timings:
+			write_timing("parse", time.time() - start)
+		start = time.time()
+		program, globals = compile_program(parsed)
+		if timings:
+			write_timing("compile", time.time() - start)
+		if cache_path is not None:
+			write_cache(cache_path, program, program_contents)
+	# the global closure doesn't use any slots, so we don't need it here
+	start = time.time()
+	start_execution(program, stack=None, global_closure=None)
+	if timings:
+		write_timing("execute", time.time() - start)
+
+def write_timing(phase, seconds):
+	"""Report the time spent in a phase, in a format bench/run.py reads."""
+	os.write(2, "timing %s %s\n" % (phase, str(seconds)))
 
 def entry_point(argv):
-	try:
-		filename = argv[1]
-	except IndexError:
+	timings = False
+	use_cache = True
+	filename = None
+	for arg in argv[1:]:
+		if arg == "--timings":
+			timings = True
+		elif arg == "--no-cache":
+			use_cache = False
+		elif filename is None:
+			filename = arg
+	if filename is None:
 		print("You must supply a filename")
 		return 1
 
-	run(os.open(filename, os.O_RDONLY, 0777))
+	program_cache = None
+	if use_cache:
+		program_cache = cache_path(filename)
+	try:
+		run(os.open(filename, os.O_RDONLY, 0777), program_cache, timings)
+	except rstackovf.StackOverflow:
+		# non-tail calls nest on the host stack, so deep recursion ends up here
+		rstackovf.check_stack_overflow()
+		print("Stack overflow: too many nested function calls")
+		return 1
 	return 0
 
 def target(*args):
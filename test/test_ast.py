@@ -2,12 +2,13 @@
 
 import pytest
 
-from rswail.ast import Closure, compile_expression, compile_statement, expr_apply, expr_base_value, expr_from_int, expr_name_access, stmt_declaration, stmt_expression
+from rswail.ast import Closure, expression, compile_expression, compile_statement, expr_apply, expr_base_value, expr_from_int, expr_name_access, stmt_declaration, stmt_expression
 from rswail.cons_list import empty, from_list, singleton
-from rswail.bytecode import Program
-from rswail.function import NativeFunction
+from rswail.bytecode import Instruction, Program
+from rswail.execute import MatchError
+from rswail.function import ArgumentCountError, NativeFunction
 from rswail.value import Integer, String
-from target import start_execution
+from target import parse, start_execution
 
 def test_base_value():
 	"""Load a base value in an expression."""
@@ -73,6 +74,13 @@ def test_declare_and_load():
 	assert sorted(closure.bound_variables.keys()) == [u"foo"]
 	assert sorted(closure.used_variables.keys()) == [u"def", u"foo"]
 	assert sorted(closure.get_free_variables().keys()) == [u"def"]
+	# bound variables are loaded from their slot, free ones by name
+	assert closure.get_slot(u"foo") == 0
+	assert closure.get_slot(u"def") == -1
+	assert closure.slot_count() == 1
+	block = program.get_block(block_id)
+	assert block.opcodes[-1] == Instruction.LOAD_FAST
+	assert block.arguments[-1] == 0
 
 	# TODO: check the program works
 
@@ -88,3 +96,187 @@ def test_load_general_name():
 	assert sorted(closure.get_free_variables().keys()) == [u"foo"]
 
 	# TODO: check the program works
+
+def test_define_and_call():
+	"""Define a function with def and call it."""
+	program = Program()
+	closure = Closure(is_global=True)
+	arg = expr_name_access(singleton(String(u"x")))
+	body = singleton(stmt_expression(arg))
+	decl = stmt_declaration(singleton(String(u"def")), String(u"id"), singleton(arg), body)
+	call = expr_apply(expr_name_access(singleton(String(u"id"))), singleton(expr_from_int(37)))
+	block_id = compile_statement(program, program.start_block, decl, closure)
+	block_id = compile_statement(program, block_id, stmt_expression(call), closure)
+
+	stack = start_execution(program, global_closure=closure)
+
+	assert stack[-1].eq(37)
+	# the function is stored below its return value
+	assert len(stack) == 2
+
+def test_nested_calls():
+	"""Call functions from functions, and return the last statement's value."""
+	program = Program()
+	closure = Closure(is_global=True)
+	x = expr_name_access(singleton(String(u"x")))
+	y = expr_name_access(singleton(String(u"y")))
+	def_ = singleton(String(u"def"))
+	def name(value):
+		return expr_name_access(singleton(String(value)))
+	# def first(x, y): y; x
+	first = stmt_declaration(def_, String(u"first"), from_list([x, y]),
+			from_list([stmt_expression(y), stmt_expression(x)]))
+	# def twice(x): first(first(x, 1), 2)
+	inner = expr_apply(name(u"first"), from_list([x, expr_from_int(1)]))
+	outer = expr_apply(name(u"first"), from_list([inner, expr_from_int(2)]))
+	twice = stmt_declaration(def_, String(u"twice"), singleton(x),
+			singleton(stmt_expression(outer)))
+	call = expr_apply(name(u"twice"), singleton(expr_from_int(37)))
+	block_id = program.start_block
+	for stmt in [first, twice, stmt_expression(call)]:
+		block_id = compile_statement(program, block_id, stmt, closure)
+
+	stack = start_execution(program, global_closure=closure)
+
+	assert stack[-1].eq(37)
+	assert len(stack) == 3
+
+def test_match():
+	"""A match runs the case of the value's member, with its fields bound."""
+	source = """def first(name, args, body):
+	match args:
+		0
+	case cons_list.cons(`head, `tail):
+		match head
+		case expression.base_value(`value):
+			value
+		case expression.name_access(`name):
+			1
+"""
+	for call, result in [("first foo(37, 2)\n", 37), ("first bar(baz)\n", 1), ("first quux()\n", 0)]:
+		program, globals = parse(source + call)
+		stack = start_execution(program, global_closure=globals)
+		assert stack[-1].eq(result)
+	# without a default, values that match no case are an error
+	program, globals = parse(source + "first foo(first(1))\n")
+	with pytest.raises(MatchError):
+		start_execution(program, global_closure=globals)
+
+def test_match_patterns():
+	"""A case only matches members of its struct with as many fields."""
+	source = """def first(name, args, body):
+	match args:
+		0
+	case cons(`head):
+		1
+	case statement.cons(`head, `tail):
+		2
+	case cons_list.cons(`head, `tail):
+		3
+"""
+	program, globals = parse(source + "first foo(37, 2)\n")
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].eq(3)
+
+def test_match_globals():
+	"""At the top level, the fields are bound to global variables."""
+	program, globals = parse("""def fields(name, args, body):
+	args
+fields foo(1, 2)
+match foo
+case cons(`head, `tail):
+	tail
+head
+""")
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].member is expression.members[u"base_value"]
+	assert stack[-1].get_field(0).eq(1)
+	assert program.globals.lookup(u"tail").length == 1
+
+def test_closures():
+	"""Nested functions capture the variables of the functions around them."""
+	source = """def compose(f, g):
+	def composed(x):
+		f(g(x))
+	composed
+def double(x):
+	add(x, x)
+def apply(f, x):
+	f(x)
+def outer(x):
+	def middle(y):
+		def inner(z):
+			add(x, z)
+		inner(y)
+	middle(1)
+"""
+	for call, result in [("apply(compose(double, double), 3)\n", 12), ("outer(41)\n", 42)]:
+		program, globals = parse(source + call)
+		stack = start_execution(program, global_closure=globals)
+		assert stack[-1].eq(result)
+
+def test_recursive_closure():
+	"""A nested function can call itself."""
+	program, globals = parse("""def count(name, args, body):
+	def walk(list):
+		match list
+		case empty():
+			0
+		case cons(`head, `tail):
+			add(1, walk(tail))
+	walk(args)
+count foo(1, 2, 3)
+""")
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].eq(3)
+
+def test_captured_variables():
+	"""Only the variables bound by enclosing functions are captured."""
+	outer = Closure(is_global=True)
+	outer.make_bound(u"global")
+	function = Closure(parent=outer, function_name=u"function")
+	function.make_bound(u"x")
+	function.make_bound(u"y")
+	nested = Closure(parent=function, function_name=u"nested")
+	assert not nested.can_capture(u"global")
+	assert nested.can_capture(u"x")
+	assert nested.can_capture(u"nested")
+	assert not function.can_capture(u"function")
+	# capturing goes through all enclosing functions
+	innermost = Closure(parent=nested)
+	assert innermost.can_capture(u"x")
+	# the free variables are captured in the order they are first loaded,
+	# leaving out y, which nested binds itself after loading it
+	for name in [u"nested", u"global", u"x", u"nested", u"y"]:
+		nested.make_used(name)
+		if nested.can_capture(name):
+			nested.add_free_load(0, 0, name)
+	nested.make_bound(u"y")
+	nested.capture_free_variables()
+	assert nested.captured == [u"nested", u"x"]
+	assert nested.get_captured_index(u"x") == 1
+	assert nested.get_captured_index(u"global") == -1
+
+def test_tail_calls():
+	"""Calls in tail position don't need a new frame, so they can go deep."""
+	program, globals = parse("""def last(name, args, body):
+	def walk(list, previous):
+		match list
+		case empty():
+			previous
+		case cons(`head, `tail):
+			walk(tail, head)
+	walk(args, 0)
+last foo(%s)
+""" % ", ".join(str(i) for i in range(1, 801)))
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].get_field(0).eq(800)
+
+def test_argument_count():
+	"""Calling a function with the wrong number of arguments is an error."""
+	for call in ["f(1, 2, 3, 4, 5, 6)", "f()", "g(1)", "add(1)", "hello(1)"]:
+		program, globals = parse("def f(x):\n\tx\ndef g(x):\n\tf(x, x)\n" + call + "\n")
+		with pytest.raises(ArgumentCountError):
+			start_execution(program, global_closure=globals)
+	program, globals = parse("def f(x, y):\n\ty\nf(1, 2)\n")
+	assert start_execution(program, global_closure=globals)[-1].eq(2)
@@ -0,0 +1,103 @@
+import pytest
+
+from rswail.bytecode import Instruction, MAX_ARGUMENT, MIN_ARGUMENT, Program, pack_instruction, unpack_argument, unpack_opcode
+from rswail.value import Integer, String
+from target import parse, start_execution
+
+def test_pack_instruction():
+	"""Packing an instruction keeps both the opcode and the argument."""
+	for opcode in [Instruction.NOP, Instruction.PUSH_INT, Instruction.HCF]:
+		for argument in [0, 1, 37, -1, -37, MAX_ARGUMENT, MIN_ARGUMENT]:
+			instruction = pack_instruction(opcode, argument)
+			assert unpack_opcode(instruction) == opcode
+			assert unpack_argument(instruction) == argument
+
+def test_finalize():
+	"""Finalizing a block packs its code and forbids new instructions."""
+	program = Program()
+	block = program.get_block(program.start_block)
+	program.add_instruction(program.start_block, Instruction.PUSH_INT, -37)
+	program.add_instruction(program.start_block, Instruction.WRITE)
+	assert not block.is_finalized()
+
+	program.finalize()
+
+	assert block.is_finalized()
+	assert block.instruction_count() == 2
+	assert unpack_opcode(block.code[0]) == Instruction.PUSH_INT
+	assert unpack_argument(block.code[0]) == -37
+	assert unpack_opcode(block.code[1]) == Instruction.WRITE
+	with pytest.raises(AssertionError):
+		program.add_instruction(program.start_block, Instruction.NOP)
+
+def test_finalize_new_blocks():
+	"""Blocks added after finalizing can be finalized later."""
+	program = Program()
+	program.finalize()
+	block_id = program.new_block()
+	program.add_instruction(block_id, Instruction.NOP)
+	program.finalize()
+	assert program.get_block(block_id).instruction_count() == 1
+
+def test_block_stack_usage():
+	"""Blocks know how far they grow the stack, before and after finalizing."""
+	program = Program()
+	block_id = program.start_block
+	program.add_instruction(block_id, Instruction.PUSH_INT, 1)
+	program.add_instruction(block_id, Instruction.PUSH_INT, 2)
+	program.add_instruction(block_id, Instruction.DUP, 1)
+	program.add_instruction(block_id, Instruction.POP, 3)
+	program.add_instruction(block_id, Instruction.POP, 1)
+	block = program.get_block(block_id)
+	assert block.stack_usage() == (3, -1)
+	block.finalize()
+	assert block.stack_usage() == (3, -1)
+
+def test_stack_depth_follows_calls():
+	"""The stack depth includes the code after calls and jump targets."""
+	program = Program()
+	block_id = program.start_block
+	program.add_instruction(block_id, Instruction.PUSH_INT, 0)
+	program.add_instruction(block_id, Instruction.PUSH_INT, 1)
+	program.add_instruction(block_id, Instruction.CALL, 1)
+	next_block = program.make_next_block(block_id)
+	jump_target = program.new_block()
+	label = program.add_label(next_block, jump_target)
+	program.add_instruction(next_block, Instruction.PUSH_INT, 2)
+	program.add_instruction(next_block, Instruction.JUMP, label)
+	for i in range(3):
+		program.add_instruction(jump_target, Instruction.PUSH_INT, i)
+	assert program.stack_depth(block_id) == 5
+	assert program.stack_depth(block_id, 2) == 7
+	assert program.stack_depth(jump_target) == 3
+
+def test_program_pops_statements():
+	"""Only the value of the last top-level statement stays on the stack."""
+	program, globals = parse("def f(x):\n\tx\n" + "f(1)\n" * 100 + "f(2)\n")
+	assert program.stack_depth(program.start_block) == 2
+	stack = start_execution(program, global_closure=globals)
+	assert len(stack) == 1
+	assert stack[-1].eq(2)
+	function = program.globals.lookup(u"f")
+	# just the argument, which the return value replaces
+	assert function.stack_depth == 1
+
+def test_constant_pool():
+	"""All blocks of a program share their constants and names."""
+	program = Program()
+	other_block = program.new_block()
+	const_id = program.add_constant(program.start_block, Integer.from_int(37))
+	assert program.add_constant(other_block, Integer.from_int(37)) == const_id
+	assert program.add_constant(other_block, String(u"37")) != const_id
+	name_id = program.add_name(program.start_block, u"name")
+	assert program.add_name(other_block, u"name") == name_id
+	assert program.pool.names == [u"", u"name"]
+
+	# execution uses the tables, which are filled in when finalizing
+	assert len(program.pool.constant_table) == 0
+	program.finalize()
+	assert program.pool.constant_table[const_id].eq(37)
+	assert program.pool.name_table[name_id] == u"name"
+	program.add_name(other_block, u"new")
+	program.finalize()
+	assert program.pool.name_table[-1] == u"new"
@@ -0,0 +1,101 @@
+import pytest
+
+from rpython.rlib import rmmap
+
+from rswail.bytecode import Instruction, Program
+from rswail.cache import CacheReader, CacheWriter, cache_path, read_cache, write_cache
+from rswail.function import NativeFunction
+from target import parse, start_execution
+
+source = """def id(x):
+	x
+def twice(f, x):
+	f(f(x))
+foo bar(1, baz)
+twice(id, 37)
+"""
+
+def test_cache_path():
+	"""The cache file is placed next to the source file."""
+	assert cache_path("example/hello.swa") == "example/hello.swc"
+	assert cache_path("hello") == "hello.swc"
+
+def test_roundtrip(tmpdir):
+	"""A cached program should run the same as the freshly compiled one."""
+	path = str(tmpdir.join("program.swc"))
+	program, globals = parse(source)
+	assert write_cache(path, program, source)
+
+	cached = read_cache(path, source)
+	assert cached is not None
+	assert cached.start_block == program.start_block
+	assert len(cached.blocks) == len(program.blocks)
+	for block, cached_block in zip(program.blocks, cached.blocks):
+		assert cached_block.code == block.code
+		assert cached_block.labels == block.labels
+		assert cached_block.next_block_id == block.next_block_id
+		assert cached_block.pool is cached.pool
+	assert cached.pool.names == program.pool.names
+	assert len(cached.pool.constants) == len(program.pool.constants)
+	for constant, cached_constant in zip(program.pool.constants, cached.pool.constants):
+		assert type(cached_constant) is type(constant)
+
+	# foo is a declaration header which takes the AST as arguments
+	def foo(args):
+		assert args[0].eq(u"bar")
+		return args[0]
+	cached.globals.define(u"foo", NativeFunction(u"foo", foo))
+	assert start_execution(cached)[-1].eq(37)
+
+def test_stale_cache(tmpdir):
+	"""A cache file for different source code isn't used."""
+	path = str(tmpdir.join("program.swc"))
+	program, globals = parse(source)
+	assert write_cache(path, program, source)
+	assert read_cache(path, source + "hello()\n") is None
+
+def test_missing_or_invalid_cache(tmpdir):
+	"""Missing and invalid cache files are ignored."""
+	path = tmpdir.join("program.swc")
+	assert read_cache(str(path), source) is None
+	path.write("")
+	assert read_cache(str(path), source) is None
+	path.write("this is not a cache file")
+	assert read_cache(str(path), source) is None
+
+def test_invalid_block_ids(tmpdir):
+	"""Cache files which refer to missing blocks are ignored."""
+	path = str(tmpdir.join("program.swc"))
+	program, globals = parse(source)
+	block = program.blocks[program.start_block]
+	block.next_block_id = len(program.blocks)
+	assert write_cache(path, program, source)
+	assert read_cache(path, source) is None
+
+	program, globals = parse(source)
+	program.blocks[program.start_block].labels.append(len(program.blocks) + 5)
+	assert write_cache(path, program, source)
+	assert read_cache(path, source) is None
+
+def test_uncacheable_program(tmpdir):
+	"""Programs with native functions as constants can't be cached."""
+	path = str(tmpdir.join("program.swc"))
+	program = Program()
+	program.add_constant(program.start_block, NativeFunction(u"func", None))
+	program.finalize()
+	assert not write_cache(path, program, "")
+	assert not tmpdir.join("program.swc").check()
+
+def test_ints(tmpdir):
+	"""Integers of all sizes survive encoding."""
+	values = [0, 1, -1, 63, 64, -64, -65, 1 << 40, -(1 << 40)]
+	writer = CacheWriter()
+	for value in values:
+		writer.write_int(value)
+	path = tmpdir.join("ints")
+	path.write(writer.getvalue(), mode="wb")
+
+	with path.open("rb") as fp:
+		reader = CacheReader(rmmap.mmap(fp.fileno(), 0, access=rmmap.ACCESS_READ))
+		for value in values:
+			assert reader.read_int() == value
@@ -1,6 +1,7 @@
 import pytest
 
-from rswail.cons_list import append, cons, empty, extend, from_list, index, length, singleton, to_list
+from rswail.cons_list import append, cons, cons_list, empty, extend, from_list, index, length, singleton, to_list
+from rswail.struct import construct, make_instance
 from rswail.value import Integer
 
 def test_empty_lists_equivalent():
@@ -71,3 +72,58 @@ def test_index_errors():
 		index(cons(Integer.from_int(1), cons(Integer.from_int(2), empty())), 2)
 	with pytest.raises(IndexError):
 		index(cons(Integer.from_int(1), cons(Integer.from_int(2), empty())), -1)
+
+def test_list_pattern_surface():
+	"""Lists look like cons-list instances, with a head and tail field."""
+	list = from_list([Integer.from_int(1), Integer.from_int(2)])
+	assert list.member is cons_list.members[u"cons"]
+	assert list.get_field(0).eq(1)
+	tail = list.get_field(1)
+	assert tail.member is cons_list.members[u"cons"]
+	assert tail.get_field(0).eq(2)
+	assert tail.get_field(1).member is cons_list.members[u"empty"]
+	assert tail.get_field(1).field_count() == 0
+
+def test_cons_shares_items():
+	"""Consing onto a tail reuses its array, unless it's already in use."""
+	tail = singleton(Integer.from_int(3))
+	first = cons(Integer.from_int(1), tail)
+	second = cons(Integer.from_int(2), tail)
+	assert first.items is tail.items
+	assert second.items is not tail.items
+	assert to_list(first)[0].eq(1)
+	assert to_list(second)[0].eq(2)
+	assert first.tail().eq(tail)
+	assert second.tail().eq(tail)
+
+def test_long_lists():
+	"""Building and comparing long lists doesn't recurse."""
+	list = empty()
+	for i in range(10000):
+		list = cons(Integer.from_int(i), list)
+	assert length(list) == 10000
+	assert index(list, 0).eq(9999)
+	assert list.eq(from_list(to_list(list)))
+	assert length(append(list, Integer.from_int(-1))) == 10001
+	assert length(extend(list, list)) == 20000
+
+def test_empty_list_shared():
+	"""There is only one empty list, which cons doesn't modify."""
+	assert empty() is empty()
+	assert from_list([]) is empty()
+	assert singleton(Integer.from_int(1)).tail() is empty()
+	one = cons(Integer.from_int(1), empty())
+	two = cons(Integer.from_int(2), empty())
+	assert to_list(one)[0].eq(1)
+	assert to_list(two)[0].eq(2)
+	assert length(empty()) == 0
+
+def test_construct_members():
+	"""Constructing the members of cons_list gives the same lists as the functions."""
+	assert cons_list.members[u"empty"].nullary_instance() is empty()
+	assert construct(cons_list, u"empty") is empty()
+	list = construct(cons_list, u"cons", Integer.from_int(1), construct(cons_list, u"empty"))
+	assert length(list) == 1
+	list = make_instance(cons_list.members[u"cons"], [Integer.from_int(2), list])
+	assert to_list(list)[1].eq(1)
+	assert cons(Integer.from_int(3), list).eq(from_list([Integer.from_int(i) for i in [3, 2, 1]]))
@@ -27,6 +27,22 @@ def test_builtin_tests():
 	"""The builtin tests should run successfully."""
 	assert entry_point(["swail", "tests.swa"]) == 0
 
+def test_timings(capfd):
+	"""Each phase reports its timing on stderr when asked to."""
+	exit_code = entry_point(["swail", "--timings", "--no-cache", "example/define-functions.swa"])
+	assert exit_code == 0
+	out, err = capfd.readouterr()
+	phases = [line.split()[1] for line in err.splitlines()]
+	assert phases == ["parse", "compile", "execute"]
+
+def test_stack_overflow(tmpdir, capsys):
+	"""Report an error instead of crashing when recursion gets too deep."""
+	program = tmpdir.join("forever.swa")
+	program.write("def forever(x):\n\tadd(1, forever(x))\n\nforever(1)\n")
+	assert entry_point(["swail", "--no-cache", str(program)]) != 0
+	out, err = capsys.readouterr()
+	assert "Stack overflow" in out
+
 def test_missing_file():
 	"""Report an error but gracefully exit when the file to run isn't specified."""
 	assert entry_point(["swail"]) != 0
@@ -1,6 +1,6 @@
 from rswail.ast import Closure, compile_expression, expr_apply, expr_base_value
 from rswail.bytecode import Instruction, Program
-from rswail.function import CodeFunction
+from rswail.function import CodeFunction, NativeFunction, NativeFunction0, NativeFunction1, NativeFunction2
 from rswail.cons_list import empty
 from rswail.value import Integer
 from target import start_execution
@@ -14,8 +14,8 @@ def test_defined_function_call():
 	func_closure = Closure()
 	func_block = program.new_block()
 	block_id = compile_expression(program, func_block, return_expr, func_closure)
-	# get the return label and jump to it
-	program.add_instruction(block_id, Instruction.JUMP_LABEL, 2)
+	# and return its value
+	program.add_instruction(block_id, Instruction.RETURN)
 
 	# FIXME debug code
 	print(program.blocks[func_block].pretty_print())
@@ -30,3 +30,14 @@ def test_defined_function_call():
 	tos = stack[-1]
 
 	assert tos.eq(37)
+
+def test_native_call_conventions():
+	"""Native functions with a fixed number of arguments get them directly."""
+	one, two, three = Integer.from_int(1), Integer.from_int(2), Integer.from_int(3)
+	generic = NativeFunction(u"generic", lambda args: Integer.from_int(len(args)))
+	assert generic.call_args([one, two, three]).eq(3)
+	assert generic.call2(one, two).eq(2)
+	assert NativeFunction0(u"nullary", lambda: Integer.from_int(37)).call0().eq(37)
+	assert NativeFunction1(u"unary", lambda arg: arg).call1(two).eq(2)
+	binary = NativeFunction2(u"binary", lambda left, right: left.sub(right))
+	assert binary.call2(two, three).eq(-1)
@@ -0,0 +1,55 @@
+import pytest
+
+from rswail.globals import Globals, make_globals
+from rswail.value import Integer
+from target import parse, start_execution
+
+def test_define_and_lookup():
+	"""Defining a global makes it available for lookup."""
+	globals = Globals()
+	assert not globals.contains(u"foo")
+	globals.define(u"foo", Integer.from_int(37))
+	assert globals.contains(u"foo")
+	assert globals.lookup(u"foo").eq(37)
+
+def test_lookup_missing():
+	"""Looking up an undefined global gives an error."""
+	with pytest.raises(KeyError):
+		Globals().lookup(u"foo")
+
+def test_version_changes():
+	"""Adding a name changes the version, assigning to a name keeps the cell."""
+	globals = Globals()
+	version = globals.version
+	globals.define(u"foo", Integer.from_int(1))
+	assert globals.version is not version
+
+	version = globals.version
+	cell = globals.get_cell(u"foo")
+	globals.define(u"foo", Integer.from_int(2))
+	assert globals.version is version
+	assert globals.get_cell(u"foo") is cell
+	assert cell.value.eq(2)
+
+def test_builtins():
+	"""The builtins are globals of each program."""
+	assert make_globals().contains(u"hello")
+	assert make_globals().contains(u"def")
+	# and the program builds them only once, not e.g. for each frame
+	program, globals = parse("def f(x):\n\tadd(x, 1)\nf(mul(2, 3))\n")
+	cells = [program.globals.get_cell(name) for name in [u"hello", u"add", u"mul"]]
+	values = [cell.value for cell in cells]
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].eq(7)
+	for index, name in enumerate([u"hello", u"add", u"mul"]):
+		assert program.globals.get_cell(name) is cells[index]
+		assert cells[index].value is values[index]
+
+def test_arithmetic_builtins():
+	"""The arithmetic builtins work on integers of any size."""
+	program, globals = parse("add(mul(6, 7), sub(1, 2))\n")
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].eq(41)
+	program, globals = parse("mul(4611686018427387904, 4)\n")
+	stack = start_execution(program, global_closure=globals)
+	assert stack[-1].eq(Integer.from_decimal("18446744073709551616"))
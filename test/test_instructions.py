@@ -2,9 +2,13 @@
 
 import pytest
 
-from rswail.bytecode import Instruction, Program
-from rswail.function import NativeFunction
-from rswail.value import Integer
+from rswail.bytecode import Instruction, Program, unpack_opcode
+from rswail.closure import Closure
+from rswail.cons_list import from_list
+from rswail.execute import Frame, MatchError, execute_frame
+from rswail.function import CodeFunction, NativeFunction
+from rswail.struct import Struct
+from rswail.value import Boolean, Integer, Value
 from target import start_execution
 
 def test_empty_program():
@@ -128,6 +132,79 @@ def test_store_load_local():
 	tos = stack[-1]
 	assert tos.eq(37)
 
+def test_store_load_global():
+	"""Globals are stored in the program, not the stack frame."""
+	program = Program()
+	var_id = program.add_name(program.start_block, u"var")
+	program.add_instruction(program.start_block, Instruction.STORE_GLOBAL, var_id)
+	program.add_instruction(program.start_block, Instruction.LOAD_GLOBAL, var_id)
+
+	stack = start_execution(program, [Integer.from_int(37)])
+
+	tos = stack[-1]
+	assert tos.eq(37)
+	assert program.globals.lookup(u"var").eq(37)
+
+def test_load_local_falls_back_to_global():
+	"""Loading a name that isn't a local gives the global."""
+	program = Program()
+	var_id = program.add_name(program.start_block, u"hello")
+	program.add_instruction(program.start_block, Instruction.LOAD_LOCAL, var_id)
+
+	stack = start_execution(program)
+
+	assert stack[-1] is program.globals.lookup(u"hello")
+
+def test_store_load_fast():
+	"""Storing into two slots and loading them in the same order swaps the values."""
+	program = Program()
+	closure = Closure()
+	assert closure.make_bound(u"a") == 0
+	assert closure.make_bound(u"b") == 1
+	program.add_instruction(program.start_block, Instruction.STORE_FAST, 1)
+	program.add_instruction(program.start_block, Instruction.STORE_FAST, 0)
+	program.add_instruction(program.start_block, Instruction.LOAD_FAST, 1)
+	program.add_instruction(program.start_block, Instruction.LOAD_FAST, 0)
+
+	stack = start_execution(program, [Integer.from_int(1), Integer.from_int(2)], closure)
+
+	# the slots are separate, so the values have swapped places
+	assert len(stack) == 2
+	assert stack[0].eq(2)
+	assert stack[1].eq(1)
+
+def test_load_attr():
+	"""Loading an attribute replaces the TOS with the attribute."""
+	program = Program()
+	name_id = program.add_name(program.start_block, u"name")
+	program.add_instruction(program.start_block, Instruction.LOAD_ATTR, name_id)
+	program.add_instruction(program.start_block, Instruction.LOAD_ATTR, name_id)
+
+	stack = start_execution(program, [Integer.from_int(37)])
+
+	assert len(stack) == 1
+	assert stack[-1].eq(u'"37"')
+
+def test_load_attr_cached():
+	"""Loading attributes keeps working when the value's map changes."""
+	program = Program()
+	attr_id = program.add_name(program.start_block, u"attr")
+	program.add_instruction(program.start_block, Instruction.LOAD_ATTR, attr_id)
+	program.add_instruction(program.start_block, Instruction.SWAP, 2)
+	program.add_instruction(program.start_block, Instruction.LOAD_ATTR, attr_id)
+	first = Value(u"first")
+	first.set(u"attr", Integer.from_int(1))
+	second = Value(u"second")
+	second.set(u"other", Integer.from_int(0))
+	second.set(u"attr", Integer.from_int(2))
+
+	stack = start_execution(program, [first, second])
+	assert stack[0].eq(2)
+	assert stack[1].eq(1)
+	stack = start_execution(program, [second, first])
+	assert stack[0].eq(1)
+	assert stack[1].eq(2)
+
 def test_pop_single():
 	"""Pop a single value from the stack."""
 	program = Program()
@@ -290,3 +367,75 @@ def test_call_args():
 	tos = stack[-1]
 
 	assert tos.eq(37)
+
+def test_frame_stack():
+	"""The frame's stack has room for exactly the values the code pushes."""
+	program = Program()
+	program.add_instruction(program.start_block, Instruction.PUSH_INT, 1)
+	program.add_instruction(program.start_block, Instruction.PUSH_INT, 2)
+	program.add_instruction(program.start_block, Instruction.POP, 1)
+	program.finalize()
+	frame = Frame(program, program.start_block,
+			stack_depth=program.stack_depth(program.start_block))
+	assert len(frame.stack) == 2
+	execute_frame(frame)
+	assert frame.sp == 1
+	assert frame.stack[0].eq(Integer.from_int(1))
+	# popped values don't stay alive through the stack
+	assert frame.stack[1] is None
+
+def test_quickening():
+	"""Instructions specialize on the values they see, and fall back on others."""
+	program = Program()
+	block = program.blocks[program.start_block]
+	code_block = program.new_block()
+	program.add_instruction(code_block, Instruction.PUSH_INT, 5)
+	program.add_instruction(code_block, Instruction.RETURN)
+	program.add_instruction(program.start_block, Instruction.CALL, 0)
+	program.add_instruction(program.start_block, Instruction.SWAP, 2)
+	program.add_instruction(program.start_block, Instruction.LOAD_ATTR,
+			program.add_name(program.start_block, u"member"))
+	program.add_instruction(program.start_block, Instruction.SWAP, 3)
+	program.add_instruction(program.start_block, Instruction.JUMP_IF,
+			program.add_label(program.start_block, code_block))
+	def quickened():
+		return [unpack_opcode(instruction) for instruction in block.quickened]
+
+	native = NativeFunction(u"native", lambda args: Integer.from_int(37))
+	code = CodeFunction(u"code", code_block)
+	first = Struct(u"first", {u"member": []})
+	second = Struct(u"second", {u"other": [], u"member": []})
+
+	stack = start_execution(program, [Boolean(False), first, native])
+	assert stack[0].eq(37)
+	assert stack[1] is first.get(u"member")
+	assert quickened() == [Instruction.CALL_NATIVE, Instruction.SWAP,
+			Instruction.LOAD_ATTR_STRUCT_MEMBER, Instruction.SWAP, Instruction.JUMP_IF_BOOL]
+	# the code of the block itself stays the same
+	assert block.get_instruction(0) == (Instruction.CALL, 0)
+
+	stack = start_execution(program, [Boolean(True), first, code])
+	# the code function returned 5, then we jumped to its code
+	assert stack[0].eq(5)
+	assert stack[1] is first.get(u"member")
+	assert stack[2].eq(5)
+	assert quickened()[0] == Instruction.CALL_CODE
+	assert quickened()[2] == Instruction.LOAD_ATTR_STRUCT_MEMBER
+
+	stack = start_execution(program, [Integer.from_int(0), second, native])
+	assert stack[1] is second.get(u"member")
+	assert quickened() == [Instruction.CALL_NATIVE, Instruction.SWAP,
+			Instruction.LOAD_ATTR_STRUCT_MEMBER, Instruction.SWAP, Instruction.JUMP_IF]
+
+	plain = Value(u"plain")
+	plain.set(u"member", Integer.from_int(1))
+	stack = start_execution(program, [Integer.from_int(0), plain, native])
+	assert stack[1].eq(1)
+	assert quickened()[2] == Instruction.LOAD_ATTR
+
+def test_unpack_field_count():
+	"""Unpacking an instance with another number of fields is an error."""
+	program = Program()
+	program.add_instruction(program.start_block, Instruction.UNPACK, 1)
+	with pytest.raises(MatchError):
+		start_execution(program, [from_list([Integer.from_int(37)])])
@@ -0,0 +1,36 @@
+#!/usr/bin/env python2
+
+import pytest
+
+from rswail.map import EMPTY_MAP, AttributeCache
+from rswail.value import Unit, Value
+
+def test_transitions_are_shared():
+	"""Adding the same attribute to the same map gives the same map."""
+	map = EMPTY_MAP.with_attribute(u"a")
+	assert map is EMPTY_MAP.with_attribute(u"a")
+	assert map is not EMPTY_MAP.with_attribute(u"b")
+	assert EMPTY_MAP.attribute_count() == 0
+	assert map.attribute_count() == 1
+
+def test_find_index():
+	"""Attributes are numbered in the order they were added."""
+	map = EMPTY_MAP.with_attribute(u"a").with_attribute(u"b")
+	assert map.find_index(u"a") == 0
+	assert map.find_index(u"b") == 1
+	assert map.find_index(u"c") == -1
+
+def test_attribute_cache():
+	"""The cache gives the index of the attribute in values of any map."""
+	cache = AttributeCache()
+	value1 = Value(u"value")
+	value1.set(u"a", Unit())
+	value1.set(u"b", Unit())
+	value2 = Value(u"value")
+	value2.set(u"b", Unit())
+	assert cache.lookup(value1.map, u"b") == 1
+	assert cache.map is value1.map
+	assert cache.lookup(value1.map, u"b") == 1
+	assert cache.lookup(value2.map, u"b") == 0
+	assert cache.map is value2.map
+	assert cache.lookup(EMPTY_MAP, u"b") == -1
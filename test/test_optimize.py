@@ -0,0 +1,184 @@
+#!/usr/bin/env python2
+
+import pytest
+
+from rswail.bytecode import Block, Instruction, Program, pack_load_attr
+from rswail.function import NativeFunction
+from rswail.optimize import optimize_block, optimize_program, thread_returns
+from rswail.value import Integer
+from target import parse, start_execution
+
+def make_block(instructions):
+	"""Make a block with the given list of (opcode, argument) pairs."""
+	block = Block()
+	for opcode, argument in instructions:
+		block.add_instruction(opcode, argument)
+	return block
+
+def instructions(block):
+	return list(zip(block.opcodes, block.arguments))
+
+def test_dead_push_pop():
+	"""Values that are pushed and immediately popped are left out."""
+	block = make_block([
+		(Instruction.PUSH_CONST, 0),
+		(Instruction.LOAD_FAST, 1),
+		(Instruction.POP, 1),
+		(Instruction.POP, 1),
+		(Instruction.CALL, 0),
+	])
+	optimize_block(block)
+	assert instructions(block) == [(Instruction.CALL, 0)]
+
+def test_pop_partially():
+	"""Pops of values that weren't pushed in the block remain."""
+	block = make_block([
+		(Instruction.PUSH_INT, 3),
+		(Instruction.POP, 3),
+	])
+	optimize_block(block)
+	assert instructions(block) == [(Instruction.POP, 2)]
+
+def test_store_keep():
+	"""Duplicating and then storing becomes storing without popping."""
+	block = make_block([
+		(Instruction.DUP, 1),
+		(Instruction.STORE_FAST, 2),
+		(Instruction.DUP, 1),
+		(Instruction.STORE_GLOBAL, 1),
+		(Instruction.DUP, 2),
+		(Instruction.STORE_FAST, 0),
+	])
+	block.add_name(u"var")
+	optimize_block(block)
+	assert instructions(block) == [
+		(Instruction.STORE_FAST_KEEP, 2),
+		(Instruction.STORE_GLOBAL_KEEP, 1),
+		(Instruction.DUP, 2),
+		(Instruction.STORE_FAST, 0),
+	]
+	assert block.pool.names == [u"", u"var"]
+
+def test_store_keep_pop():
+	"""Storing, keeping and then popping is just storing."""
+	block = make_block([
+		(Instruction.DUP, 1),
+		(Instruction.STORE_FAST, 2),
+		(Instruction.POP, 1),
+	])
+	optimize_block(block)
+	assert instructions(block) == [(Instruction.STORE_FAST, 2)]
+
+def test_tail_call():
+	"""Returning the value of a call is a tail call."""
+	block = make_block([
+		(Instruction.CALL, 2),
+		(Instruction.RETURN, 0),
+		(Instruction.CALL, 1),
+		(Instruction.JUMP_LABEL, 3),
+	])
+	optimize_block(block)
+	assert instructions(block) == [
+		(Instruction.TAIL_CALL, 2),
+		(Instruction.CALL, 1),
+		(Instruction.JUMP_LABEL, 3),
+	]
+
+def test_load_attr():
+	"""Loading a variable and then its attribute is one instruction."""
+	block = make_block([
+		(Instruction.LOAD_FAST, 3),
+		(Instruction.LOAD_ATTR, 1),
+		(Instruction.LOAD_ATTR, 2),
+		(Instruction.LOAD_GLOBAL, 2),
+		(Instruction.LOAD_ATTR, 1),
+	])
+	block.add_name(u"attr")
+	block.add_name(u"global")
+	optimize_block(block)
+	attr_id = block.pool.names.index(u"attr")
+	global_id = block.pool.names.index(u"global")
+	assert instructions(block) == [
+		(Instruction.LOAD_FAST_ATTR, pack_load_attr(3, attr_id)),
+		(Instruction.LOAD_ATTR, global_id),
+		(Instruction.LOAD_GLOBAL_ATTR, pack_load_attr(global_id, attr_id)),
+	]
+
+def test_compact():
+	"""Labels that aren't used are dropped, the shared constants and names stay."""
+	block = make_block([
+		(Instruction.PUSH_CONST, 2),
+		(Instruction.LOAD_GLOBAL, 2),
+		(Instruction.JUMP, 1),
+	])
+	block.add_constant(Integer.from_int(1))
+	block.add_constant(Integer.from_int(2))
+	block.add_name(u"unused")
+	block.add_name(u"used")
+	block.add_label(37)
+	optimize_block(block)
+	assert instructions(block) == [
+		(Instruction.PUSH_CONST, 2),
+		(Instruction.LOAD_GLOBAL, 2),
+		(Instruction.JUMP, 0),
+	]
+	assert len(block.pool.constants) == 3
+	assert block.pool.constants[2].eq(2)
+	assert block.pool.names == [u"", u"unused", u"used"]
+	assert block.labels == [37]
+
+def test_optimized_program():
+	"""Optimized programs still compute the same values."""
+	program, globals = parse("def f(x):\n\tdef g(y):\n\t\ty\n\tx.name\nhello.name\nf(hello)\n")
+	stack = start_execution(program, global_closure=globals)
+	assert len(stack) == 1
+	assert stack[-1].eq(u"hello")
+
+def test_merge_blocks():
+	"""Code after a call continues in the same block."""
+	source = "def f(x, y):\n\tx\n\ty\nf(1, 2)\nf(hello, 3)\nf(4, 5)\n"
+	program, globals = parse(source)
+	# the start block and the body of f
+	assert len(program.blocks) == 2
+	stack = start_execution(program, global_closure=globals)
+	assert len(stack) == 1
+	assert stack[-1].eq(5)
+
+def test_merge_keeps_jump_targets():
+	"""Blocks that are jumped to aren't merged, and ids are renumbered."""
+	program = Program()
+	block_id = program.start_block
+	func_id = program.add_constant(block_id, NativeFunction(u"func", lambda args: Integer.from_int(1)))
+	program.add_instruction(block_id, Instruction.PUSH_CONST, func_id)
+	program.add_instruction(block_id, Instruction.CALL, 0)
+	after_call = program.make_next_block(block_id)
+	program.add_instruction(after_call, Instruction.PUSH_INT, 2)
+	program.add_instruction(after_call, Instruction.CALL, 0)
+	program.make_next_block(after_call)
+	target = program.new_block()
+	label = program.add_label(after_call, target)
+	program.add_instruction(after_call, Instruction.JUMP, label)
+	program.add_instruction(target, Instruction.PUSH_INT, 3)
+	optimize_program(program)
+	# only the block after the first call is merged
+	assert len(program.blocks) == 3
+	assert program.blocks[program.start_block].labels == [2]
+
+def test_thread_returns():
+	"""Jumps to a block that only returns become returns."""
+	program = Program()
+	return_block = program.new_block()
+	program.add_instruction(return_block, Instruction.RETURN)
+	other_block = program.new_block()
+	program.add_instruction(other_block, Instruction.NOP)
+	return_label = program.add_label(program.start_block, return_block)
+	other_label = program.add_label(program.start_block, other_block)
+	program.add_instruction(program.start_block, Instruction.JUMP_IF, return_label)
+	program.add_instruction(program.start_block, Instruction.JUMP, other_label)
+	program.add_instruction(program.start_block, Instruction.JUMP, return_label)
+	thread_returns(program)
+	assert instructions(program.blocks[program.start_block]) == [
+		(Instruction.JUMP_IF, return_label),
+		(Instruction.JUMP, other_label),
+		(Instruction.RETURN, 0),
+	]
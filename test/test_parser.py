@@ -6,7 +6,7 @@ from rpython.rlib.parsing.tree import Nonterminal, Symbol
 
 from rswail.ast import statement, expression
 from rswail.cons_list import empty, from_list, index, length, to_list
-from rswail.parser import lexed_to_nodes, nodes_to_ast, swail_parser, swail_lexer
+from rswail.parser import lexed_to_nodes, nodes_to_ast, swail_parser, swail_tokenizer
 from rswail.value import String
 
 import pytest
@@ -99,6 +99,10 @@ def test_parser():
 			"def foo():\n\tpass\n",
 			"def foo():\n\tdef bar():\n\t\tpass\n",
 			"def foo():\n\tdef bar():\n\t\tpass\n\tbar\n",
+			# matches
+			"match foo\ncase bar.baz():\n\tquux\n",
+			"match foo:\n\t1\ncase bar.baz(`x, `y):\n\tx\ncase quux(`z):\n\tz\n",
+			"def foo(x):\n\tmatch x\n\tcase bar():\n\t\t1\n\tx\n",
 	]
 	for statement in statements:
 		swail_parser(statement)
@@ -112,9 +116,17 @@ def test_general_name_unicode():
 	assert length(stmts) == 1
 	stmt = index(stmts, 0)
 	assert stmt.member is statement.members[u"expression"]
-	expr = stmt.values[0]
+	expr = stmt.get_field(0)
 	assert expr.member is expression.members[u"name_access"]
-	assert expr.values[0].eq(from_list(map(String, [u'general', u'name', u'with', u'dots'])))
+	assert expr.get_field(0).eq(from_list(map(String, [u'general', u'name', u'with', u'dots'])))
+
+def test_names_interned():
+	"""Each occurrence of a name in the source gives the same String."""
+	stmts = swail_parser("foo.bar\nfoo\n")
+	first = index(stmts, 0).get_field(0).get_field(0)
+	second = index(stmts, 1).get_field(0).get_field(0)
+	assert index(first, 0) is index(second, 0)
+	assert index(first, 0) is String.interned(u"foo")
 
 def test_arg_list():
 	"""Parsing an argument list should give a list of expressions."""
@@ -122,36 +134,62 @@ def test_arg_list():
 	assert length(stmts) == 1
 	stmt = index(stmts, 0)
 	assert stmt.member is statement.members[u"expression"]
-	expr = stmt.values[0]
+	expr = stmt.get_field(0)
 	assert expr.member is expression.members[u"apply"]
-	assert expr.values[0].member is expression.members[u"name_access"]
-	assert expr.values[0].values[0].eq(from_list([String(u'call')]))
-	assert length(expr.values[1]) == 2
-	for arg in to_list(expr.values[1]):
+	assert expr.get_field(0).member is expression.members[u"name_access"]
+	assert expr.get_field(0).get_field(0).eq(from_list([String(u'call')]))
+	assert length(expr.get_field(1)) == 2
+	for arg in to_list(expr.get_field(1)):
 		assert arg.member is expression.members[u"name_access"]
-		name_parts = to_list(arg.values[0])
+		name_parts = to_list(arg.get_field(0))
 		for name in name_parts:
 			assert isinstance(name, String)
 
-def test_lex_eof():
-	"""The lexer should nicely handle EOF, appending a newline."""
-	
-	# note that we get an extra \n since the starting newline isn't overwritten
-	assert swail_lexer("") == ["\n", "\n"]
+def token_names(program_code):
+	"""Tokenize the code and give the names of the tokens."""
+	return [token.name for token in swail_tokenizer(program_code)]
+
+def test_tokenize_eof():
+	"""The tokenizer should nicely handle EOF, appending a newline."""
+	assert token_names("") == ["NEWLINE", "EOF"]
 	# some small lines with and without indents
-	assert swail_lexer("foo") == ["f", "o", "o", "\n"]
-	assert swail_lexer("foo\n\tbar") == [
-			"f", "o", "o", "\n",
-			"<indent>\t", "b", "a", "r", "\n",
-			"<dedent>\t\n",
+	assert token_names("foo") == ["NAME", "NEWLINE", "EOF"]
+	assert token_names("foo\n\tbar") == [
+			"NAME", "NEWLINE",
+			"INDENT", "NAME", "NEWLINE",
+			"DEDENT", "NEWLINE", "EOF",
 	]
-	assert swail_lexer("foo\n\tbar\nbaz") == [
-			"f", "o", "o", "\n",
-			"<indent>\t", "b", "a", "r", "\n",
-			"<dedent>\t\n", "b", "a", "z", "\n",
+	assert token_names("foo\n\tbar\nbaz") == [
+			"NAME", "NEWLINE",
+			"INDENT", "NAME", "NEWLINE",
+			"DEDENT", "NEWLINE", "NAME", "NEWLINE", "EOF",
 	]
 	# what happens when we start out indented?
-	assert swail_lexer("\tfoo") == ["<indent>\t", "f", "o", "o", "\n", "<dedent>\t\n"]
+	assert token_names("\tfoo") == ["INDENT", "NAME", "NEWLINE", "DEDENT", "NEWLINE", "EOF"]
+
+def test_tokenize_sources():
+	"""Tokens should refer to the code they were made from."""
+	tokens = swail_tokenizer("foo.bar(12, baz) # comment\n")
+	assert [token.source for token in tokens] == [
+			"foo", ".", "bar", "(", "12", ",", "baz", ")", "\n", "", "",
+	]
+	assert tokens[2].source_pos.columnno == 4
+	assert tokens[-1].name == "EOF"
+
+def test_tokenize_blank_lines():
+	"""Lines without statements don't affect indentation."""
+	assert token_names("foo\n\tbar\n\n  \n# comment\n\tbaz\n") == [
+			"NAME", "NEWLINE",
+			"INDENT", "NAME", "NEWLINE", "NEWLINE", "NEWLINE", "NEWLINE",
+			"NAME", "NEWLINE", "NEWLINE",
+			"DEDENT", "NEWLINE", "EOF",
+	]
+	swail_parser("def foo():\n\tbar\n\n\tbaz\n")
+
+def test_tokenize_error():
+	"""Unknown characters should give a lexer error."""
+	with pytest.raises(LexerError):
+		swail_tokenizer("foo\n\tbar(\"baz\")\n")
 
 def test_visit_reduces_singleton_node():
 	"""Replacing a _node with only one child should give us the child."""
@@ -165,3 +203,24 @@ def test_parse_with_newlines():
 	without_newlines = swail_parser("call(arg1, arg2)")
 	with_newlines = swail_parser("\n\n\ncall(arg1, arg2)\n\n\n")
 	assert without_newlines.eq(with_newlines)
+
+def test_many_statements():
+	"""Files with many statements don't overflow the stack."""
+	stmts = swail_parser("foo(1, bar)\n" * 2000 + "def baz():\n\tquux\n")
+	assert length(stmts) == 2001
+	assert index(stmts, 2000).member is statement.members[u"declaration"]
+
+def test_match():
+	"""A match statement has a default block and a list of cases."""
+	stmt = index(swail_parser("match foo:\n\t1\ncase bar.baz(`x, `y):\n\tx\ncase quux():\n\t2\n"), 0)
+	assert stmt.member is statement.members[u"match"]
+	assert stmt.get_field(0).member is expression.members[u"name_access"]
+	assert length(stmt.get_field(1)) == 1
+	cases = to_list(stmt.get_field(2))
+	assert len(cases) == 2
+	assert [name.value for name in to_list(cases[0].get_field(0))] == [u"bar", u"baz"]
+	assert [name.value for name in to_list(cases[0].get_field(1))] == [u"x", u"y"]
+	assert length(cases[0].get_field(2)) == 1
+	assert to_list(cases[1].get_field(1)) == []
+	# match and case are keywords, not names
+	assert token_names("match case matches")[:3] == ["__5_match", "__6_case", "NAME"]
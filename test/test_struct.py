@@ -1,7 +1,8 @@
 import pytest
 
-from rswail.struct import Struct, construct
-from rswail.value import String
+from rswail.struct import Struct, StructInstance0, StructInstance2, StructInstanceN, construct, make_instance
+from rswail.cons_list import cons, cons_list, empty, from_list
+from rswail.value import Integer, String
 
 def test_get_struct_member():
 	"""Define a struct and get one of its members."""
@@ -43,3 +44,65 @@ def test_struct_equivalence():
 	assert not instance_just.eq(construct(struct, u"just", String(u"Goodbye!")))
 	# maybe this should just raise an error, but they're definitely different
 	assert not instance_just.eq(construct(struct, u"just"))
+
+def test_instance_fields():
+	"""Instances store their fields in a class specialized to the count."""
+	pair = Struct(u"pair", {u"pair": [u"first", u"second"]})
+	first = String(u"first")
+	second = String(u"second")
+	instance = construct(pair, u"pair", first, second)
+	assert isinstance(instance, StructInstance2)
+	assert instance.field_count() == 2
+	assert instance.get_field(0) is first
+	assert instance.get_field(1) is second
+	assert instance.get_named_field(u"second") is second
+	with pytest.raises(KeyError):
+		instance.get_named_field(u"third")
+	assert instance.get_name() == u"pair"
+
+def test_make_instance():
+	"""Making an instance from a list is equivalent to constructing it."""
+	many = Struct(u"many", {u"none": [], u"many": [u"a", u"b", u"c", u"d", u"e"]})
+	values = [String(letter) for letter in [u"a", u"b", u"c", u"d", u"e"]]
+	instance = make_instance(many.members[u"many"], values)
+	assert isinstance(instance, StructInstanceN)
+	assert instance.eq(construct(many, u"many", *values))
+	assert instance.get_named_field(u"e").eq(u"e")
+	assert isinstance(make_instance(many.members[u"none"], []), StructInstance0)
+
+def test_nullary_instances_shared():
+	"""Members without fields only have one instance."""
+	struct = Struct(u"maybe", {u"nothing": [], u"just": [u"value"]})
+	assert construct(struct, u"nothing") is construct(struct, u"nothing")
+	assert make_instance(struct.members[u"nothing"], []) is construct(struct, u"nothing")
+	assert construct(struct, u"just", String(u"x")) is not construct(struct, u"just", String(u"x"))
+
+def test_structural_hash():
+	"""Equivalent instances have the same hash, which is cached."""
+	struct = Struct(u"maybe", {u"nothing": [], u"just": [u"value"]})
+	just1 = construct(struct, u"just", String(u"Hello!"))
+	just2 = construct(struct, u"just", String(u"Hello!"))
+	assert just1.hash() == just2.hash()
+	assert just1.hash_value != 0
+	assert just1.hash() != construct(struct, u"nothing").hash()
+	# instances with different cached hashes can't be equivalent
+	goodbye = construct(struct, u"just", String(u"Goodbye!"))
+	goodbye.hash()
+	assert not just1.eq(goodbye)
+
+def test_list_hash():
+	"""Lists hash the same as the cons instances they're equivalent to."""
+	elements = [Integer.from_int(1), Integer.from_int(2)]
+	nested = construct(cons_list, u"cons", elements[0],
+			construct(cons_list, u"cons", elements[1], construct(cons_list, u"empty")))
+	assert from_list(elements).eq(nested)
+	assert from_list(elements).hash() == nested.hash()
+	assert cons(elements[0], cons(elements[1], empty())).hash() == nested.hash()
+	assert from_list(elements[:1]).hash() != nested.hash()
+
+def test_member_tags():
+	"""The members of a struct are numbered by their tags."""
+	struct = Struct(u"maybe", {u"nothing": [], u"just": [u"value"]})
+	for member in struct.members.values():
+		assert struct.member_list[member.tag] is member
+	assert sorted(member.tag for member in struct.members.values()) == [0, 1]
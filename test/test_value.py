@@ -3,38 +3,99 @@
 from __future__ import unicode_literals
 
 import pytest
+import sys
 
 from rpython.rlib.rbigint import rbigint
 
-from rswail.value import Boolean, Integer, String, Unit, Value
+from rswail.value import Boolean, Integer, Label, String, Unit, Value, make_value_dict
 
 def test_integer_from_int():
 	"""Making an integer from an int should be equivalent to going via rbigint."""
 	assert Integer.from_int(37).eq(Integer(rbigint.fromint(37)))
 def test_integer_from_string():
 	"""Making an integer from a string should be equivalent to going via int."""
-	assert Integer.from_int(37).eq(Integer.from_decimal(u"37"))
+	assert Integer.from_int(37).eq(Integer.from_decimal(b"37"))
 	assert Integer.from_int(37).eq(Integer.from_string(String(u"37")))
 
 def test_stringify_int():
 	"""Make sure base values have their representation as name."""
-	assert Integer(rbigint.fromint(37)).name == u"37"
-	assert Integer(rbigint.fromint(0)).name == u"0"
-	assert Integer(rbigint.fromint(-42)).name == u"-42"
+	assert Integer(rbigint.fromint(37)).get_name() == u"37"
+	assert Integer(rbigint.fromint(0)).get_name() == u"0"
+	assert Integer(rbigint.fromint(-42)).get_name() == u"-42"
+	assert Integer.from_decimal(b"123456789012345678901234567890").get_name() == u"123456789012345678901234567890"
 	# and the same with the .get method
 	assert Integer(rbigint.fromint(37)).get(u"name").eq(String(u"37"))
 
+def test_small_integers():
+	"""Integers that fit in a machine word don't need a bigint."""
+	assert Integer.from_int(37).is_small()
+	assert Integer(rbigint.fromint(37)).is_small()
+	assert not Integer.from_decimal(b"123456789012345678901234567890").is_small()
+
+def test_integer_arithmetic():
+	"""Arithmetic works on small integers and on bigints."""
+	assert Integer.from_int(2).add(Integer.from_int(3)).eq(5)
+	assert Integer.from_int(2).sub(Integer.from_int(3)).eq(-1)
+	assert Integer.from_int(2).mul(Integer.from_int(3)).eq(6)
+	big = Integer.from_decimal(b"123456789012345678901234567890")
+	assert big.add(Integer.from_int(1)).eq(Integer.from_decimal(b"123456789012345678901234567891"))
+	assert big.sub(big).eq(0)
+	assert big.sub(big).is_small()
+
+def test_integer_overflow():
+	"""Results that don't fit in a machine word become bigints."""
+	largest = Integer.from_int(sys.maxint)
+	smallest = Integer.from_int(-sys.maxint - 1)
+	assert largest.add(Integer.from_int(1)).eq(rbigint.fromint(sys.maxint).int_add(1))
+	assert not largest.add(Integer.from_int(1)).is_small()
+	assert smallest.sub(Integer.from_int(1)).eq(rbigint.fromint(-sys.maxint - 1).int_sub(1))
+	assert largest.mul(largest).eq(rbigint.fromint(sys.maxint).mul(rbigint.fromint(sys.maxint)))
+	assert largest.add(Integer.from_int(1)).sub(Integer.from_int(1)).is_small()
+
 def test_stringify_bool():
 	"""Make sure base values have their representation as name."""
-	assert Boolean(True).name == u"True"
-	assert Boolean(False).name == u"False"
+	assert Boolean(True).get_name() == u"True"
+	assert Boolean(False).get_name() == u"False"
 
 def test_stringify_string():
 	"""Make sure base values have their representation as name."""
-	assert String(u"hello").name == u'"hello"'
-	assert String(u"").name == u'""'
+	assert String(u"hello").get_name() == u'"hello"'
+	assert String(u"").get_name() == u'""'
 	# TODO: implement escaping and enable this:
-	# assert String(u"\"").name == u'"\""'
+	# assert String(u"\"").get_name() == u'"\""'
+
+def test_stringify_label():
+	"""Make sure base values have their representation as name."""
+	assert Label(37).get_name() == u":37"
+	assert Unit().get_name() == u"()"
+
+def test_attributes_allocated_on_set():
+	"""Values share an empty attribute storage until they get an attribute."""
+	value1 = Value(u"value")
+	value2 = Value(u"value")
+	assert value1.storage is value2.storage
+	value1.set(u"some-attribute", Unit())
+	assert value1.storage is not value2.storage
+	assert value1.get(u"some-attribute").eq(Unit())
+	with pytest.raises(KeyError):
+		value2.get(u"some-attribute")
+
+def test_attributes_share_maps():
+	"""Values with the same attributes in the same order share a map."""
+	value1 = Value(u"value")
+	value2 = Value(u"value")
+	value1.set(u"a", Unit())
+	value1.set(u"b", Unit())
+	value2.set(u"a", Boolean(True))
+	assert value1.map is not value2.map
+	value2.set(u"b", Boolean(False))
+	assert value1.map is value2.map
+	# assigning an existing attribute keeps the map
+	value2.set(u"a", Boolean(False))
+	assert value1.map is value2.map
+	assert value2.get(u"a").eq(False)
+	assert value2.get(u"b").eq(False)
+	assert value1.get(u"b").eq(Unit())
 
 def test_set_and_get():
 	"""Set and get a value's attributes."""
@@ -209,6 +270,36 @@ def test_string_eq():
 	value.value = u"foo"
 	assert not String(u"foo").eq(value)
 
+def test_string_interned():
+	"""Interned strings with the same value are the same object."""
+	assert String.interned(u"foo") is String.interned(u"foo")
+	assert String.interned_utf8(b"A\xe2\x80\x93Eskwadraat") is String.interned(u"A\u2013Eskwadraat")
+	assert String.interned(u"foo").eq(String(u"foo"))
+	assert String.interned(u"foo") is not String(u"foo")
+
+def test_hash():
+	"""Equivalent values have the same hash."""
+	assert Integer.from_int(37).hash() == Integer(rbigint.fromint(37)).hash()
+	big = b"123456789012345678901234567890"
+	assert Integer.from_decimal(big).hash() == Integer.from_decimal(big).hash()
+	assert String(u"foo").hash() == String.interned(u"foo").hash()
+	assert Boolean(True).hash() == Boolean(True).hash()
+	assert Boolean(True).hash() != Boolean(False).hash()
+	assert Unit().hash() == Unit().hash()
+	assert Label(3).hash() == Label(3).hash()
+	assert Label(3).eq(Label(3))
+	value = Value(u"value")
+	assert value.hash() == value.hash()
+
+def test_value_dict():
+	"""Value dicts find keys by equivalence instead of identity."""
+	values = make_value_dict()
+	values[Integer.from_int(1)] = String(u"one")
+	values[String(u"two")] = Integer.from_int(2)
+	assert values[Integer.from_int(1)].eq(u"one")
+	assert values[String(u"two")].eq(2)
+	assert Unit() not in values
+
 def test_string_from_bytes():
 	"""Decoding a String from bytes is equivalent to the corresponding unicode."""
 	assert String.from_bytes(b"").eq(u"")